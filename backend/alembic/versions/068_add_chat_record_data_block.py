@@ -0,0 +1,41 @@
+"""add compressed column data block to chat_record
+
+Revision ID: c3d4e5f6g7h8
+Revises: b2c3d4e5f6g7
+Create Date: 2026-03-02 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c3d4e5f6g7h8'
+down_revision = 'b2c3d4e5f6g7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # ===================================================
+    # 问答结果数据：按列分块压缩存储
+    # 历史 json 文本在应用启动后分批转换，转换前仍可直接读取
+    # ===================================================
+    op.add_column('chat_record', sa.Column('data_block', sa.LargeBinary(), nullable=True))
+
+
+def downgrade():
+    # ===================================================
+    # 回滚前把已转换的数据还原为 json 文本
+    # ===================================================
+    import orjson
+    from apps.chat.curd.record_data import decode_record_data
+
+    conn = op.get_bind()
+    rows = conn.execute(sa.text("SELECT id, data_block FROM chat_record WHERE data_block IS NOT NULL"))
+    for row in rows.fetchall():
+        data_obj = decode_record_data(bytes(row.data_block))
+        data_obj.pop('rows', None)
+        conn.execute(sa.text("UPDATE chat_record SET data = :data WHERE id = :id"),
+                     {'data': orjson.dumps(data_obj).decode(), 'id': row.id})
+
+    op.drop_column('chat_record', 'data_block')
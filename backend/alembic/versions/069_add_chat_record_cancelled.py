@@ -0,0 +1,26 @@
+"""add cancelled flag to chat_record
+
+Revision ID: d4e5f6g7h8i9
+Revises: c3d4e5f6g7h8
+Create Date: 2026-03-05 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'd4e5f6g7h8i9'
+down_revision = 'c3d4e5f6g7h8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # ===================================================
+    # 客户端断开后中止的问答记录
+    # ===================================================
+    op.add_column('chat_record', sa.Column('cancelled', sa.Boolean(), nullable=True, server_default=sa.false()))
+
+
+def downgrade():
+    op.drop_column('chat_record', 'cancelled')
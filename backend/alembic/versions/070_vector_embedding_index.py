@@ -0,0 +1,65 @@
+"""native vector columns and HNSW indexes for embeddings
+
+Revision ID: e5f6g7h8i9j0
+Revises: d4e5f6g7h8i9
+Create Date: 2026-03-09 00:00:00.000000
+
+"""
+from alembic import op
+
+from common.core.config import settings
+
+# revision identifiers, used by Alembic.
+revision = 'e5f6g7h8i9j0'
+down_revision = 'd4e5f6g7h8i9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dimension = int(settings.EMBEDDING_DIMENSION)
+    op.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+
+    # ===================================================
+    # 术语、数据训练：向量列固定维度，HNSW 索引要求列有维度
+    # 维度与当前模型不一致的向量置空，启动后由补全任务重新生成
+    # ===================================================
+    for table in ('terminology', 'data_training'):
+        op.execute(f"UPDATE {table} SET embedding = NULL "
+                   f"WHERE embedding IS NOT NULL AND vector_dims(embedding) <> {dimension}")
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN embedding TYPE vector({dimension})")
+
+    # ===================================================
+    # 表、数据源：json 文本转为向量列，在数据库中排序
+    # ===================================================
+    for table in ('core_table', 'core_datasource'):
+        op.execute(f"""
+            ALTER TABLE {table} ALTER COLUMN embedding TYPE vector({dimension}) USING
+            CASE WHEN embedding IS NULL OR embedding = '' THEN NULL
+                 WHEN vector_dims(embedding::vector) <> {dimension} THEN NULL
+                 ELSE embedding::vector({dimension}) END
+        """)
+
+    for table in ('terminology', 'data_training', 'core_table', 'core_datasource'):
+        op.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_embedding_hnsw ON {table} "
+                   f"USING hnsw (embedding vector_cosine_ops)")
+
+    # 过滤条件的索引，过滤后行数少时走精确排序
+    op.create_index('idx_terminology_oid', 'terminology', ['oid'])
+    op.create_index('idx_data_training_oid_datasource', 'data_training', ['oid', 'datasource'])
+    op.create_index('idx_data_training_oid_advanced_application', 'data_training', ['oid', 'advanced_application'])
+
+
+def downgrade():
+    op.drop_index('idx_data_training_oid_advanced_application', table_name='data_training')
+    op.drop_index('idx_data_training_oid_datasource', table_name='data_training')
+    op.drop_index('idx_terminology_oid', table_name='terminology')
+
+    for table in ('terminology', 'data_training', 'core_table', 'core_datasource'):
+        op.execute(f"DROP INDEX IF EXISTS idx_{table}_embedding_hnsw")
+
+    for table in ('core_table', 'core_datasource'):
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN embedding TYPE text USING embedding::text")
+
+    for table in ('terminology', 'data_training'):
+        op.execute(f"ALTER TABLE {table} ALTER COLUMN embedding TYPE vector")
@@ -0,0 +1,46 @@
+"""chat history, the rolling conversation read on every chat turn
+
+Revision ID: f6g7h8i9j0k1
+Revises: e5f6g7h8i9j0
+Create Date: 2026-03-12 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'f6g7h8i9j0k1'
+down_revision = 'e5f6g7h8i9j0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'chat_history',
+        sa.Column('id', sa.BigInteger(), sa.Identity(always=True), nullable=False),
+        sa.Column('chat_id', sa.BigInteger(), nullable=False),
+        sa.Column('record_id', sa.BigInteger(), nullable=True),
+        sa.Column('log_id', sa.BigInteger(), nullable=True),
+        sa.Column('operate', sa.String(length=3), nullable=True),
+        sa.Column('messages', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+        sa.Column('create_time', sa.DateTime(timezone=False), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+    # 最近一轮：chat_id + operate 倒序取一条；重新生成：按 record_id 取
+    op.create_index('idx_chat_history_chat_id_operate', 'chat_history', ['chat_id', 'operate', 'id'])
+    op.create_index('idx_chat_history_record_id', 'chat_history', ['record_id'])
+    op.create_index('idx_chat_history_log_id', 'chat_history', ['log_id'])
+
+    # 没有 chat_history 的旧对话回退到 chat_log 按 pid 查询
+    op.create_index('idx_chat_log_pid', 'chat_log', ['pid'])
+
+
+def downgrade():
+    op.drop_index('idx_chat_log_pid', table_name='chat_log')
+    op.drop_index('idx_chat_history_log_id', table_name='chat_history')
+    op.drop_index('idx_chat_history_record_id', table_name='chat_history')
+    op.drop_index('idx_chat_history_chat_id_operate', table_name='chat_history')
+    op.drop_table('chat_history')
@@ -0,0 +1,30 @@
+"""chat log segments, prompt message parts stored once by content hash
+
+Revision ID: g7h8i9j0k1l2
+Revises: f6g7h8i9j0k1
+Create Date: 2026-03-13 00:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'g7h8i9j0k1l2'
+down_revision = 'f6g7h8i9j0k1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # chat_log.messages 中较长的消息保存为片段 hash 列表，已有的日志保持原样
+    op.create_table(
+        'chat_log_segment',
+        sa.Column('hash', sa.String(length=64), nullable=False),
+        sa.Column('content', sa.Text(), nullable=False),
+        sa.Column('create_time', sa.DateTime(timezone=False), nullable=True),
+        sa.PrimaryKeyConstraint('hash')
+    )
+
+
+def downgrade():
+    op.drop_table('chat_log_segment')
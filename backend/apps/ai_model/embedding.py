@@ -1,12 +1,18 @@
+import hashlib
 import os.path
 import threading
+import time
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import Future
 from typing import Optional
 
+import orjson
 from langchain_core.embeddings import Embeddings
-from langchain_huggingface import HuggingFaceEmbeddings
 from pydantic import BaseModel
 
 from common.core.config import settings
+from common.utils.utils import SQLBotLogUtil, equals_ignore_case
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -15,11 +21,26 @@ class EmbeddingModelInfo(BaseModel):
     folder: str
     name: str
     device: str = 'cpu'
+    backend: str = 'torch'
+    quantization: str = ''
 
 
 # 使用 HuggingFace 在线模型名称（会自动下载到 cache_folder）
 local_embedding_model = EmbeddingModelInfo(folder=settings.LOCAL_MODEL_PATH,
-                                           name=settings.DEFAULT_EMBEDDING_MODEL)
+                                           name=settings.DEFAULT_EMBEDDING_MODEL,
+                                           backend=settings.EMBEDDING_BACKEND,
+                                           quantization=settings.EMBEDDING_ONNX_QUANTIZATION)
+
+
+def get_model_key(config: EmbeddingModelInfo) -> str:
+    """Key of a model and the way it is run, the vectors of torch, ONNX and each quantization differ slightly"""
+    if equals_ignore_case(config.backend, 'onnx'):
+        return f"{config.name}:onnx:{config.quantization or 'fp32'}"
+    return f"{config.name}:torch"
+
+
+# model, worker and cached question embeddings are keyed by it, vectors of another backend are never mixed in
+DEFAULT_MODEL_KEY = get_model_key(local_embedding_model)
 
 _lock = threading.Lock()
 locks = {}
@@ -31,13 +52,63 @@ class EmbeddingModelCache:
 
     @staticmethod
     def _new_instance(config: EmbeddingModelInfo = local_embedding_model):
+        # sentence-transformers and torch are imported on first use, not when the app starts
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        if equals_ignore_case(config.backend, 'onnx'):
+            try:
+                return EmbeddingModelCache._new_onnx_instance(config)
+            except Exception as e:
+                SQLBotLogUtil.error(f"Load ONNX embedding model {config.name} error, fall back to torch: {e}")
         return HuggingFaceEmbeddings(model_name=config.name, cache_folder=config.folder,
                                      model_kwargs={'device': config.device},
                                      encode_kwargs={'normalize_embeddings': True}
                                      )
 
     @staticmethod
-    def _get_lock(key: str = settings.DEFAULT_EMBEDDING_MODEL):
+    def _new_onnx_instance(config: EmbeddingModelInfo):
+        """
+        The same model run by ONNX Runtime. It is exported once to LOCAL_MODEL_PATH/onnx/<model>,
+        with an int8 dynamically quantized copy when a quantization config is set, and loaded from there.
+        """
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        export_path = os.path.join(config.folder, 'onnx', config.name.replace('/', '__'))
+        file_name = EmbeddingModelCache._find_onnx_file(export_path)
+        if file_name is None:
+            from sentence_transformers import SentenceTransformer
+
+            SQLBotLogUtil.info(f"Export embedding model {config.name} to ONNX: {export_path}")
+            model = SentenceTransformer(config.name, cache_folder=config.folder, device=config.device, backend='onnx')
+            model.save_pretrained(export_path)
+            file_name = EmbeddingModelCache._find_onnx_file(export_path)
+
+        if config.quantization:
+            quantized = f"onnx/model_qint8_{config.quantization}.onnx"
+            if not os.path.exists(os.path.join(export_path, quantized)):
+                from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+                SQLBotLogUtil.info(f"Quantize ONNX embedding model {config.name}: {config.quantization}")
+                model = SentenceTransformer(export_path, device=config.device, backend='onnx',
+                                            model_kwargs={'file_name': file_name})
+                export_dynamic_quantized_onnx_model(model, config.quantization, export_path)
+            file_name = quantized
+
+        return HuggingFaceEmbeddings(model_name=export_path,
+                                     model_kwargs={'device': config.device, 'backend': 'onnx',
+                                                   'model_kwargs': {'file_name': file_name}},
+                                     encode_kwargs={'normalize_embeddings': True}
+                                     )
+
+    @staticmethod
+    def _find_onnx_file(path: str) -> Optional[str]:
+        for file_name in ('onnx/model.onnx', 'model.onnx'):
+            if os.path.exists(os.path.join(path, file_name)):
+                return file_name
+        return None
+
+    @staticmethod
+    def _get_lock(key: str = DEFAULT_MODEL_KEY):
         lock = locks.get(key)
         if lock is None:
             with _lock:
@@ -49,7 +120,7 @@ class EmbeddingModelCache:
         return lock
 
     @staticmethod
-    def get_model(key: str = settings.DEFAULT_EMBEDDING_MODEL,
+    def get_model(key: str = DEFAULT_MODEL_KEY,
                   config: EmbeddingModelInfo = local_embedding_model) -> Embeddings:
         model_instance = _embedding_model.get(key)
         if model_instance is None:
@@ -61,3 +132,309 @@ class EmbeddingModelCache:
                     _embedding_model[key] = model_instance
 
         return model_instance
+
+    @staticmethod
+    def is_ready(key: str = DEFAULT_MODEL_KEY) -> bool:
+        return _embedding_model.get(key) is not None
+
+    @staticmethod
+    def warm_up(key: str = DEFAULT_MODEL_KEY):
+        """Load the model and run it once, so the first question does not pay for it"""
+        start_time = time.time()
+        EmbeddingModelCache.get_model(key).embed_query('SQLBot')
+        SQLBotLogUtil.info(f"embedding model {key} ready in {time.time() - start_time:.2f} seconds")
+
+
+class _EmbedRequest:
+    __slots__ = ('texts', 'future', 'submitted_at')
+
+    def __init__(self, texts: list[str]):
+        self.texts = texts
+        self.future: Future = Future()
+        self.submitted_at = time.monotonic()
+
+
+class _BatchStats:
+    def __init__(self):
+        self.requests = 0
+        self.texts = 0
+        self.batches = 0
+        self.model_time = 0.0
+        self.errors = 0
+        # 最近请求的耗时(秒)，用于计算 p95
+        self.latencies: deque[float] = deque(maxlen=1000)
+
+    def to_dict(self) -> dict:
+        latencies = sorted(self.latencies)
+        p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] if latencies else 0
+        return {
+            'requests': self.requests,
+            'texts': self.texts,
+            'batches': self.batches,
+            'errors': self.errors,
+            'avg_batch_size': round(self.texts / self.batches, 2) if self.batches else 0,
+            'texts_per_second': round(self.texts / self.model_time, 2) if self.model_time else 0,
+            'p95_latency_ms': round(p95 * 1000, 2),
+        }
+
+
+class _EmbeddingWorker:
+    """
+    The only thread calling one embedding model. Concurrent questions are coalesced into micro batches,
+    waiting at most EMBEDDING_BATCH_MAX_WAIT_MS for company, and always run before the next chunk of a bulk job.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self._cond = threading.Condition()
+        self._queries: deque[_EmbedRequest] = deque()
+        self._bulk: deque[_EmbedRequest] = deque()
+        self._started = False
+        self.stats = {'query': _BatchStats(), 'bulk': _BatchStats()}
+
+    def submit(self, texts: list[str], bulk: bool) -> Future:
+        request = _EmbedRequest(texts)
+        with self._cond:
+            (self._bulk if bulk else self._queries).append(request)
+            if not self._started:
+                self._started = True
+                threading.Thread(target=self._work, name='sqlbot-embedding', daemon=True).start()
+            self._cond.notify()
+        return request.future
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queries and not self._bulk:
+                    self._cond.wait()
+                if self._queries:
+                    kind = 'query'
+                    batch = self._take_queries()
+                else:
+                    kind = 'bulk'
+                    batch = [self._bulk.popleft()]
+            self._execute(kind, batch)
+
+    def _take_queries(self) -> list[_EmbedRequest]:
+        batch_size = max(settings.EMBEDDING_BATCH_SIZE, 1)
+        deadline = self._queries[0].submitted_at + settings.EMBEDDING_BATCH_MAX_WAIT_MS / 1000
+        while sum(len(r.texts) for r in self._queries) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._cond.wait(remaining)
+        batch = [self._queries.popleft()]
+        count = len(batch[0].texts)
+        while self._queries and count + len(self._queries[0].texts) <= batch_size:
+            count += len(self._queries[0].texts)
+            batch.append(self._queries.popleft())
+        return batch
+
+    def _execute(self, kind: str, batch: list[_EmbedRequest]):
+        texts = [text for request in batch for text in request.texts]
+        # 按长度排序，减少同一批次内的 padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        stats = self.stats[kind]
+        start = time.perf_counter()
+        try:
+            vectors = EmbeddingModelCache.get_model(self.key).embed_documents([texts[i] for i in order])
+        except Exception as e:
+            stats.errors += 1
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        model_time = time.perf_counter() - start
+
+        results: list[Optional[list[float]]] = [None] * len(texts)
+        for position, index in enumerate(order):
+            results[index] = vectors[position]
+        offset = 0
+        now = time.monotonic()
+        for request in batch:
+            request.future.set_result(results[offset:offset + len(request.texts)])
+            offset += len(request.texts)
+            stats.latencies.append(now - request.submitted_at)
+        stats.requests += len(batch)
+        stats.texts += len(texts)
+        stats.batches += 1
+        stats.model_time += model_time
+
+
+_workers: dict[str, _EmbeddingWorker] = {}
+
+
+class EmbeddingService:
+    """
+    Embedding calls of the application go through here instead of calling the model directly.
+    The local model encodes queries and documents the same way, so both are served by embed_documents batches.
+    """
+
+    @staticmethod
+    def embed_query(text: str, key: str = DEFAULT_MODEL_KEY) -> list[float]:
+        return EmbeddingService._get_worker(key).submit([text], bulk=False).result()[0]
+
+    @staticmethod
+    def embed_documents(texts: list[str], key: str = DEFAULT_MODEL_KEY) -> list[list[float]]:
+        """Bulk embedding, split into EMBEDDING_BATCH_SIZE chunks of texts of similar length"""
+        if not texts:
+            return []
+        batch_size = max(settings.EMBEDDING_BATCH_SIZE, 1)
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        worker = EmbeddingService._get_worker(key)
+        chunks = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+        futures = [worker.submit([texts[i] for i in chunk], bulk=True) for chunk in chunks]
+
+        results: list[Optional[list[float]]] = [None] * len(texts)
+        for chunk, future in zip(chunks, futures):
+            for index, vector in zip(chunk, future.result()):
+                results[index] = vector
+        return results
+
+    @staticmethod
+    def stats() -> dict:
+        return {key: {kind: stats.to_dict() for kind, stats in worker.stats.items()}
+                for key, worker in list(_workers.items())}
+
+    @staticmethod
+    def _get_worker(key: str) -> _EmbeddingWorker:
+        worker = _workers.get(key)
+        if worker is None:
+            with _lock:
+                worker = _workers.get(key)
+                if worker is None:
+                    worker = _EmbeddingWorker(key)
+                    _workers[key] = worker
+        return worker
+
+
+_query_cache_lock = threading.Lock()
+_query_cache: OrderedDict[str, list[float]] = OrderedDict()
+_query_cache_stats = {'hits': 0, 'redis_hits': 0, 'misses': 0, 'redis_errors': 0}
+_redis_client = None
+_REDIS_PREFIX = 'sqlbot-cache:embedding:'
+
+
+class QueryEmbeddingCache:
+    """
+    Embeddings of questions, keyed by model key (name, backend and quantization) + normalized text.
+    A bounded LRU in the process, with Redis behind it when CACHE_TYPE is redis, so the same question is
+    embedded once across lookups, regenerate and recommended questions.
+    """
+
+    @staticmethod
+    def embed_query(text: str, key: str = DEFAULT_MODEL_KEY) -> list[float]:
+        text = normalize_query(text)
+        if settings.EMBEDDING_QUERY_CACHE_SIZE <= 0:
+            return EmbeddingService.embed_query(text, key)
+
+        cache_key = f"{key}:{hashlib.sha1(text.encode('utf-8')).hexdigest()}"
+        with _query_cache_lock:
+            vector = _query_cache.get(cache_key)
+            if vector is not None:
+                _query_cache.move_to_end(cache_key)
+                _query_cache_stats['hits'] += 1
+                return vector
+
+        vector = QueryEmbeddingCache._redis_get(cache_key)
+        if vector is None:
+            vector = EmbeddingService.embed_query(text, key)
+            QueryEmbeddingCache._redis_set(cache_key, vector)
+            with _query_cache_lock:
+                _query_cache_stats['misses'] += 1
+        else:
+            with _query_cache_lock:
+                _query_cache_stats['redis_hits'] += 1
+
+        with _query_cache_lock:
+            _query_cache[cache_key] = vector
+            _query_cache.move_to_end(cache_key)
+            while len(_query_cache) > settings.EMBEDDING_QUERY_CACHE_SIZE:
+                _query_cache.popitem(last=False)
+        return vector
+
+    @staticmethod
+    def stats() -> dict:
+        with _query_cache_lock:
+            stats = dict(_query_cache_stats)
+            stats['size'] = len(_query_cache)
+        total = stats['hits'] + stats['redis_hits'] + stats['misses']
+        stats['max_size'] = settings.EMBEDDING_QUERY_CACHE_SIZE
+        stats['redis'] = _use_redis()
+        stats['hit_rate'] = round((stats['hits'] + stats['redis_hits']) / total, 4) if total else 0
+        return stats
+
+    @staticmethod
+    def clear():
+        with _query_cache_lock:
+            _query_cache.clear()
+
+    @staticmethod
+    def _redis_get(cache_key: str) -> Optional[list[float]]:
+        client = _get_redis_client()
+        if client is None:
+            return None
+        try:
+            value = client.get(f'{_REDIS_PREFIX}{cache_key}')
+            return orjson.loads(value) if value else None
+        except Exception as e:
+            QueryEmbeddingCache._redis_error(e)
+            return None
+
+    @staticmethod
+    def _redis_set(cache_key: str, vector: list[float]):
+        client = _get_redis_client()
+        if client is None:
+            return
+        try:
+            client.set(f'{_REDIS_PREFIX}{cache_key}', orjson.dumps(vector), ex=settings.EMBEDDING_QUERY_CACHE_EXPIRE)
+        except Exception as e:
+            QueryEmbeddingCache._redis_error(e)
+
+    @staticmethod
+    def _redis_error(e: Exception):
+        with _query_cache_lock:
+            _query_cache_stats['redis_errors'] += 1
+        SQLBotLogUtil.warning(f"Query embedding cache redis error: {e}")
+
+
+
+def _use_redis() -> bool:
+    return bool(settings.CACHE_TYPE) and settings.CACHE_TYPE.lower() == 'redis'
+
+
+def _get_redis_client():
+    global _redis_client
+    if not _use_redis():
+        return None
+    if _redis_client is None:
+        with _lock:
+            if _redis_client is None:
+                import redis
+                _redis_client = redis.Redis.from_url(settings.CACHE_REDIS_URL or "redis://localhost:6379/0")
+    return _redis_client
+
+
+def normalize_query(text: str) -> str:
+    return ' '.join(unicodedata.normalize('NFKC', text or '').split())
+
+
+class QueryEmbedding:
+    """Embedding of a question, computed on first use and shared by all lookups of the question"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self._lock = threading.Lock()
+        self._vector: Optional[list[float]] = None
+
+    def get(self) -> list[float]:
+        if self._vector is None:
+            with self._lock:
+                if self._vector is None:
+                    self._vector = QueryEmbeddingCache.embed_query(self.text)
+        return self._vector
+
+
+def embed_question(question: str, question_embedding: Optional[QueryEmbedding] = None) -> list[float]:
+    if question_embedding is not None and question_embedding.text == question:
+        return question_embedding.get()
+    return QueryEmbeddingCache.embed_query(question)
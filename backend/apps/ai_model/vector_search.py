@@ -0,0 +1,35 @@
+from typing import Sequence
+
+from sqlalchemy import text
+
+from common.core.config import settings
+from common.core.deps import SessionDep
+
+
+def set_hnsw_ef_search(session: SessionDep):
+    """Candidate list size of the HNSW scans in the current transaction, rows dropped by filters need a larger one"""
+    session.execute(text(f"SET LOCAL hnsw.ef_search = {max(int(settings.EMBEDDING_HNSW_EF_SEARCH), 1)}"))
+
+
+def rank_ids_by_embedding(session: SessionDep, table_name: str, ids: Sequence[int], embedding: Sequence[float],
+                          limit: int) -> list[tuple[int, float]]:
+    """
+    The `limit` rows of `table_name` among `ids` closest to the embedding, as (id, cosine similarity),
+    most similar first. Rows without embedding are left out.
+    The ids are ranked exactly: with the HNSW index the filter would be applied after an approximate
+    global top ef_search and could leave fewer rows than `limit`, the materialized CTE keeps the index out.
+    """
+    if not ids or limit <= 0:
+        return []
+    sql = f"""
+WITH candidates AS MATERIALIZED (
+    SELECT id, embedding FROM {table_name}
+    WHERE id = ANY(:ids) AND embedding IS NOT NULL
+)
+SELECT id, 1 - (embedding <=> CAST(:embedding AS vector)) AS similarity
+FROM candidates
+ORDER BY embedding <=> CAST(:embedding AS vector)
+LIMIT :limit
+"""
+    rows = session.execute(text(sql), {'embedding': str(list(embedding)), 'ids': list(ids), 'limit': limit})
+    return [(row.id, float(row.similarity)) for row in rows]
@@ -5,7 +5,7 @@ from typing import Optional, List
 
 import orjson
 import pandas as pd
-from fastapi import APIRouter, HTTPException, Path
+from fastapi import APIRouter, HTTPException, Path, Query
 from fastapi.responses import StreamingResponse
 from sqlalchemy import and_, select
 from starlette.responses import JSONResponse
@@ -14,15 +14,16 @@ from apps.chat.curd.chat import delete_chat_with_user, get_chart_data_with_user,
     list_chats, get_chat_with_records, create_chat, rename_chat, \
     delete_chat, get_chat_chart_data, get_chat_predict_data, get_chat_with_records_with_data, get_chat_record_by_id, \
     format_json_data, format_json_list_data, get_chart_config, list_recent_questions, get_chat as get_chat_exec, \
-    rename_chat_with_user, get_chat_log_history
+    rename_chat_with_user, get_chat_log_history, iter_chat_chart_data
 from apps.chat.models.chat_model import CreateChat, ChatRecord, RenameChat, ChatQuestion, AxisObj, QuickCommand, \
     ChatInfo, Chat, ChatFinishStep
 from apps.chat.task.llm import LLMService
+from apps.db.columnar import ColumnarResult
 from apps.swagger.i18n import PLACEHOLDER_PREFIX
 from apps.system.schemas.permission import SqlbotPermission, require_permissions
 from common.core.deps import CurrentAssistant, SessionDep, CurrentUser, Trans
+from common.error import TaskRejectedError
 from common.utils.command_utils import parse_quick_command
-from common.utils.data_format import DataFormat
 from common.audit.models.log_model import OperationType, OperationModules
 from common.audit.schemas.logger_decorator import LogConfig, system_log
 
@@ -73,10 +74,16 @@ async def chat_predict_data(session: SessionDep, chat_record_id: int):
 
 
 @router.get("/record/{chat_record_id}/data", summary=f"{PLACEHOLDER_PREFIX}get_chart_data")
-async def chat_record_data(session: SessionDep, current_user: CurrentUser, chat_record_id: int):
+async def chat_record_data(session: SessionDep, current_user: CurrentUser, chat_record_id: int,
+                           offset: int = Query(0, ge=0), limit: Optional[int] = Query(None, ge=0)):
     def inner():
-        data = get_chart_data_with_user(chat_record_id=chat_record_id, session=session, current_user=current_user)
-        return format_json_data(data)
+        data = get_chart_data_with_user(chat_record_id=chat_record_id, session=session, current_user=current_user,
+                                        offset=offset, limit=limit)
+        result = format_json_data(data)
+        if limit is not None:
+            # 分页读取时返回总行数
+            result['rows'] = data.get('rows', 0)
+        return result
 
     return await asyncio.to_thread(inner)
 
@@ -234,7 +241,7 @@ async def ask_recommend_questions(session: SessionDep, current_user: CurrentUser
 
         return StreamingResponse(_err(e), media_type="text/event-stream")
 
-    return StreamingResponse(llm_service.await_result(), media_type="text/event-stream")
+    return StreamingResponse(llm_service.async_result(), media_type="text/event-stream")
 
 
 @router.get("/recent_questions/{datasource_id}", response_model=List[str],
@@ -351,10 +358,15 @@ async def question_answer_inner(session: SessionDep, current_user: CurrentUser,
 
             return StreamingResponse(_err(e), media_type="text/event-stream")
         else:
-            return JSONResponse(
-                content={'message': str(e)},
-                status_code=500,
-            )
+            return error_response(e)
+
+
+def error_response(e: Exception) -> JSONResponse:
+    if isinstance(e, TaskRejectedError):
+        # 任务队列已满，提示客户端稍后重试
+        return JSONResponse(content={'message': str(e), 'retry_after': e.retry_after}, status_code=429,
+                            headers={'Retry-After': str(e.retry_after)})
+    return JSONResponse(content={'message': str(e)}, status_code=500)
 
 
 async def stream_sql(session: SessionDep, current_user: CurrentUser, request_question: ChatQuestion,
@@ -374,16 +386,12 @@ async def stream_sql(session: SessionDep, current_user: CurrentUser, request_que
 
             return StreamingResponse(_err(e), media_type="text/event-stream")
         else:
-            return JSONResponse(
-                content={'message': str(e)},
-                status_code=500,
-            )
+            return error_response(e)
     if stream:
-        return StreamingResponse(llm_service.await_result(), media_type="text/event-stream")
+        return StreamingResponse(llm_service.async_result(), media_type="text/event-stream")
     else:
-        res = llm_service.await_result()
         raw_data = {}
-        for chunk in res:
+        async for chunk in llm_service.async_result():
             if chunk:
                 raw_data = chunk
         status_code = 200
@@ -413,14 +421,15 @@ async def analysis_or_predict(session: SessionDep, current_user: CurrentUser, ch
 
         stmt = select(ChatRecord.id, ChatRecord.question, ChatRecord.chat_id, ChatRecord.datasource,
                       ChatRecord.engine_type,
-                      ChatRecord.ai_modal_id, ChatRecord.create_by, ChatRecord.chart, ChatRecord.data).where(
+                      ChatRecord.ai_modal_id, ChatRecord.create_by, ChatRecord.chart, ChatRecord.data,
+                      ChatRecord.data_block).where(
             and_(ChatRecord.id == chat_record_id))
         result = session.execute(stmt)
         for r in result:
             record = ChatRecord(id=r.id, question=r.question, chat_id=r.chat_id, datasource=r.datasource,
                                 engine_type=r.engine_type, ai_modal_id=r.ai_modal_id, create_by=r.create_by,
                                 chart=r.chart,
-                                data=r.data)
+                                data=r.data, data_block=r.data_block)
 
         if not record:
             raise Exception(f"Chat record with id {chat_record_id} not found")
@@ -445,16 +454,12 @@ async def analysis_or_predict(session: SessionDep, current_user: CurrentUser, ch
 
             return StreamingResponse(_err(e), media_type="text/event-stream")
         else:
-            return JSONResponse(
-                content={'message': str(e)},
-                status_code=500,
-            )
+            return error_response(e)
     if stream:
-        return StreamingResponse(llm_service.await_result(), media_type="text/event-stream")
+        return StreamingResponse(llm_service.async_result(), media_type="text/event-stream")
     else:
-        res = llm_service.await_result()
         raw_data = {}
-        for chunk in res:
+        async for chunk in llm_service.async_result():
             if chunk:
                 raw_data = chunk
         status_code = 200
@@ -483,12 +488,14 @@ async def export_excel(session: SessionDep, current_user: CurrentUser, chat_reco
         )
     is_predict_data = chat_record.predict_record_id is not None
 
-    _origin_data = format_json_data(get_chat_chart_data(chat_record_id=chat_record_id, session=session))
-
-    _base_field = _origin_data.get('fields')
-    _data = _origin_data.get('data')
+    # 记录数据按块读取写入 Excel，不一次性展开全部行
+    _chunks = iter_chat_chart_data(session=session, chat_record_id=chat_record_id)
+    try:
+        _first_chunk = next(_chunks, None)
+    except Exception:
+        _first_chunk = None
 
-    if not _data:
+    if not _first_chunk or not _first_chunk.get('data'):
         raise HTTPException(
             status_code=500,
             detail=trans("i18n_excel_export.data_is_empty")
@@ -527,21 +534,31 @@ async def export_excel(session: SessionDep, current_user: CurrentUser, chat_reco
     if is_predict_data:
         _predict_data = format_json_list_data(get_chat_predict_data(chat_record_id=chat_record_id, session=session))
 
-    def inner():
-
-        data_list = DataFormat.convert_large_numbers_in_object_array(obj_array=_data + _predict_data, int_threshold=1e11)
+    def row_chunks():
+        yield format_json_list_data(_first_chunk.get('data'))
+        for chunk in _chunks:
+            yield format_json_list_data(chunk.get('data'))
+        if _predict_data:
+            yield _predict_data
 
-        md_data, _fields_list = DataFormat.convert_object_array_for_pandas(fields, data_list)
+    def inner():
 
         # data, _fields_list, col_formats = LLMService.format_pd_data(fields, _data + _predict_data)
 
-        df = pd.DataFrame(md_data, columns=_fields_list)
+        names = {field.value: field.name for field in fields}
 
         buffer = io.BytesIO()
 
         with pd.ExcelWriter(buffer, engine='xlsxwriter',
                             engine_kwargs={'options': {'strings_to_numbers': False}}) as writer:
-            df.to_excel(writer, sheet_name='Sheet1', index=False)
+            start_row = 0
+            for rows in row_chunks():
+                result = ColumnarResult.from_rows([field.value for field in fields], rows)
+                result.stringify_large_numbers(int_threshold=1e11)
+                df = result.to_dataframe(names=names)
+                # 表头只在第一块写入，之后的块接在已写入的行后面
+                df.to_excel(writer, sheet_name='Sheet1', index=False, header=start_row == 0, startrow=start_row)
+                start_row += len(df) + (1 if start_row == 0 else 0)
 
             # 获取 xlsxwriter 的工作簿和工作表对象
             # workbook = writer.book
@@ -1,14 +1,17 @@
 import datetime
-from typing import List, Optional, Union
+from typing import Iterator, List, Optional, Union
 
 import orjson
 import sqlparse
 from sqlalchemy import and_, select, update
-from sqlalchemy import desc, func
+from sqlalchemy import desc, func, text
 from sqlalchemy.orm import aliased
 
 from apps.chat.models.chat_model import Chat, ChatRecord, CreateChat, ChatInfo, RenameChat, ChatQuestion, ChatLog, \
-    TypeEnum, OperationEnum, ChatRecordResult, ChatLogHistory, ChatLogHistoryItem
+    TypeEnum, OperationEnum, ChatRecordResult, ChatLogHistory, ChatLogHistoryItem, ChatHistory
+from apps.chat.curd.log_segment import save_log_messages, load_log_messages
+from apps.chat.curd.record_data import encode_record_data, load_record_data, load_display_record_data, \
+    iter_record_data
 from apps.datasource.crud.recommended_problem import get_datasource_recommended_chart
 from apps.datasource.models.datasource import CoreDatasource
 from apps.db.constant import DB
@@ -101,6 +104,7 @@ def delete_chat(session, chart_id) -> str:
     if not chat:
         return f'Chat with id {chart_id} has been deleted'
 
+    session.query(ChatHistory).filter(ChatHistory.chat_id == chart_id).delete(synchronize_session=False)
     session.delete(chat)
     session.commit()
 
@@ -113,6 +117,7 @@ def delete_chat_with_user(session, current_user: CurrentUser, chart_id) -> str:
         return f'Chat with id {chart_id} has been deleted'
     if chat.create_by != current_user.id:
         raise Exception(f"Chat with id {chart_id} not Owned by the current user")
+    session.query(ChatHistory).filter(ChatHistory.chat_id == chart_id).delete(synchronize_session=False)
     session.delete(chat)
     session.commit()
 
@@ -224,28 +229,40 @@ def get_chat_chart_config(session: SessionDep, chat_record_id: int):
     return {}
 
 
-def get_chart_data_with_user(session: SessionDep, current_user: CurrentUser, chat_record_id: int):
-    stmt = select(ChatRecord.data).where(and_(ChatRecord.id == chat_record_id, ChatRecord.create_by == current_user.id))
+def get_chart_data_with_user(session: SessionDep, current_user: CurrentUser, chat_record_id: int,
+                             offset: int = 0, limit: Optional[int] = None):
+    stmt = select(ChatRecord.data_block, ChatRecord.data).where(
+        and_(ChatRecord.id == chat_record_id, ChatRecord.create_by == current_user.id))
     res = session.execute(stmt)
     for row in res:
         try:
-            return orjson.loads(row.data)
+            return load_record_data(row.data_block, row.data, offset=offset, limit=limit)
         except Exception:
             pass
     return {}
 
 
-def get_chat_chart_data(session: SessionDep, chat_record_id: int):
-    stmt = select(ChatRecord.data).where(and_(ChatRecord.id == chat_record_id))
+def get_chat_chart_data(session: SessionDep, chat_record_id: int, fields: Optional[list[str]] = None,
+                        offset: int = 0, limit: Optional[int] = None):
+    stmt = select(ChatRecord.data_block, ChatRecord.data).where(and_(ChatRecord.id == chat_record_id))
     res = session.execute(stmt)
     for row in res:
         try:
-            return orjson.loads(row.data)
+            return load_record_data(row.data_block, row.data, fields=fields, offset=offset, limit=limit)
         except Exception:
             pass
     return {}
 
 
+def iter_chat_chart_data(session: SessionDep, chat_record_id: int, chunk_rows: Optional[int] = None) -> Iterator[dict]:
+    """按 chunk_rows 行分批读取记录数据，记录不存在时为空"""
+    stmt = select(ChatRecord.data_block, ChatRecord.data).where(and_(ChatRecord.id == chat_record_id))
+    row = session.execute(stmt).first()
+    if row is None:
+        return iter(())
+    return iter_record_data(row.data_block, row.data, chunk_rows=chunk_rows)
+
+
 def get_chat_predict_data_with_user(session: SessionDep, current_user: CurrentUser, chat_record_id: int):
     stmt = select(ChatRecord.predict_data).where(
         and_(ChatRecord.id == chat_record_id, ChatRecord.create_by == current_user.id))
@@ -312,7 +329,7 @@ def get_chat_with_records(session: SessionDep, chart_id: int, current_user: Curr
                    ChatRecord.datasource_select_answer, ChatRecord.analysis_record_id, ChatRecord.predict_record_id,
                    ChatRecord.regenerate_record_id,
                    ChatRecord.recommended_question, ChatRecord.first_chat,
-                   ChatRecord.finish, ChatRecord.error,
+                   ChatRecord.finish, ChatRecord.cancelled, ChatRecord.error,
                    sql_alias_log.reasoning_content.label('sql_reasoning_content'),
                    chart_alias_log.reasoning_content.label('chart_reasoning_content'),
                    analysis_alias_log.reasoning_content.label('analysis_reasoning_content'),
@@ -339,7 +356,8 @@ def get_chat_with_records(session: SessionDep, chart_id: int, current_user: Curr
                       ChatRecord.datasource_select_answer, ChatRecord.analysis_record_id, ChatRecord.predict_record_id,
                       ChatRecord.regenerate_record_id,
                       ChatRecord.recommended_question, ChatRecord.first_chat,
-                      ChatRecord.finish, ChatRecord.error, ChatRecord.data, ChatRecord.predict_data).where(
+                      ChatRecord.finish, ChatRecord.cancelled, ChatRecord.error, ChatRecord.data_block, ChatRecord.data,
+                      ChatRecord.predict_data).where(
             and_(ChatRecord.create_by == current_user.id, ChatRecord.chat_id == chart_id)).order_by(
             ChatRecord.create_time)
 
@@ -407,7 +425,7 @@ def get_chat_with_records(session: SessionDep, chart_id: int, current_user: Curr
                                  analysis_record_id=row.analysis_record_id, predict_record_id=row.predict_record_id,
                                  regenerate_record_id=row.regenerate_record_id,
                                  recommended_question=row.recommended_question, first_chat=row.first_chat,
-                                 finish=row.finish, error=row.error,
+                                 finish=row.finish, cancelled=row.cancelled, error=row.error,
                                  sql_reasoning_content=row.sql_reasoning_content,
                                  chart_reasoning_content=row.chart_reasoning_content,
                                  analysis_reasoning_content=row.analysis_reasoning_content,
@@ -426,17 +444,24 @@ def get_chat_with_records(session: SessionDep, chart_id: int, current_user: Curr
                                  analysis_record_id=row.analysis_record_id, predict_record_id=row.predict_record_id,
                                  regenerate_record_id=row.regenerate_record_id,
                                  recommended_question=row.recommended_question, first_chat=row.first_chat,
-                                 finish=row.finish, error=row.error, data=row.data, predict_data=row.predict_data))
+                                 finish=row.finish, cancelled=row.cancelled, error=row.error,
+                                 predict_data=row.predict_data))
+
+    # 结果数据单独解码，未转换的历史记录仍是 json 文本
+    data_map = {row.id: (row.data_block, row.data, row.chart) for row in result} if with_data else {}
 
     result = list(map(format_record, record_list))
 
-    for row in result:
-        try:
-            data_value = row.get('data')
-            if data_value is not None:
-                row['data'] = format_json_data(data_value)
-        except Exception:
-            pass
+    if with_data:
+        for row in result:
+            try:
+                data_value = load_display_record_data(*data_map[row.get('id')])
+                if data_value:
+                    row['data'] = format_json_data(data_value)
+                    # 总行数，前端据此分页读取其余行
+                    row['data']['rows'] = data_value.get('rows', 0)
+            except Exception:
+                pass
 
     chat_info.records = result
 
@@ -547,7 +572,11 @@ def get_chat_log_history(session: SessionDep, chat_record_id: int, current_user:
     total_tokens = 0
     steps = []
 
-    for log in chat_logs:
+    # 还原按片段存储的完整消息
+    log_messages = [None] * len(chat_logs)
+    if not without_steps:
+        log_messages = load_log_messages(session, [log.messages for log in chat_logs])
+    for log, log_message in zip(chat_logs, log_messages):
         # 计算单条记录的token消耗
         log_tokens = 0
         if log.token_usage is not None:
@@ -592,11 +621,11 @@ def get_chat_log_history(session: SessionDep, chat_record_id: int, current_user:
                 else:
                     operate_name = str(log.operate)
 
-                if log.messages is not None:
-                    message = log.messages
+                if log_message is not None:
+                    message = log_message
                     if not log.operate == OperationEnum.CHOOSE_TABLE:
                         try:
-                            message = orjson.loads(log.messages)
+                            message = orjson.loads(log_message)
                         except Exception:
                             pass
 
@@ -635,6 +664,40 @@ def get_chat_log_history(session: SessionDep, chat_record_id: int, current_user:
     return chat_log_history
 
 
+def get_token_usage_stats(session: SessionDep, days: int = 7) -> dict:
+    """Input tokens of the llm calls of the last `days` days by operation, cached and uncached by the provider"""
+    sql = """
+SELECT operate, count(*) AS calls,
+       sum((token_usage->>'input_tokens')::bigint) AS input_tokens,
+       sum(coalesce((token_usage->>'cached_input_tokens')::bigint, 0)) AS cached_input_tokens,
+       sum(coalesce((token_usage->>'output_tokens')::bigint, 0)) AS output_tokens
+FROM chat_log
+WHERE start_time >= :start_time AND jsonb_typeof(token_usage) = 'object'
+  AND token_usage->>'input_tokens' IS NOT NULL
+GROUP BY operate
+"""
+    start_time = datetime.datetime.now() - datetime.timedelta(days=days)
+    operations = {item.value: item.name for item in OperationEnum}
+    result = {'days': days, 'operations': [], 'total': {}}
+    total = {'calls': 0, 'input_tokens': 0, 'cached_input_tokens': 0, 'output_tokens': 0}
+    for row in session.execute(text(sql), {'start_time': start_time}):
+        item = {'operate': operations.get(row.operate, row.operate), 'calls': row.calls,
+                'input_tokens': int(row.input_tokens or 0), 'cached_input_tokens': int(row.cached_input_tokens or 0),
+                'output_tokens': int(row.output_tokens or 0)}
+        for key in total:
+            total[key] += item[key]
+        result['operations'].append(_with_cache_ratio(item))
+    result['operations'].sort(key=lambda x: x['input_tokens'], reverse=True)
+    result['total'] = _with_cache_ratio(total)
+    return result
+
+
+def _with_cache_ratio(item: dict) -> dict:
+    item['uncached_input_tokens'] = item['input_tokens'] - item['cached_input_tokens']
+    item['cache_hit_rate'] = round(item['cached_input_tokens'] / item['input_tokens'], 4) if item['input_tokens'] else 0
+    return item
+
+
 def get_chat_brief_generate(session: SessionDep, chat_id: int):
     chat = get_chat(session=session, chat_id=chat_id)
     if chat is not None and chat.brief_generate is not None:
@@ -643,30 +706,40 @@ def get_chat_brief_generate(session: SessionDep, chat_id: int):
         return False
 
 
-def list_generate_sql_logs(session: SessionDep, chart_id: int) -> List[ChatLog]:
-    stmt = select(ChatLog).where(
-        and_(ChatLog.pid.in_(select(ChatRecord.id).where(and_(ChatRecord.chat_id == chart_id))),
-             ChatLog.type == TypeEnum.CHAT, ChatLog.operate == OperationEnum.GENERATE_SQL)).order_by(
-        ChatLog.start_time)
-    result = session.execute(stmt).all()
-    _list = []
-    for row in result:
-        for r in row:
-            _list.append(ChatLog(**r.model_dump()))
-    return _list
+# prompts whose conversation is carried into the next turn of the chat
+HISTORY_OPERATIONS = (OperationEnum.GENERATE_SQL, OperationEnum.GENERATE_CHART)
 
 
-def list_generate_chart_logs(session: SessionDep, chart_id: int) -> List[ChatLog]:
-    stmt = select(ChatLog).where(
-        and_(ChatLog.pid.in_(select(ChatRecord.id).where(and_(ChatRecord.chat_id == chart_id))),
-             ChatLog.type == TypeEnum.CHAT, ChatLog.operate == OperationEnum.GENERATE_CHART)).order_by(
-        ChatLog.start_time)
-    result = session.execute(stmt).all()
-    _list = []
-    for row in result:
-        for r in row:
-            _list.append(ChatLog(**r.model_dump()))
-    return _list
+def get_chat_history(session: SessionDep, chat_id: int, operate: OperationEnum, record_id: int = None) -> list[dict]:
+    """
+    Human and ai messages of the last sql or chart prompt of the chat,
+    or of the prompt of `record_id` when the record is regenerated
+    """
+    stmt = select(ChatHistory.messages).where(and_(ChatHistory.chat_id == chat_id, ChatHistory.operate == operate))
+    if record_id:
+        stmt = stmt.where(ChatHistory.record_id == record_id).order_by(ChatHistory.id)
+    else:
+        stmt = stmt.order_by(ChatHistory.id.desc())
+    row = session.execute(stmt.limit(1)).first()
+    if row is not None:
+        return row.messages or []
+
+    # chats from before chat_history, read only the log the history comes from
+    stmt = select(ChatLog.messages).where(and_(ChatLog.type == TypeEnum.CHAT, ChatLog.operate == operate))
+    if record_id:
+        stmt = stmt.where(ChatLog.pid == record_id).order_by(ChatLog.start_time)
+    else:
+        stmt = stmt.where(ChatLog.pid.in_(select(ChatRecord.id).where(ChatRecord.chat_id == chat_id))).order_by(
+            ChatLog.start_time.desc())
+    row = session.execute(stmt.limit(1)).first()
+    return conversation_messages(load_log_messages(session, [row.messages])[0]) if row is not None else []
+
+
+def conversation_messages(messages: Optional[list[dict]]) -> list[dict]:
+    """The messages of a prompt that are carried into the next turn, without the system prompt"""
+    if not messages or not isinstance(messages, list):
+        return []
+    return [msg for msg in messages if isinstance(msg, dict) and msg.get('type') in ('human', 'ai')]
 
 
 def create_chat(session: SessionDep, current_user: CurrentUser, create_chat_obj: CreateChat,
@@ -787,6 +860,7 @@ def save_analysis_predict_record(session: SessionDep, base_record: ChatRecord, a
     record.create_by = base_record.create_by
     record.chart = base_record.chart
     record.data = base_record.data
+    record.data_block = base_record.data_block
 
     if action_type == 'analysis':
         record.analysis_record_id = base_record.id
@@ -806,16 +880,21 @@ def save_analysis_predict_record(session: SessionDep, base_record: ChatRecord, a
 
 def start_log(session: SessionDep, ai_modal_id: int = None, ai_modal_name: str = None, operate: OperationEnum = None,
               record_id: int = None, full_message: Union[list[dict], dict] = None,
-              local_operation: bool = False) -> ChatLog:
+              local_operation: bool = False, chat_id: int = None, start_time: datetime.datetime = None) -> ChatLog:
     log = ChatLog(type=TypeEnum.CHAT, operate=operate, pid=record_id, ai_modal_id=ai_modal_id, base_modal=ai_modal_name,
-                  messages=full_message, start_time=datetime.datetime.now(), local_operation=local_operation)
+                  messages=save_log_messages(full_message), start_time=start_time or datetime.datetime.now(),
+                  local_operation=local_operation)
 
     result = ChatLog(**log.model_dump())
+    result.messages = full_message
 
     session.add(log)
     session.flush()
     session.refresh(log)
     result.id = log.id
+    if chat_id and operate in HISTORY_OPERATIONS:
+        session.add(ChatHistory(chat_id=chat_id, record_id=record_id, log_id=log.id, operate=operate,
+                                messages=conversation_messages(full_message), create_time=log.start_time))
     session.commit()
 
     return result
@@ -832,12 +911,15 @@ def end_log(session: SessionDep, log: ChatLog, full_message: Union[list[dict], d
     log.reasoning_content = reasoning_content if reasoning_content and len(reasoning_content.strip()) > 0 else None
 
     stmt = update(ChatLog).where(and_(ChatLog.id == log.id)).values(
-        messages=log.messages,
+        messages=save_log_messages(full_message),
         token_usage=log.token_usage,
         finish_time=log.finish_time,
         reasoning_content=log.reasoning_content
     )
     session.execute(stmt)
+    if log.operate in HISTORY_OPERATIONS:
+        session.execute(update(ChatHistory).where(and_(ChatHistory.log_id == log.id)).values(
+            messages=conversation_messages(log.messages)))
     session.commit()
 
     return log
@@ -1088,17 +1170,18 @@ def save_error_message(session: SessionDep, record_id: int, message: str) -> Cha
     return result
 
 
-def save_sql_exec_data(session: SessionDep, record_id: int, data: str) -> ChatRecord:
+def save_sql_exec_data(session: SessionDep, record_id: int, data: dict) -> ChatRecord:
     if not record_id:
         raise Exception("Record id cannot be None")
     record = get_chat_record_by_id(session, record_id)
 
-    record.data = data
+    record.data_block = encode_record_data(data)
 
     result = ChatRecord(**record.model_dump())
 
     stmt = update(ChatRecord).where(and_(ChatRecord.id == record.id)).values(
-        data=record.data,
+        data=None,
+        data_block=record.data_block,
     )
 
     session.execute(stmt)
@@ -1108,6 +1191,36 @@ def save_sql_exec_data(session: SessionDep, record_id: int, data: str) -> ChatRe
     return result
 
 
+def save_cancelled_record(session: SessionDep, record_id: int) -> ChatRecord:
+    if not record_id:
+        raise Exception("Record id cannot be None")
+    record = get_chat_record_by_id(session, record_id)
+
+    record.cancelled = True
+    record.finish = True
+    record.finish_time = datetime.datetime.now()
+
+    result = ChatRecord(**record.model_dump())
+
+    stmt = update(ChatRecord).where(and_(ChatRecord.id == record.id)).values(
+        cancelled=record.cancelled,
+        finish=record.finish,
+        finish_time=record.finish_time
+    )
+
+    session.execute(stmt)
+
+    # close the logs of the interrupted steps
+    stmt = update(ChatLog).where(and_(ChatLog.pid == record.id, ChatLog.finish_time.is_(None))).values(
+        finish_time=record.finish_time
+    )
+    session.execute(stmt)
+
+    session.commit()
+
+    return result
+
+
 def finish_record(session: SessionDep, record_id: int) -> ChatRecord:
     if not record_id:
         raise Exception("Record id cannot be None")
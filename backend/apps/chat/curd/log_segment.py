@@ -0,0 +1,161 @@
+import datetime
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Iterable, Optional
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import Session
+
+from apps.chat.models.chat_model import ChatLogSegment
+from common.core.db import engine
+from common.core.deps import SessionDep
+
+# prompt blocks that repeat across logs, each one is stored as a segment of its own,
+# the text around them (questions, history, answers) is unique to the log and stays inline
+SEGMENT_BLOCKS = ('m-schema', 'terminologies', 'sql-examples')
+# shorter blocks stay inline in chat_log.messages
+SEGMENT_MIN_LENGTH = 256
+_KNOWN_HASH_SIZE = 10000
+
+_block_open = re.compile(r'^\s*<(' + '|'.join(SEGMENT_BLOCKS) + r')>\s*$')
+
+_known_hashes: OrderedDict[str, None] = OrderedDict()
+_lock = threading.Lock()
+
+
+def split_segments(content: str) -> list[str]:
+    """
+    Cut a message into the text around the prompt blocks and the blocks themselves,
+    the template, schema, terminology and sql example parts then repeat as identical segments
+    """
+    segments = []
+    current = []
+    closing = None
+    for line in content.splitlines(keepends=True):
+        if closing is None:
+            match = _block_open.match(line)
+            if match:
+                if current:
+                    segments.append(''.join(current))
+                current = [line]
+                closing = f'</{match.group(1)}>'
+                continue
+        current.append(line)
+        if closing is not None and line.strip() == closing:
+            segments.append(''.join(current))
+            current = []
+            closing = None
+    if current:
+        segments.append(''.join(current))
+    return segments
+
+
+def _segment_hash(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def _to_segments(content: str, rows: dict[str, str]) -> Optional[list]:
+    """
+    Parts of a message, the prompt blocks as segment hashes and the text around them inline as `{'text'}`.
+    None when the message has no block worth a segment.
+    """
+    parts = []
+    stored = False
+    for segment in split_segments(content):
+        if len(segment) >= SEGMENT_MIN_LENGTH and _block_open.match(segment.split('\n', 1)[0]):
+            segment_hash = _segment_hash(segment)
+            rows[segment_hash] = segment
+            parts.append(segment_hash)
+            stored = True
+        elif parts and isinstance(parts[-1], dict):
+            parts[-1]['text'] += segment
+        else:
+            parts.append({'text': segment})
+    return parts if stored else None
+
+
+def _from_segments(parts: list, contents: dict[str, str]) -> str:
+    return ''.join(p['text'] if isinstance(p, dict) else contents.get(p, '') for p in parts)
+
+
+def _segment_hashes(parts: list) -> list[str]:
+    return [p for p in parts if isinstance(p, str)]
+
+
+def _is_segmented(messages: Any) -> bool:
+    # a string message saved as segments, the other dict messages never have this single key
+    return isinstance(messages, dict) and messages.keys() == {'segments'}
+
+
+def save_log_messages(messages: Any) -> Any:
+    """
+    Store the repeating prompt blocks of the messages as segments and return the messages to save in
+    chat_log.messages, `{'type', 'content'}` becomes `{'type', 'segments': [hash or {'text'}, ...]}`.
+    A long string is the schema chosen for the question, the content of the m-schema block, and is stored
+    as one segment `{'segments': [hash]}`. Other values are returned unchanged.
+    """
+    rows: dict[str, str] = {}
+    if isinstance(messages, str):
+        if len(messages) < SEGMENT_MIN_LENGTH:
+            return messages
+        segment_hash = _segment_hash(messages)
+        rows[segment_hash] = messages
+        result = {'segments': [segment_hash]}
+    elif isinstance(messages, list):
+        result = []
+        for msg in messages:
+            content = msg.get('content') if isinstance(msg, dict) else None
+            parts = _to_segments(content, rows) if isinstance(content, str) else None
+            if parts is None:
+                result.append(msg)
+                continue
+            result.append({**{k: v for k, v in msg.items() if k != 'content'}, 'segments': parts})
+    else:
+        return messages
+
+    with _lock:
+        new_hashes = [h for h in rows if h not in _known_hashes]
+    if new_hashes:
+        now = datetime.datetime.now()
+        stmt = insert(ChatLogSegment).values(
+            [{'hash': h, 'content': rows[h], 'create_time': now} for h in new_hashes]).on_conflict_do_nothing(
+            index_elements=['hash'])
+        # a session of its own, the pending changes of the caller are left to the caller to commit
+        with Session(engine) as segment_session:
+            segment_session.execute(stmt)
+            # committed before the hashes are remembered, a remembered segment is always in the database
+            segment_session.commit()
+        with _lock:
+            for h in new_hashes:
+                _known_hashes[h] = None
+            while len(_known_hashes) > _KNOWN_HASH_SIZE:
+                _known_hashes.popitem(last=False)
+    return result
+
+
+def load_log_messages(session: SessionDep, messages_list: Iterable[Any]) -> list[Any]:
+    """Rebuild the full messages of several logs, the segments of all of them are read in one query"""
+    messages_list = list(messages_list)
+    hashes = {h for messages in messages_list if isinstance(messages, list)
+              for msg in messages if isinstance(msg, dict) and 'segments' in msg
+              for h in _segment_hashes(msg['segments'])}
+    hashes.update(h for messages in messages_list if _is_segmented(messages)
+                  for h in _segment_hashes(messages['segments']))
+    if not hashes:
+        return messages_list
+
+    contents = dict(session.execute(
+        select(ChatLogSegment.hash, ChatLogSegment.content).where(ChatLogSegment.hash.in_(hashes))).all())
+    result = []
+    for messages in messages_list:
+        if isinstance(messages, list):
+            messages = [{**{k: v for k, v in msg.items() if k != 'segments'},
+                         'content': _from_segments(msg['segments'], contents)}
+                        if isinstance(msg, dict) and 'segments' in msg else msg for msg in messages]
+        elif _is_segmented(messages):
+            messages = _from_segments(messages['segments'], contents)
+        result.append(messages)
+    return result
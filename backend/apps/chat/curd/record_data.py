@@ -0,0 +1,197 @@
+"""
+chat_record.data_block 存储格式（按列分块压缩）:
+
+    MAGIC(4) | VERSION(1) | HEADER_LEN(4, big endian) | HEADER(json) | COLUMN CHUNKS...
+
+HEADER: {"fields": [...], "columns": [...], "rows": n, "chunk_rows": m, "meta": {...},
+         "chunks": [[[offset, size], ...], ...]}
+每列按 chunk_rows 行切分，每个分块是 zlib 压缩后的 json 数组，读取时只解压需要的列和行范围。
+"""
+
+import struct
+import traceback
+import zlib
+from typing import Any, Iterator, Optional
+
+import orjson
+from sqlalchemy import and_, select, update
+
+from apps.chat.models.chat_model import ChatRecord
+from common.core.config import settings
+from common.utils.data_format import DataFormat
+from common.utils.utils import SQLBotLogUtil
+
+MAGIC = b'SQBC'
+VERSION = 1
+_HEAD = struct.Struct('>4sBI')
+
+# 除 fields/data 外需要保留的结果属性
+_META_KEYS = ('sql', 'limit', 'truncated', 'total')
+
+
+def encode_record_data(data_obj: dict, chunk_rows: Optional[int] = None) -> bytes:
+    fields = data_obj.get('fields') or []
+    rows: list[dict] = data_obj.get('data') or []
+    chunk_rows = max(chunk_rows or settings.CHAT_RECORD_DATA_CHUNK_ROWS, 1)
+
+    # 行数据以字段名为 key，重复的字段名只会保留一列
+    columns = list(dict.fromkeys(str(field) for field in fields))
+    if rows:
+        columns.extend(key for key in rows[0].keys() if key not in columns)
+
+    body = bytearray()
+    chunks: list[list[list[int]]] = []
+    for column in columns:
+        values = [row.get(column) for row in rows]
+        column_chunks = []
+        for start in range(0, max(len(values), 1), chunk_rows):
+            packed = zlib.compress(orjson.dumps(values[start:start + chunk_rows]),
+                                   settings.CHAT_RECORD_DATA_COMPRESS_LEVEL)
+            column_chunks.append([len(body), len(packed)])
+            body.extend(packed)
+        chunks.append(column_chunks)
+
+    header = orjson.dumps({
+        'fields': fields,
+        'columns': columns,
+        'rows': len(rows),
+        'chunk_rows': chunk_rows,
+        'meta': {key: data_obj[key] for key in _META_KEYS if key in data_obj},
+        'chunks': chunks,
+    })
+    return _HEAD.pack(MAGIC, VERSION, len(header)) + header + bytes(body)
+
+
+def read_block_header(block: bytes) -> tuple[dict, int]:
+    magic, version, header_len = _HEAD.unpack_from(block, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Unsupported chat record data block')
+    start = _HEAD.size
+    return orjson.loads(block[start:start + header_len]), start + header_len
+
+
+def decode_record_data(block: bytes, fields: Optional[list[str]] = None, offset: int = 0,
+                       limit: Optional[int] = None) -> dict:
+    """
+    :param fields: 只读取这些列，默认全部
+    :param offset: 起始行
+    :param limit: 最多读取的行数，默认到末尾
+    """
+    header, body_start = read_block_header(block)
+    total_rows = header['rows']
+    chunk_rows = header['chunk_rows']
+    start = min(max(offset, 0), total_rows)
+    end = total_rows if limit is None else min(start + max(limit, 0), total_rows)
+
+    columns: list[str] = header['columns']
+    wanted = set(fields) if fields is not None else None
+    selected = columns if wanted is None else [column for column in columns if column in wanted]
+
+    values: dict[str, list] = {}
+    if end > start:
+        first_chunk, last_chunk = start // chunk_rows, (end - 1) // chunk_rows
+        skip = start - first_chunk * chunk_rows
+        for column in selected:
+            column_values = []
+            for chunk_offset, size in header['chunks'][columns.index(column)][first_chunk:last_chunk + 1]:
+                chunk_start = body_start + chunk_offset
+                column_values.extend(orjson.loads(zlib.decompress(block[chunk_start:chunk_start + size])))
+            values[column] = column_values[skip:skip + end - start]
+
+    rows = [dict(zip(values.keys(), row)) for row in zip(*values.values())] if values else []
+
+    result = {'fields': header['fields'] if wanted is None else [f for f in header['fields'] if f in wanted],
+              'data': rows, 'rows': total_rows}
+    result.update(header['meta'])
+    return result
+
+
+def load_record_data(data_block: Optional[bytes], data: Optional[str], fields: Optional[list[str]] = None,
+                     offset: int = 0, limit: Optional[int] = None) -> dict:
+    """读取记录数据，兼容尚未转换的 json 文本"""
+    if data_block:
+        return decode_record_data(bytes(data_block), fields=fields, offset=offset, limit=limit)
+    if not data:
+        return {}
+    data_obj: dict[str, Any] = orjson.loads(data)
+    rows = data_obj.get('data') or []
+    data_obj['rows'] = len(rows)
+    start = max(offset, 0)
+    rows = rows[start:] if limit is None else rows[start:start + max(limit, 0)]
+    if fields is not None:
+        wanted = set(fields)
+        data_obj['fields'] = [f for f in data_obj.get('fields') or [] if f in wanted]
+        rows = [{k: v for k, v in row.items() if k in wanted} for row in rows]
+    data_obj['data'] = rows
+    return data_obj
+
+
+def iter_record_data(data_block: Optional[bytes], data: Optional[str], fields: Optional[list[str]] = None,
+                     chunk_rows: Optional[int] = None) -> Iterator[dict]:
+    """按 chunk_rows 行分批读取记录数据，每批结构同 load_record_data；未转换的 json 文本一次读出"""
+    if not data_block:
+        data_obj = load_record_data(None, data, fields=fields)
+        if data_obj:
+            yield data_obj
+        return
+    block = bytes(data_block)
+    header, _ = read_block_header(block)
+    step = max(chunk_rows or header['chunk_rows'], 1)
+    for offset in range(0, header['rows'], step):
+        yield decode_record_data(block, fields=fields, offset=offset, limit=step)
+
+
+def load_display_record_data(data_block: Optional[bytes], data: Optional[str], chart: Optional[str]) -> dict:
+    """
+    对话历史中随记录返回的数据：只读取图表用到的列及前 CHAT_RECORD_DATA_DISPLAY_ROWS 行，
+    `rows` 为总行数，其余行通过 /chat/record/{id}/data 分页读取
+    """
+    limit = settings.CHAT_RECORD_DATA_DISPLAY_ROWS if settings.CHAT_RECORD_DATA_DISPLAY_ROWS > 0 else None
+    fields = None
+    if chart:
+        try:
+            fields = [f for f in DataFormat.get_chart_field_names(orjson.loads(chart)) if f] or None
+        except Exception:
+            fields = None
+    data_obj = load_record_data(data_block, data, fields=fields, limit=limit)
+    if fields and len(data_obj.get('fields') or []) < len(set(fields)):
+        # 图表中的列在结果中不存在，返回全部列
+        data_obj = load_record_data(data_block, data, limit=limit)
+    return data_obj
+
+
+def run_convert_record_data(session_maker):
+    """把历史记录中的 json 文本数据分批转换为压缩列存"""
+    try:
+        if not settings.CHAT_RECORD_DATA_CONVERT_ENABLED:
+            return
+        batch_size = settings.CHAT_RECORD_DATA_CONVERT_BATCH
+        last_id = 0
+        converted = 0
+        while True:
+            session = session_maker()
+            stmt = select(ChatRecord.id, ChatRecord.data).where(
+                and_(ChatRecord.id > last_id, ChatRecord.data.isnot(None), ChatRecord.data_block.is_(None))).order_by(
+                ChatRecord.id).limit(batch_size)
+            rows = session.execute(stmt).all()
+            if not rows:
+                break
+            for row in rows:
+                last_id = row.id
+                try:
+                    block = encode_record_data(orjson.loads(row.data)) if row.data.strip() else None
+                except Exception as e:
+                    # 无法解析的数据保持原样
+                    SQLBotLogUtil.warning(f"Chat record {row.id} data can not be converted: {e}")
+                    continue
+                session.execute(update(ChatRecord).where(and_(ChatRecord.id == row.id)).values(
+                    data_block=block, data=None))
+                converted += 1
+            session.commit()
+            session_maker.remove()
+        if converted:
+            SQLBotLogUtil.info(f"Converted {converted} chat record data to column blocks")
+    except Exception:
+        traceback.print_exc()
+    finally:
+        session_maker.remove()
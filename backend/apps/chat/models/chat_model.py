@@ -4,7 +4,7 @@ from typing import List, Optional, Union
 
 from fastapi import Body
 from pydantic import BaseModel
-from sqlalchemy import Column, Integer, Text, BigInteger, DateTime, Identity, Boolean
+from sqlalchemy import Column, Integer, Text, BigInteger, DateTime, Identity, Boolean, LargeBinary, String
 from sqlalchemy import Enum as SQLAlchemyEnum
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlmodel import SQLModel, Field
@@ -81,6 +81,27 @@ class ChatLog(SQLModel, table=True):
     error: bool = Field(default=False)
 
 
+class ChatLogSegment(SQLModel, table=True):
+    """Text of a prompt message part, stored once under its sha256, referenced by chat_log.messages"""
+    __tablename__ = "chat_log_segment"
+    hash: str = Field(sa_column=Column(String(64), primary_key=True))
+    content: str = Field(sa_column=Column(Text, nullable=False))
+    create_time: datetime = Field(sa_column=Column(DateTime(timezone=False), nullable=True))
+
+
+class ChatHistory(SQLModel, table=True):
+    """Rolling conversation of a chat, only the human and ai messages of the sql and chart prompts"""
+    __tablename__ = "chat_history"
+    id: Optional[int] = Field(sa_column=Column(BigInteger, Identity(always=True), primary_key=True))
+    chat_id: int = Field(sa_column=Column(BigInteger, nullable=False))
+    record_id: Optional[int] = Field(sa_column=Column(BigInteger, nullable=True))
+    log_id: Optional[int] = Field(sa_column=Column(BigInteger, nullable=True))
+    operate: OperationEnum = Field(
+        sa_column=Column(SQLAlchemyEnum(OperationEnum, native_enum=False, values_callable=enum_values, length=3)))
+    messages: Optional[list[dict]] = Field(sa_column=Column(JSONB))
+    create_time: datetime = Field(sa_column=Column(DateTime(timezone=False), nullable=True))
+
+
 class Chat(SQLModel, table=True):
     __tablename__ = "chat"
     id: Optional[int] = Field(sa_column=Column(BigInteger, Identity(always=True), primary_key=True))
@@ -115,6 +136,7 @@ class ChatRecord(SQLModel, table=True):
     sql: str = Field(sa_column=Column(Text, nullable=True))
     sql_exec_result: str = Field(sa_column=Column(Text, nullable=True))
     data: str = Field(sa_column=Column(Text, nullable=True))
+    data_block: Optional[bytes] = Field(sa_column=Column(LargeBinary, nullable=True))
     chart_answer: str = Field(sa_column=Column(Text, nullable=True))
     chart: str = Field(sa_column=Column(Text, nullable=True))
     analysis: str = Field(sa_column=Column(Text, nullable=True))
@@ -124,6 +146,7 @@ class ChatRecord(SQLModel, table=True):
     recommended_question: str = Field(sa_column=Column(Text, nullable=True))
     datasource_select_answer: str = Field(sa_column=Column(Text, nullable=True))
     finish: bool = Field(sa_column=Column(Boolean, nullable=True, default=False))
+    cancelled: bool = Field(sa_column=Column(Boolean, nullable=True, default=False))
     error: str = Field(sa_column=Column(Text, nullable=True))
     analysis_record_id: int = Field(sa_column=Column(BigInteger, nullable=True))
     predict_record_id: int = Field(sa_column=Column(BigInteger, nullable=True))
@@ -149,6 +172,7 @@ class ChatRecordResult(BaseModel):
     recommended_question: Optional[str] = None
     datasource_select_answer: Optional[str] = None
     finish: Optional[bool] = None
+    cancelled: Optional[bool] = None
     error: Optional[str] = None
     analysis_record_id: Optional[int] = None
     predict_record_id: Optional[int] = None
@@ -228,7 +252,11 @@ class AiModelQuestion(BaseModel):
     error_msg: str = ""
     regenerate_record_id: Optional[int] = None
 
-    def sql_sys_question(self, db_type: Union[str, DB], enable_query_limit: bool = True):
+    def sql_sys_question_parts(self, db_type: Union[str, DB], enable_query_limit: bool = True) -> tuple[str, str]:
+        """
+        System prompt of generate sql as (prefix, context). The prefix only depends on the db type and the schema,
+        it stays the same across questions and can be served from the prompt cache of the model provider
+        """
         _sql_template = get_sql_example_template(db_type)
         _base_template = get_sql_template()
         _process_check = _sql_template.get('process_check') if _sql_template.get('process_check') else _base_template[
@@ -244,16 +272,21 @@ class AiModelQuestion(BaseModel):
             'example_answer_2']
         _example_answer_3 = _sql_template['example_answer_3_with_limit'] if enable_query_limit else _sql_template[
             'example_answer_3']
-        return _base_template['system'].format(engine=self.engine, schema=self.db_schema, question=self.question,
-                                               lang=self.lang, terminologies=self.terminologies,
-                                               data_training=self.data_training, custom_prompt=self.custom_prompt,
-                                               process_check=_process_check,
-                                               base_sql_rules=_base_sql_rules,
-                                               basic_sql_examples=_sql_examples,
-                                               example_engine=_example_engine,
-                                               example_answer_1=_example_answer_1,
-                                               example_answer_2=_example_answer_2,
-                                               example_answer_3=_example_answer_3)
+        _prefix = _base_template['system'].format(engine=self.engine, schema=self.db_schema, lang=self.lang,
+                                                  process_check=_process_check,
+                                                  base_sql_rules=_base_sql_rules,
+                                                  basic_sql_examples=_sql_examples,
+                                                  example_engine=_example_engine,
+                                                  example_answer_1=_example_answer_1,
+                                                  example_answer_2=_example_answer_2,
+                                                  example_answer_3=_example_answer_3)
+        _context = _base_template['system_context'].format(terminologies=self.terminologies,
+                                                           data_training=self.data_training,
+                                                           custom_prompt=self.custom_prompt)
+        return _prefix, _context
+
+    def sql_sys_question(self, db_type: Union[str, DB], enable_query_limit: bool = True):
+        return ''.join(self.sql_sys_question_parts(db_type, enable_query_limit))
 
     def sql_user_question(self, current_time: str, change_title: bool):
         _question = self.question
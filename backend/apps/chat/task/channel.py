@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import traceback
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from common.core.config import settings
+
+
+class ChunkChannel:
+    """
+    Bounded producer/consumer channel between the worker thread running a chat task and the response.
+    The worker blocks in put() while the buffer is full (backpressure), the consumer is woken as soon as a
+    chunk arrives. Once the consumer goes away the channel is cancelled and put() returns False.
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max(max_size or settings.CHAT_STREAM_BUFFER_SIZE, 1)
+        self._buffer: deque = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._cancelled = False
+        self._waiter: Optional[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = None
+        self._on_cancel: list[Callable[[], None]] = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+
+    def put(self, chunk: Any) -> bool:
+        with self._cond:
+            while len(self._buffer) >= self.max_size and not self._cancelled:
+                self._cond.wait()
+            if self._cancelled:
+                return False
+            self._buffer.append(chunk)
+            self._cond.notify_all()
+            waiter = self._waiter
+        self._wake(waiter)
+        return True
+
+    def close(self):
+        """Producer finished, the consumer stops after the buffered chunks"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            waiter = self._waiter
+        self._wake(waiter)
+
+    def on_cancel(self, callback: Callable[[], None]):
+        """Register a callback run once when the consumer goes away, it must not block"""
+        with self._cond:
+            if not self._cancelled:
+                self._on_cancel.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        """Consumer is gone, drop buffered chunks and release a blocked producer"""
+        with self._cond:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            self._buffer.clear()
+            self._cond.notify_all()
+            callbacks = self._on_cancel
+            self._on_cancel = []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                traceback.print_exc()
+
+    def __iter__(self) -> Iterator[Any]:
+        try:
+            while True:
+                with self._cond:
+                    while not self._buffer and not self._closed:
+                        self._cond.wait()
+                    if not self._buffer:
+                        return
+                    chunks = list(self._buffer)
+                    self._buffer.clear()
+                    self._cond.notify_all()
+                yield from chunks
+        finally:
+            self._finish_consumer()
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        try:
+            while True:
+                with self._cond:
+                    chunks = list(self._buffer)
+                    self._buffer.clear()
+                    if chunks:
+                        self._cond.notify_all()
+                    elif self._closed:
+                        return
+                    else:
+                        event.clear()
+                        self._waiter = (loop, event)
+                if not chunks:
+                    await event.wait()
+                    continue
+                for chunk in chunks:
+                    yield chunk
+        finally:
+            # client disconnected or response aborted, stop the producer as well
+            self._finish_consumer()
+
+    def _finish_consumer(self):
+        with self._cond:
+            self._waiter = None
+            closed = self._closed
+        if not closed:
+            self.cancel()
+
+    @staticmethod
+    def _wake(waiter: Optional[tuple[asyncio.AbstractEventLoop, asyncio.Event]]):
+        if waiter is None:
+            return
+        loop, event = waiter
+        try:
+            loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            # event loop already closed
+            pass
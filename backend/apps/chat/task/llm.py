@@ -1,15 +1,16 @@
 import concurrent
 import json
 import os
+import sys
+import threading
 import traceback
 import urllib.parse
 import warnings
-from concurrent.futures import ThreadPoolExecutor, Future
+from concurrent.futures import Future
 from datetime import datetime
 from typing import Any, List, Optional, Union, Dict, Iterator
 
 import orjson
-import pandas as pd
 import requests
 import sqlparse
 from langchain.chat_models.base import BaseChatModel
@@ -23,23 +24,28 @@ from sqlbot_xpack.custom_prompt.models.custom_prompt_model import CustomPromptTy
 from sqlbot_xpack.license.license_manage import SQLBotLicenseUtil
 from sqlmodel import Session
 
+from apps.ai_model.embedding import QueryEmbedding
 from apps.ai_model.model_factory import LLMConfig, LLMFactory, get_default_config
 from apps.chat.curd.chat import save_question, save_sql_answer, save_sql, \
     save_error_message, save_sql_exec_data, save_chart_answer, save_chart, \
     finish_record, save_analysis_answer, save_predict_answer, save_predict_data, \
     save_select_datasource_answer, save_recommend_question_answer, \
     get_old_questions, save_analysis_predict_record, rename_chat, get_chart_config, \
-    get_chat_chart_data, list_generate_sql_logs, list_generate_chart_logs, start_log, end_log, \
+    get_chat_chart_data, get_chat_history, start_log, end_log, \
     get_last_execute_sql_error, format_json_data, format_chart_fields, get_chat_brief_generate, get_chat_predict_data, \
-    get_chat_chart_config, trigger_log_error
+    get_chat_chart_config, trigger_log_error, save_cancelled_record
 from apps.chat.models.chat_model import ChatQuestion, ChatRecord, Chat, RenameChat, ChatLog, OperationEnum, \
-    ChatFinishStep, AxisObj
+    ChatFinishStep
+from apps.chat.task.channel import ChunkChannel
 from apps.data_training.curd.data_training import get_training_template
 from apps.datasource.crud.datasource import get_table_schema
 from apps.datasource.crud.permission import get_row_permission_filters, is_normal_user
 from apps.datasource.embedding.ds_embedding import get_ds_embedding
 from apps.datasource.models.datasource import CoreDatasource
-from apps.db.db import exec_sql, get_version, check_connection
+from apps.db.columnar import ColumnarResult
+from apps.db.db import get_version
+from apps.db.ds_context import DatasourceContext
+from apps.db.sql_rewrite import inject_row_filters, replace_tables
 from apps.system.crud.assistant import AssistantOutDs, AssistantOutDsFactory, get_assistant_ds
 from apps.system.crud.parameter_manage import get_groups
 from apps.system.schemas.system_schema import AssistantOutDsSchema
@@ -47,16 +53,19 @@ from apps.terminology.curd.terminology import get_terminology_template
 from common.core.config import settings
 from common.core.db import engine
 from common.core.deps import CurrentAssistant, CurrentUser
-from common.error import SingleMessageError, SQLBotDBError, ParseSQLResultError, SQLBotDBConnectionError
+from common.error import SingleMessageError, SQLBotDBError, ParseSQLResultError, SQLBotDBConnectionError, \
+    TaskCancelledError, TaskRejectedError
 from common.utils.data_format import DataFormat
 from common.utils.locale import I18n, I18nHelper
+from common.utils.task_scheduler import TaskScheduler, QUEUE_CHAT, QUEUE_ANALYSIS, QUEUE_RECOMMEND, QUEUE_CHART, \
+    QUEUE_RETRIEVAL
 from common.utils.utils import SQLBotLogUtil, extract_nested_json, prepare_for_orjson
 
 warnings.filterwarnings("ignore")
 
-executor = ThreadPoolExecutor(max_workers=200)
 
 dynamic_ds_types = [1, 3]
+sql_row_limit = 1000
 dynamic_subsql_prefix = 'select * from sqlbot_dynamic_temp_table_'
 
 session_maker = scoped_session(sessionmaker(bind=engine, class_=Session))
@@ -77,14 +86,18 @@ class LLMService:
     current_user: CurrentUser
     current_assistant: Optional[CurrentAssistant] = None
     out_ds_instance: Optional[AssistantOutDs] = None
+    ds_context: Optional[DatasourceContext] = None
+    question_embedding: Optional[QueryEmbedding] = None
     change_title: bool = False
 
-    generate_sql_logs: List[ChatLog] = []
-    generate_chart_logs: List[ChatLog] = []
+    sql_history: List[dict[str, Any]] = []
+    chart_history: List[dict[str, Any]] = []
 
     current_logs: dict[OperationEnum, ChatLog] = {}
+    # stable system prompt prefixes, marked as cacheable when LLM_PROMPT_CACHE_HINT is on
+    prompt_cache_prefixes: List[str] = []
 
-    chunk_list: List[str] = []
+    channel: ChunkChannel
     future: Future
 
     trans: I18nHelper = None
@@ -98,7 +111,8 @@ class LLMService:
     def __init__(self, session: Session, current_user: CurrentUser, chat_question: ChatQuestion,
                  current_assistant: Optional[CurrentAssistant] = None, no_reasoning: bool = False,
                  embedding: bool = False, config: LLMConfig = None):
-        self.chunk_list = []
+        self.channel = ChunkChannel()
+        self.channel.on_cancel(self.cancel)
         self.current_user = current_user
         self.current_assistant = current_assistant
         chat_id = chat_question.chat_id
@@ -134,8 +148,11 @@ class LLMService:
                     raise SingleMessageError("No available datasource configuration found")
                 chat_question.engine = (ds.type_name if ds.type != 'excel' else 'PostgreSQL') + get_version(ds)
 
-        self.generate_sql_logs = list_generate_sql_logs(session=session, chart_id=chat_id)
-        self.generate_chart_logs = list_generate_chart_logs(session=session, chart_id=chat_id)
+        # conversation of the last turn, or of the turn before the regenerated record
+        self.sql_history = get_chat_history(session=session, chat_id=chat_id, operate=OperationEnum.GENERATE_SQL,
+                                            record_id=chat_question.regenerate_record_id)
+        self.chart_history = get_chat_history(session=session, chat_id=chat_id, operate=OperationEnum.GENERATE_CHART,
+                                              record_id=chat_question.regenerate_record_id)
 
         self.change_title = not get_chat_brief_generate(session=session, chat_id=chat_id)
 
@@ -145,6 +162,8 @@ class LLMService:
         self.ds = (
             ds if isinstance(ds, AssistantOutDsSchema) else CoreDatasource(**ds.model_dump())) if ds else None
         self.chat_question = chat_question
+        # embedded once, shared by the terminology, sql example, table and datasource lookups
+        self.question_embedding = QueryEmbedding(chat_question.question)
         self.config = config
         if no_reasoning:
             # only work while using qwen
@@ -202,23 +221,15 @@ class LLMService:
             return True
 
     def init_messages(self, session: Session):
-
-        self.choose_table_schema(session)
-
-        last_sql_messages: List[dict[str, Any]] = self.generate_sql_logs[-1].messages if len(
-            self.generate_sql_logs) > 0 else []
-        if self.chat_question.regenerate_record_id:
-            # filter record before regenerate_record_id
-            _temp_log = next(
-                filter(lambda obj: obj.pid == self.chat_question.regenerate_record_id, self.generate_sql_logs), None)
-            last_sql_messages: List[dict[str, Any]] = _temp_log.messages if _temp_log else []
+        last_sql_messages: List[dict[str, Any]] = self.sql_history
 
         count_limit = self.base_message_round_count_limit
 
         self.sql_message = []
         # add sys prompt
-        self.sql_message.append(SystemMessage(
-            content=self.chat_question.sql_sys_question(self.ds.type, self.enable_sql_row_limit)))
+        sql_prefix, sql_context = self.chat_question.sql_sys_question_parts(self.ds.type, self.enable_sql_row_limit)
+        self.prompt_cache_prefixes = [sql_prefix]
+        self.sql_message.append(SystemMessage(content=sql_prefix + sql_context))
         if last_sql_messages is not None and len(last_sql_messages) > 0:
             last_rounds = get_last_conversation_rounds(last_sql_messages, rounds=count_limit)
 
@@ -231,13 +242,7 @@ class LLMService:
                     _msg = AIMessage(content=_msg_dict.get('content'))
                     self.sql_message.append(_msg)
 
-        last_chart_messages: List[dict[str, Any]] = self.generate_chart_logs[-1].messages if len(
-            self.generate_chart_logs) > 0 else []
-        if self.chat_question.regenerate_record_id:
-            # filter record before regenerate_record_id
-            _temp_log = next(
-                filter(lambda obj: obj.pid == self.chat_question.regenerate_record_id, self.generate_chart_logs), None)
-            last_chart_messages: List[dict[str, Any]] = _temp_log.messages if _temp_log else []
+        last_chart_messages: List[dict[str, Any]] = self.chart_history
 
         count_chart_limit = self.base_message_round_count_limit
 
@@ -285,7 +290,8 @@ class LLMService:
                                                                   record_id=self.record.id, local_operation=True)
 
         self.chat_question.terminologies, term_list = get_terminology_template(_session, self.chat_question.question,
-                                                                               calculate_oid, calculate_ds_id)
+                                                                               calculate_oid, calculate_ds_id,
+                                                                               self.question_embedding)
         self.current_logs[OperationEnum.FILTER_TERMS] = end_log(session=_session,
                                                                 log=self.current_logs[OperationEnum.FILTER_TERMS],
                                                                 full_message=term_list)
@@ -326,17 +332,58 @@ class LLMService:
             self.chat_question.data_training, example_list = get_training_template(_session,
                                                                                    self.chat_question.question,
                                                                                    calculate_oid,
-                                                                                   None, self.current_assistant.id)
+                                                                                   None, self.current_assistant.id,
+                                                                                   self.question_embedding)
         else:
             self.chat_question.data_training, example_list = get_training_template(_session,
                                                                                    self.chat_question.question,
                                                                                    calculate_oid,
-                                                                                   calculate_ds_id)
+                                                                                   calculate_ds_id, None,
+                                                                                   self.question_embedding)
         self.current_logs[OperationEnum.FILTER_SQL_EXAMPLE] = end_log(session=_session,
                                                                       log=self.current_logs[
                                                                           OperationEnum.FILTER_SQL_EXAMPLE],
                                                                       full_message=example_list)
 
+    def retrieve_context(self, _session: Session, oid: int = None, ds_id: int = None):
+        """
+        Terminologies, sql examples, custom prompts and the table schema do not depend on each other, they are
+        looked up concurrently on their own sessions and share one embedding of the question.
+        Each step keeps its own log, so the time of every lookup is still recorded.
+        """
+        steps = [(self.filter_terminology_template, oid, ds_id),
+                 (self.filter_training_template, oid, ds_id),
+                 (self.filter_custom_prompts, CustomPromptTypeEnum.GENERATE_SQL, oid, ds_id)]
+        futures: List[Future] = []
+        for fn, *args in steps:
+            try:
+                futures.append(TaskScheduler.submit(QUEUE_RETRIEVAL, self.run_with_session, fn, *args,
+                                                    workspace=self.current_user.oid))
+            except TaskRejectedError:
+                # saturated, run the step here
+                fn(_session, *args)
+        # the table schema is usually the slowest, it runs on the current thread meanwhile
+        error = None
+        try:
+            self.choose_table_schema(_session)
+        except Exception as e:
+            error = e
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                error = error or e
+        if error:
+            raise error
+
+    @staticmethod
+    def run_with_session(fn, *args):
+        _session = session_maker()
+        try:
+            return fn(_session, *args)
+        finally:
+            session_maker.remove()
+
     def choose_table_schema(self, _session: Session):
         self.current_logs[OperationEnum.CHOOSE_TABLE] = start_log(session=_session,
                                                                   operate=OperationEnum.CHOOSE_TABLE,
@@ -347,7 +394,8 @@ class LLMService:
             session=_session,
             current_user=self.current_user,
             ds=self.ds,
-            question=self.chat_question.question)
+            question=self.chat_question.question,
+            question_embedding=self.question_embedding)
 
         self.current_logs[OperationEnum.CHOOSE_TABLE] = end_log(session=_session,
                                                                 log=self.current_logs[OperationEnum.CHOOSE_TABLE],
@@ -382,7 +430,7 @@ class LLMService:
         full_thinking_text = ''
         full_analysis_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(analysis_msg), token_usage)
+        res = process_stream(self.stream_llm(analysis_msg), token_usage)
         for chunk in res:
             if chunk.get('content'):
                 full_analysis_text += chunk.get('content')
@@ -430,7 +478,7 @@ class LLMService:
         full_thinking_text = ''
         full_predict_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(predict_msg), token_usage)
+        res = process_stream(self.stream_llm(predict_msg), token_usage)
         for chunk in res:
             if chunk.get('content'):
                 full_predict_text += chunk.get('content')
@@ -482,7 +530,7 @@ class LLMService:
         full_thinking_text = ''
         full_guess_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(guess_msg), token_usage)
+        res = process_stream(self.stream_llm(guess_msg), token_usage)
         for chunk in res:
             if chunk.get('content'):
                 full_guess_text += chunk.get('content')
@@ -534,7 +582,8 @@ class LLMService:
             if settings.TABLE_EMBEDDING_ENABLED and (
                     not self.current_assistant or (self.current_assistant and self.current_assistant.type != 1)):
                 _ds_list = get_ds_embedding(_session, self.current_user, _ds_list, self.out_ds_instance,
-                                            self.chat_question.question, self.current_assistant)
+                                            self.chat_question.question, self.current_assistant,
+                                            self.question_embedding)
                 # yield {'content': '{"id":' + str(ds.get('id')) + '}'}
 
             _ds_list_dict = []
@@ -554,7 +603,7 @@ class LLMService:
                                                                                          msg in datasource_msg])
 
             token_usage = {}
-            res = process_stream(self.llm.stream(datasource_msg), token_usage)
+            res = process_stream(self.stream_llm(datasource_msg), token_usage)
             for chunk in res:
                 if chunk.get('content'):
                     full_text += chunk.get('content')
@@ -635,11 +684,7 @@ class LLMService:
             oid = self.ds.oid if isinstance(self.ds, CoreDatasource) else 1
             ds_id = self.ds.id if isinstance(self.ds, CoreDatasource) else None
 
-            self.filter_terminology_template(_session, oid, ds_id)
-
-            self.filter_training_template(_session, oid, ds_id)
-
-            self.filter_custom_prompts(_session, CustomPromptTypeEnum.GENERATE_SQL, oid, ds_id)
+            self.retrieve_context(_session, oid, ds_id)
 
             self.init_messages(_session)
 
@@ -657,13 +702,14 @@ class LLMService:
                                                                   ai_modal_name=self.chat_question.ai_modal_name,
                                                                   operate=OperationEnum.GENERATE_SQL,
                                                                   record_id=self.record.id,
+                                                                  chat_id=self.chat_question.chat_id,
                                                                   full_message=[
                                                                       {'type': msg.type, 'content': msg.content} for msg
                                                                       in self.sql_message])
         full_thinking_text = ''
         full_sql_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(self.sql_message), token_usage)
+        res = process_stream(self.stream_llm(self.sql_message), token_usage)
         for chunk in res:
             if chunk.get('content'):
                 full_sql_text += chunk.get('content')
@@ -703,7 +749,7 @@ class LLMService:
         full_thinking_text = ''
         full_dynamic_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(dynamic_sql_msg), token_usage)
+        res = process_stream(self.stream_llm(dynamic_sql_msg), token_usage)
         for chunk in res:
             if chunk.get('content'):
                 full_dynamic_text += chunk.get('content')
@@ -725,20 +771,47 @@ class LLMService:
         SQLBotLogUtil.info(full_dynamic_text)
         return full_dynamic_text
 
-    def generate_assistant_dynamic_sql(self, _session: Session, sql, tables: List):
+    def generate_assistant_dynamic_sql(self, _session: Session, sql) -> Optional[str]:
+        """The sql to execute, with the tables defined by a sql of the assistant datasource replaced by that sql"""
         ds: AssistantOutDsSchema = self.ds
-        sub_query = []
-        result_dict = {}
-        for table in ds.tables:
-            if table.name in tables and table.sql:
-                # sub_query.append({"table": table.name, "query": table.sql})
-                result_dict[table.name] = table.sql
-                sub_query.append({"table": table.name, "query": f'{dynamic_subsql_prefix}{table.name}'})
-        if not sub_query:
+        replacements = {table.name: table.sql for table in ds.tables or [] if table.sql}
+        if not replacements:
             return None
+        self.current_logs[OperationEnum.GENERATE_DYNAMIC_SQL] = start_log(session=_session,
+                                                                          operate=OperationEnum.GENERATE_DYNAMIC_SQL,
+                                                                          record_id=self.record.id,
+                                                                          local_operation=True)
+        # sub queries are kept out of the log, as they were kept out of the saved sql before
+        full_message = [{'type': 'human', 'content': json.dumps({'sql': sql, 'tables': list(replacements.keys())},
+                                                                ensure_ascii=False)}]
+        try:
+            dynamic_sql = replace_tables(sql, replacements, ds.type)
+        except ValueError as e:
+            SQLBotLogUtil.warning(f"Replace dynamic tables of sql failed: {e}")
+            full_message.append({'type': 'ai', 'content': str(e)})
+            log = end_log(session=_session, log=self.current_logs[OperationEnum.GENERATE_DYNAMIC_SQL],
+                          full_message=full_message)
+            trigger_log_error(_session, log)
+            if settings.ASSISTANT_DYNAMIC_SQL_LLM_FALLBACK:
+                return self.generate_llm_dynamic_sql(_session, sql, replacements)
+            raise SingleMessageError(orjson.dumps({'message': 'Cannot replace dynamic tables of sql',
+                                                   'traceback': f"Cannot replace dynamic tables of sql:\n{e}"}).decode())
+
+        self.current_logs[OperationEnum.GENERATE_DYNAMIC_SQL] = end_log(session=_session,
+                                                                        log=self.current_logs[
+                                                                            OperationEnum.GENERATE_DYNAMIC_SQL],
+                                                                        full_message=full_message)
+        return dynamic_sql
+
+    def generate_llm_dynamic_sql(self, _session: Session, sql, replacements: dict[str, str]) -> str:
+        # the LLM only sees placeholders, they are replaced by the sub queries afterwards
+        sub_query = [{"table": name, "query": f'{dynamic_subsql_prefix}{name}'} for name in replacements]
         temp_sql_text = self.generate_with_sub_sql(session=_session, sql=sql, sub_mappings=sub_query)
-        result_dict['sqlbot_temp_sql_text'] = temp_sql_text
-        return result_dict
+        dynamic_sql, *_ = self.check_sql(session=_session, res=temp_sql_text,
+                                         operate=OperationEnum.GENERATE_DYNAMIC_SQL)
+        for name, subsql in replacements.items():
+            dynamic_sql = dynamic_sql.replace(f'{dynamic_subsql_prefix}{name}', subsql)
+        return dynamic_sql
 
     def build_table_filter(self, session: Session, sql: str, filters: list):
         filter = json.dumps(filters, ensure_ascii=False)
@@ -761,7 +834,7 @@ class LLMService:
         full_thinking_text = ''
         full_filter_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(permission_sql_msg), token_usage)
+        res = process_stream(self.stream_llm(permission_sql_msg), token_usage)
         for chunk in res:
             if chunk.get('content'):
                 full_filter_text += chunk.get('content')
@@ -783,12 +856,41 @@ class LLMService:
         SQLBotLogUtil.info(full_filter_text)
         return full_filter_text
 
+    def apply_table_filter(self, session: Session, sql: str, filters: list):
+        """Rewrite the sql with the row permissions locally, the LLM is only asked when enabled as fallback"""
+        self.current_logs[OperationEnum.GENERATE_SQL_WITH_PERMISSIONS] = start_log(session=session,
+                                                                                   operate=OperationEnum.GENERATE_SQL_WITH_PERMISSIONS,
+                                                                                   record_id=self.record.id,
+                                                                                   local_operation=True)
+        # same message shape as the LLM steps, so the execution details show what went in and out
+        full_message = [{'type': 'human', 'content': json.dumps({'sql': sql, 'filters': filters}, ensure_ascii=False)}]
+        try:
+            permission_sql = inject_row_filters(sql, filters, self.ds.type)
+        except ValueError as e:
+            SQLBotLogUtil.warning(f"Apply row permission to sql failed: {e}")
+            full_message.append({'type': 'ai', 'content': str(e)})
+            log = end_log(session=session, log=self.current_logs[OperationEnum.GENERATE_SQL_WITH_PERMISSIONS],
+                          full_message=full_message)
+            trigger_log_error(session, log)
+            if settings.ROW_PERMISSION_LLM_FALLBACK:
+                return self.build_table_filter(session=session, sql=sql, filters=filters)
+            raise SingleMessageError(orjson.dumps({'message': 'Cannot apply row permission to sql',
+                                                   'traceback': f"Cannot apply row permission to sql:\n{e}"}).decode())
+
+        full_message.append({'type': 'ai', 'content': permission_sql})
+        self.current_logs[OperationEnum.GENERATE_SQL_WITH_PERMISSIONS] = end_log(session=session,
+                                                                                 log=self.current_logs[
+                                                                                     OperationEnum.GENERATE_SQL_WITH_PERMISSIONS],
+                                                                                 full_message=full_message)
+        # same answer format as the LLM, goes through check_save_sql
+        return orjson.dumps({'success': True, 'sql': permission_sql}).decode()
+
     def generate_filter(self, _session: Session, sql: str, tables: List):
         filters = get_row_permission_filters(session=_session, current_user=self.current_user, ds=self.ds,
                                              tables=tables)
         if not filters:
             return None
-        return self.build_table_filter(session=_session, sql=sql, filters=filters)
+        return self.apply_table_filter(session=_session, sql=sql, filters=filters)
 
     def generate_assistant_filter(self, _session: Session, sql, tables: List):
         ds: AssistantOutDsSchema = self.ds
@@ -798,25 +900,20 @@ class LLMService:
                 filters.append({"table": table.name, "filter": table.rule})
         if not filters:
             return None
-        return self.build_table_filter(session=_session, sql=sql, filters=filters)
-
-    def generate_chart(self, _session: Session, chart_type: Optional[str] = '', schema: Optional[str] = ''):
-        # append current question
-        self.chart_message.append(HumanMessage(self.chat_question.chart_user_question(chart_type, schema)))
+        return self.apply_table_filter(session=_session, sql=sql, filters=filters)
 
-        self.current_logs[OperationEnum.GENERATE_CHART] = start_log(session=_session,
-                                                                    ai_modal_id=self.chat_question.ai_modal_id,
-                                                                    ai_modal_name=self.chat_question.ai_modal_name,
-                                                                    operate=OperationEnum.GENERATE_CHART,
-                                                                    record_id=self.record.id,
-                                                                    full_message=[
-                                                                        {'type': msg.type, 'content': msg.content} for
-                                                                        msg
-                                                                        in self.chart_message])
+    def stream_chart(self, chart_type: Optional[str], schema: Optional[str], answer: dict):
+        """
+        Chart answer of the LLM. It may run in the chart queue while the sql is executed, so nothing is saved
+        and the service is not changed here: the messages, the answer and the token usage are collected in
+        `answer`, run_task saves them with save_chart_result once the query succeeded.
+        """
+        messages = self.chart_message + [HumanMessage(self.chat_question.chart_user_question(chart_type, schema))]
+        answer['start_time'] = datetime.now()
         full_thinking_text = ''
         full_chart_text = ''
         token_usage = {}
-        res = process_stream(self.llm.stream(self.chart_message), token_usage)
+        res = process_stream(self.stream_llm(messages), token_usage)
         for chunk in res:
             if chunk.get('content'):
                 full_chart_text += chunk.get('content')
@@ -824,17 +921,33 @@ class LLMService:
                 full_thinking_text += chunk.get('reasoning_content')
             yield chunk
 
-        self.chart_message.append(AIMessage(full_chart_text))
+        answer.update(messages=messages, content=full_chart_text, reasoning_content=full_thinking_text,
+                      token_usage=token_usage)
+
+    def save_chart_result(self, _session: Session, answer: dict):
+        self.current_logs[OperationEnum.GENERATE_CHART] = start_log(session=_session,
+                                                                    ai_modal_id=self.chat_question.ai_modal_id,
+                                                                    ai_modal_name=self.chat_question.ai_modal_name,
+                                                                    operate=OperationEnum.GENERATE_CHART,
+                                                                    record_id=self.record.id,
+                                                                    chat_id=self.chat_question.chat_id,
+                                                                    full_message=[
+                                                                        {'type': msg.type, 'content': msg.content} for
+                                                                        msg
+                                                                        in answer['messages']],
+                                                                    start_time=answer['start_time'])
+
+        self.chart_message = answer['messages'] + [AIMessage(answer['content'])]
 
         self.record = save_chart_answer(session=_session, record_id=self.record.id,
-                                        answer=orjson.dumps({'content': full_chart_text}).decode())
+                                        answer=orjson.dumps({'content': answer['content']}).decode())
         self.current_logs[OperationEnum.GENERATE_CHART] = end_log(session=_session,
                                                                   log=self.current_logs[OperationEnum.GENERATE_CHART],
                                                                   full_message=[
                                                                       {'type': msg.type, 'content': msg.content}
                                                                       for msg in self.chart_message],
-                                                                  reasoning_content=full_thinking_text,
-                                                                  token_usage=token_usage)
+                                                                  reasoning_content=answer['reasoning_content'],
+                                                                  token_usage=answer['token_usage'])
 
     def check_sql(self, session: Session, res: str, operate: OperationEnum) -> tuple[str, Optional[list]]:
         json_str = extract_nested_json(res)
@@ -997,23 +1110,25 @@ class LLMService:
     def save_sql_data(self, session: Session, data_obj: Dict[str, Any]):
         try:
             data_result = data_obj.get('data')
-            limit = 1000
+            limit = sql_row_limit
             if data_result:
                 data_result = prepare_for_orjson(data_result)
-                if data_result and len(data_result) > limit and self.enable_sql_row_limit:
+                if data_result and (len(data_result) > limit or data_obj.get('truncated')) and self.enable_sql_row_limit:
                     data_obj['data'] = data_result[:limit]
                     data_obj['limit'] = limit
                 else:
                     data_obj['data'] = data_result
-            return save_sql_exec_data(session=session, record_id=self.record.id,
-                                      data=orjson.dumps(data_obj).decode())
+            return save_sql_exec_data(session=session, record_id=self.record.id, data=data_obj)
         except Exception as e:
             raise e
 
     def finish(self, session: Session):
         return finish_record(session=session, record_id=self.record.id)
 
-    def execute_sql(self, sql: str):
+    def save_cancelled(self, session: Session):
+        return save_cancelled_record(session=session, record_id=self.record.id)
+
+    def execute_sql(self, sql: str) -> ColumnarResult:
         """Execute SQL query
 
         Args:
@@ -1024,62 +1139,142 @@ class LLMService:
             Query results
         """
         SQLBotLogUtil.info(f"Executing SQL on ds_id {self.ds.id}: {sql}")
+        self.check_cancelled()
         try:
-            return exec_sql(ds=self.ds, sql=sql, origin_column=False)
+            # with the row limit on, rows beyond it would be dropped by save_sql_data, do not fetch them at all
+            max_rows = sql_row_limit if self.enable_sql_row_limit else None
+            return self.get_ds_context().query_sql(sql=sql, origin_column=False, max_rows=max_rows)
         except Exception as e:
-            if isinstance(e, ParseSQLResultError):
+            if isinstance(e, (ParseSQLResultError, TaskCancelledError)):
                 raise e
             else:
                 err = traceback.format_exc(limit=1, chain=True)
                 raise SQLBotDBError(err)
 
-    def pop_chunk(self):
+    def get_ds_context(self) -> DatasourceContext:
+        # self.ds may be replaced by select_datasource, keep the context bound to the current one
+        if self.ds_context is None or self.ds_context.ds is not self.ds:
+            self.ds_context = DatasourceContext(self.ds)
+        return self.ds_context
+
+    def cancel(self):
+        # 客户端已断开，在后台线程中止正在执行的查询，避免阻塞事件循环
+        ds_context = self.ds_context
+        if ds_context is not None:
+            threading.Thread(target=ds_context.cancel, daemon=True).start()
+
+    def check_cancelled(self):
+        if self.channel.cancelled:
+            raise TaskCancelledError(f"Chat record {self.record.id} cancelled")
+
+    def stream_llm(self, messages: List[Union[BaseMessage, dict[str, Any]]]) -> Iterator[BaseMessageChunk]:
+        """LLM stream which stops at the next token once the client is gone"""
+        res = self.llm.stream(with_prompt_cache_hints(messages, self.prompt_cache_prefixes))
         try:
-            chunk = self.chunk_list.pop(0)
-            return chunk
-        except IndexError as e:
-            return None
+            for chunk in res:
+                self.check_cancelled()
+                yield chunk
+        finally:
+            # closing the generator releases the underlying http stream
+            close = getattr(res, 'close', None)
+            if close:
+                close()
 
     def await_result(self):
-        while self.is_running():
-            while True:
-                chunk = self.pop_chunk()
-                if chunk is not None:
-                    yield chunk
-                else:
+        yield from self.channel
+
+    def async_result(self):
+        """Chunks of the running task as an async iterator, for StreamingResponse"""
+        return aiter(self.channel)
+
+    def produce_chunks(self, chunks: Iterator, channel: Optional[ChunkChannel] = None):
+        channel = channel or self.channel
+        try:
+            for chunk in chunks:
+                if not channel.put(chunk):
+                    # 客户端已断开，停止继续生成
                     break
-        while True:
-            chunk = self.pop_chunk()
-            if chunk is None:
-                break
-            yield chunk
+        finally:
+            chunks.close()
+            channel.close()
+
+    def submit_task(self, queue: str, fn, *args, record_error: bool = True):
+        try:
+            self.future = TaskScheduler.submit(queue, fn, *args, workspace=self.current_user.oid)
+        except TaskRejectedError as e:
+            if record_error:
+                _session = session_maker()
+                try:
+                    self.save_error(session=_session, message=str(e))
+                finally:
+                    session_maker.remove()
+            raise e
 
     def run_task_async(self, in_chat: bool = True, stream: bool = True,
                        finish_step: ChatFinishStep = ChatFinishStep.GENERATE_CHART):
         if in_chat:
             stream = True
-        self.future = executor.submit(self.run_task_cache, in_chat, stream, finish_step)
+        self.submit_task(QUEUE_CHAT, self.run_task_cache, in_chat, stream, finish_step)
 
     def run_task_cache(self, in_chat: bool = True, stream: bool = True,
                        finish_step: ChatFinishStep = ChatFinishStep.GENERATE_CHART):
-        for chunk in self.run_task(in_chat, stream, finish_step):
-            self.chunk_list.append(chunk)
+        self.produce_chunks(self.run_task(in_chat, stream, finish_step))
+
+    def stream_table_chart(self, _session: Session, chart_type: Optional[str], tables: Optional[list], answer: dict):
+        used_tables_schema = self.out_ds_instance.get_db_schema(
+            self.ds.id, self.chat_question.question, embedding=False,
+            table_list=tables) if self.out_ds_instance else get_table_schema(
+            session=_session,
+            current_user=self.current_user,
+            ds=self.ds,
+            question=self.chat_question.question,
+            embedding=False, table_list=tables)
+        SQLBotLogUtil.info('used_tables_schema: \n' + used_tables_schema)
+        yield from self.stream_chart(chart_type, used_tables_schema, answer)
+
+    def run_chart_cache(self, channel: ChunkChannel, chart_type: Optional[str], tables: Optional[list]) -> dict:
+        answer = {}
+        _session = session_maker()
+        try:
+            self.produce_chunks(self.stream_table_chart(_session, chart_type, tables, answer), channel)
+        finally:
+            session_maker.remove()
+        return answer
+
+    def start_chart_task(self, chart_type: Optional[str],
+                         tables: Optional[list]) -> Optional[tuple[ChunkChannel, Future]]:
+        """
+        Generate the chart while the sql is executed, it only needs the sql and the schema of the used tables.
+        Returns None when the chart queue is saturated, the chart is then generated after the query.
+        """
+        # read only once the query is saved, a bounded buffer would stall the chart stream until then
+        channel = ChunkChannel(max_size=sys.maxsize)
+        try:
+            future = TaskScheduler.submit(QUEUE_CHART, self.run_chart_cache, channel, chart_type, tables,
+                                          workspace=self.current_user.oid)
+        except TaskRejectedError:
+            return None
+        return channel, future
+
+    @staticmethod
+    def chart_task_chunks(chart_task: tuple[ChunkChannel, Future], answer: dict):
+        channel, future = chart_task
+        yield from channel
+        # answer of the chart generation, or its error
+        answer.update(future.result())
 
     def run_task(self, in_chat: bool = True, stream: bool = True,
                  finish_step: ChatFinishStep = ChatFinishStep.GENERATE_CHART):
         json_result: Dict[str, Any] = {'success': True}
         _session = None
+        chart_task = None
         try:
             _session = session_maker()
             if self.ds:
                 oid = self.ds.oid if isinstance(self.ds, CoreDatasource) else 1
                 ds_id = self.ds.id if isinstance(self.ds, CoreDatasource) else None
 
-                self.filter_terminology_template(_session, oid, ds_id)
-
-                self.filter_training_template(_session, oid, ds_id)
-
-                self.filter_custom_prompts(_session, CustomPromptTypeEnum.GENERATE_SQL, oid, ds_id)
+                self.retrieve_context(_session, oid, ds_id)
 
                 self.init_messages(_session)
 
@@ -1117,7 +1312,7 @@ class LLMService:
                 self.validate_history_ds(_session)
 
             # check connection
-            connected = check_connection(ds=self.ds, trans=None)
+            connected = self.get_ds_context().check_connection()
             if not connected:
                 raise SQLBotDBConnectionError('Connect DB failed')
 
@@ -1154,9 +1349,7 @@ class LLMService:
 
             use_dynamic_ds: bool = self.current_assistant and self.current_assistant.type in dynamic_ds_types
             is_page_embedded: bool = self.current_assistant and self.current_assistant.type == 4
-            dynamic_sql_result = None
-            sqlbot_temp_sql_text = None
-            assistant_dynamic_sql = None
+            dynamic_sql = None
             # row permission
 
             sql_operate = OperationEnum.GENERATE_SQL
@@ -1166,9 +1359,8 @@ class LLMService:
                 sql_result = None
 
                 if use_dynamic_ds:
-                    dynamic_sql_result = self.generate_assistant_dynamic_sql(_session, sql, tables)
-                    sqlbot_temp_sql_text = dynamic_sql_result.get(
-                        'sqlbot_temp_sql_text') if dynamic_sql_result else None
+                    # the sub queries are only used for execution, the saved and shown sql stays as generated
+                    dynamic_sql = self.generate_assistant_dynamic_sql(_session, sql)
                 else:
                     sql_result = self.generate_filter(_session, sql, tables)  # maybe no sql and tables
 
@@ -1176,10 +1368,6 @@ class LLMService:
                     SQLBotLogUtil.info(sql_result)
                     sql_operate = OperationEnum.GENERATE_SQL_WITH_PERMISSIONS
                     sql = self.check_save_sql(session=_session, res=sql_result, operate=sql_operate)
-                elif dynamic_sql_result and sqlbot_temp_sql_text:
-                    sql_operate = OperationEnum.GENERATE_DYNAMIC_SQL
-                    assistant_dynamic_sql = self.check_save_sql(session=_session, res=sqlbot_temp_sql_text,
-                                                                operate=sql_operate)
                 else:
                     sql = self.check_save_sql(session=_session, res=full_sql_text, operate=sql_operate)
             else:
@@ -1198,13 +1386,7 @@ class LLMService:
                     yield f'```sql\n{format_sql}\n```\n\n'
 
             # execute sql
-            real_execute_sql = sql
-            if sqlbot_temp_sql_text and assistant_dynamic_sql:
-                dynamic_sql_result.pop('sqlbot_temp_sql_text')
-                for origin_table, subsql in dynamic_sql_result.items():
-                    assistant_dynamic_sql = assistant_dynamic_sql.replace(f'{dynamic_subsql_prefix}{origin_table}',
-                                                                          subsql)
-                real_execute_sql = assistant_dynamic_sql
+            real_execute_sql = dynamic_sql or sql
 
             if finish_step.value <= ChatFinishStep.GENERATE_SQL.value:
                 if in_chat:
@@ -1213,6 +1395,9 @@ class LLMService:
                     yield json_result
                 return
 
+            if finish_step.value > ChatFinishStep.QUERY_DATA.value:
+                chart_task = self.start_chart_task(chart_type, tables)
+
             self.current_logs[OperationEnum.EXECUTE_SQL] = start_log(session=_session,
                                                                      operate=OperationEnum.EXECUTE_SQL,
                                                                      record_id=self.record.id, local_operation=True)
@@ -1220,12 +1405,14 @@ class LLMService:
             self.current_logs[OperationEnum.EXECUTE_SQL] = end_log(session=_session,
                                                                    log=self.current_logs[OperationEnum.EXECUTE_SQL],
                                                                    full_message={'sql': real_execute_sql,
-                                                                                 'count': len(result.get('data'))})
+                                                                                 'count': result.num_rows,
+                                                                                 'total': result.total,
+                                                                                 'truncated': result.truncated})
 
-            _data = DataFormat.convert_large_numbers_in_object_array(result.get('data'))
-            result["data"] = _data
+            result.stringify_large_numbers()
+            result_data = result.to_dict()
 
-            self.save_sql_data(session=_session, data_obj=result)
+            self.save_sql_data(session=_session, data_obj=result_data)
             if in_chat:
                 yield 'data:' + orjson.dumps({'content': 'execute-success', 'type': 'sql-data'}).decode() + '\n\n'
             if not stream:
@@ -1236,37 +1423,22 @@ class LLMService:
                     if in_chat:
                         yield 'data:' + orjson.dumps({'type': 'finish'}).decode() + '\n\n'
                     else:
-                        _column_list = []
-                        for field in result.get('fields'):
-                            _column_list.append(AxisObj(name=field, value=field))
-
-                        md_data, _fields_list = DataFormat.convert_object_array_for_pandas(_column_list,
-                                                                                           result.get('data'))
-
-                        # data, _fields_list, col_formats = self.format_pd_data(_column_list, result.get('data'))
-
-                        if not _data or not _fields_list:
+                        if not result.num_rows or not result.fields:
                             yield 'The SQL execution result is empty.\n\n'
                         else:
-                            df = pd.DataFrame(_data, columns=_fields_list)
-                            df_safe = DataFormat.safe_convert_to_string(df)
-                            markdown_table = df_safe.to_markdown(index=False)
-                            yield markdown_table + '\n\n'
+                            for text in result.iter_markdown():
+                                yield text + '\n'
+                            yield '\n'
                 else:
                     yield json_result
                 return
 
-            # generate chart
-            used_tables_schema = self.out_ds_instance.get_db_schema(
-                self.ds.id, self.chat_question.question, embedding=False,
-                table_list=tables) if self.out_ds_instance else get_table_schema(
-                session=_session,
-                current_user=self.current_user,
-                ds=self.ds,
-                question=self.chat_question.question,
-                embedding=False, table_list=tables)
-            SQLBotLogUtil.info('used_tables_schema: \n' + used_tables_schema)
-            chart_res = self.generate_chart(_session, chart_type, used_tables_schema)
+            # generate chart, started together with the query when possible
+            chart_answer = {}
+            if chart_task:
+                chart_res = self.chart_task_chunks(chart_task, chart_answer)
+            else:
+                chart_res = self.stream_table_chart(_session, chart_type, tables, chart_answer)
             full_chart_text = ''
             for chunk in chart_res:
                 full_chart_text += chunk.get('content')
@@ -1274,6 +1446,8 @@ class LLMService:
                     yield 'data:' + orjson.dumps(
                         {'content': chunk.get('content'), 'reasoning_content': chunk.get('reasoning_content'),
                          'type': 'chart-result'}).decode() + '\n\n'
+            # the query succeeded, the chart answer can be saved now
+            self.save_chart_result(_session, chart_answer)
             if in_chat:
                 yield 'data:' + orjson.dumps({'type': 'info', 'msg': 'chart generated'}).decode() + '\n\n'
 
@@ -1290,17 +1464,12 @@ class LLMService:
                     {'content': orjson.dumps(chart).decode(), 'type': 'chart'}).decode() + '\n\n'
             else:
                 if stream:
-                    md_data, _fields_list = DataFormat.convert_data_fields_for_pandas(chart, result.get('fields'),
-                                                                                      result.get('data'))
-                    # data, _fields_list, col_formats = self.format_pd_data(_column_list, result.get('data'))
-
-                    if not md_data or not _fields_list:
+                    if not result.num_rows or not result.fields:
                         yield 'The SQL execution result is empty.\n\n'
                     else:
-                        df = pd.DataFrame(md_data, columns=_fields_list)
-                        df_safe = DataFormat.safe_convert_to_string(df)
-                        markdown_table = df_safe.to_markdown(index=False)
-                        yield markdown_table + '\n\n'
+                        for text in result.iter_markdown(names=DataFormat.get_chart_field_names(chart)):
+                            yield text + '\n'
+                        yield '\n'
 
             if in_chat:
                 yield 'data:' + orjson.dumps({'type': 'finish'}).decode() + '\n\n'
@@ -1314,7 +1483,7 @@ class LLMService:
                                                                                       record_id=self.record.id,
                                                                                       local_operation=True)
                         image_url, error = request_picture(self.record.chat_id, self.record.id, chart,
-                                                           format_json_data(result))
+                                                           format_json_data(result_data))
                         SQLBotLogUtil.info(image_url)
                         if stream:
                             yield f'![{chart.get("type")}]({image_url})'
@@ -1336,6 +1505,8 @@ class LLMService:
             if not stream:
                 yield json_result
 
+        except TaskCancelledError:
+            SQLBotLogUtil.info(f"Chat record {self.record.id} cancelled by client")
         except Exception as e:
             traceback.print_exc()
             error_msg: str
@@ -1362,15 +1533,21 @@ class LLMService:
                     json_result['message'] = error_msg
                     yield json_result
         finally:
-            self.finish(_session)
+            if chart_task:
+                # query failed or client gone, stop the chart generation as well
+                chart_task[0].cancel()
+            if self.channel.cancelled and _session:
+                self.save_cancelled(_session)
+            else:
+                self.finish(_session)
             session_maker.remove()
 
     def run_recommend_questions_task_async(self):
-        self.future = executor.submit(self.run_recommend_questions_task_cache)
+        # 推荐问题使用的是已有记录，排队失败时不写入错误
+        self.submit_task(QUEUE_RECOMMEND, self.run_recommend_questions_task_cache, record_error=False)
 
     def run_recommend_questions_task_cache(self):
-        for chunk in self.run_recommend_questions_task():
-            self.chunk_list.append(chunk)
+        self.produce_chunks(self.run_recommend_questions_task())
 
     def run_recommend_questions_task(self):
         try:
@@ -1394,11 +1571,10 @@ class LLMService:
     def run_analysis_or_predict_task_async(self, session: Session, action_type: str, base_record: ChatRecord,
                                            in_chat: bool = True, stream: bool = True):
         self.set_record(save_analysis_predict_record(session, base_record, action_type))
-        self.future = executor.submit(self.run_analysis_or_predict_task_cache, action_type, in_chat, stream)
+        self.submit_task(QUEUE_ANALYSIS, self.run_analysis_or_predict_task_cache, action_type, in_chat, stream)
 
     def run_analysis_or_predict_task_cache(self, action_type: str, in_chat: bool = True, stream: bool = True):
-        for chunk in self.run_analysis_or_predict_task(action_type, in_chat, stream):
-            self.chunk_list.append(chunk)
+        self.produce_chunks(self.run_analysis_or_predict_task(action_type, in_chat, stream))
 
     def run_analysis_or_predict_task(self, action_type: str, in_chat: bool = True, stream: bool = True):
         json_result: Dict[str, Any] = {'success': True}
@@ -1459,16 +1635,13 @@ class LLMService:
                         predict_data = get_chat_predict_data(_session, self.record.id)
 
                         if stream:
-                            md_data, _fields_list = DataFormat.convert_data_fields_for_pandas(chart,
-                                                                                              origin_data.get('fields'),
-                                                                                              predict_data)
-                            if not md_data or not _fields_list:
+                            _fields = origin_data.get('fields') or []
+                            if not predict_data or not _fields:
                                 yield 'Predict data result is empty.\n\n'
                             else:
-                                df = pd.DataFrame(md_data, columns=_fields_list)
-                                df_safe = DataFormat.safe_convert_to_string(df)
-                                markdown_table = df_safe.to_markdown(index=False)
-                                yield markdown_table + '\n\n'
+                                predict_result = ColumnarResult.from_rows(_fields, predict_data)
+                                yield predict_result.to_markdown(
+                                    names=DataFormat.get_chart_field_names(chart)) + '\n\n'
 
                         else:
                             json_result['origin_data'] = origin_data
@@ -1512,6 +1685,8 @@ class LLMService:
 
             if not stream:
                 yield json_result
+        except TaskCancelledError:
+            SQLBotLogUtil.info(f"Chat record {self.record.id} cancelled by client")
         except Exception as e:
             traceback.print_exc()
             error_msg: str
@@ -1532,6 +1707,8 @@ class LLMService:
                     json_result['message'] = error_msg
                     yield json_result
         finally:
+            if self.channel.cancelled and _session:
+                self.save_cancelled(_session)
             # end
             session_maker.remove()
 
@@ -1652,10 +1829,34 @@ def get_token_usage(chunk: BaseMessageChunk, token_usage: dict = None):
             token_usage['input_tokens'] = chunk.usage_metadata.get('input_tokens')
             token_usage['output_tokens'] = chunk.usage_metadata.get('output_tokens')
             token_usage['total_tokens'] = chunk.usage_metadata.get('total_tokens')
+            # input tokens served from the prompt cache of the model provider
+            input_details = chunk.usage_metadata.get('input_token_details') or {}
+            if input_details.get('cache_read') is not None:
+                token_usage['cached_input_tokens'] = input_details.get('cache_read')
     except Exception:
         pass
 
 
+def with_prompt_cache_hints(messages: List[Union[BaseMessage, dict[str, Any]]], prefixes: List[str]):
+    """
+    Send the stable prefix of a system prompt as its own text block marked with cache_control,
+    for providers that only cache explicitly marked prompt parts. The logged messages stay plain text.
+    """
+    if not settings.LLM_PROMPT_CACHE_HINT or not prefixes:
+        return messages
+    result = []
+    for msg in messages:
+        if isinstance(msg, SystemMessage) and isinstance(msg.content, str):
+            prefix = next((p for p in prefixes if p and msg.content.startswith(p)), None)
+            if prefix:
+                blocks = [{'type': 'text', 'text': prefix, 'cache_control': {'type': 'ephemeral'}}]
+                if len(msg.content) > len(prefix):
+                    blocks.append({'type': 'text', 'text': msg.content[len(prefix):]})
+                msg = SystemMessage(content=blocks)
+        result.append(msg)
+    return result
+
+
 def process_stream(res: Iterator[BaseMessageChunk],
                    token_usage: Dict[str, Any] = None,
                    enable_tag_parsing: bool = settings.PARSE_REASONING_BLOCK_ENABLED,
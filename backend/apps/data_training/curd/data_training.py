@@ -8,7 +8,8 @@ import dicttoxml
 from sqlalchemy import and_, select, func, delete, update, or_
 from sqlalchemy import text
 
-from apps.ai_model.embedding import EmbeddingModelCache
+from apps.ai_model.embedding import EmbeddingService, QueryEmbedding, embed_question
+from apps.ai_model.vector_search import set_hnsw_ef_search
 from apps.data_training.models.data_training_model import DataTrainingInfo, DataTraining, DataTrainingInfoResult
 from apps.datasource.models.datasource import CoreDatasource
 from apps.system.models.system_model import AssistantModel
@@ -426,22 +427,6 @@ def enable_training(session: SessionDep, id: int, enabled: bool, trans: Trans):
 #     executor.submit(run_fill_empty_embeddings)
 
 
-def run_fill_empty_embeddings(session_maker):
-    try:
-        if not settings.EMBEDDING_ENABLED:
-            return
-
-        session = session_maker()
-        stmt = select(DataTraining.id).where(and_(DataTraining.embedding.is_(None)))
-        results = session.execute(stmt).scalars().all()
-
-        save_embeddings(session_maker, results)
-    except Exception:
-        traceback.print_exc()
-    finally:
-        session_maker.remove()
-
-
 def save_embeddings(session_maker, ids: List[int]):
     if not settings.EMBEDDING_ENABLED:
         return
@@ -454,9 +439,7 @@ def save_embeddings(session_maker, ids: List[int]):
 
         _question_list = [item.question for item in _list]
 
-        model = EmbeddingModelCache.get_model()
-
-        results = model.embed_documents(_question_list)
+        results = EmbeddingService.embed_documents(_question_list)
 
         for index in range(len(results)):
             item = results[index]
@@ -470,32 +453,39 @@ def save_embeddings(session_maker, ids: List[int]):
         session_maker.remove()
 
 
+# filters first, then ORDER BY distance LIMIT so the HNSW index on embedding can be used,
+# the similarity threshold only drops rows from the top k
 embedding_sql = f"""
 SELECT id, datasource, question, similarity
 FROM
-(SELECT id, datasource, question, oid, enabled,
-( 1 - (embedding <=> :embedding_array) ) AS similarity
+(SELECT id, datasource, question,
+( 1 - (embedding <=> CAST(:embedding_array AS vector)) ) AS similarity
 FROM data_training AS child
+WHERE oid = :oid and datasource = :datasource and enabled = true AND embedding IS NOT NULL
+ORDER BY embedding <=> CAST(:embedding_array AS vector)
+LIMIT {settings.EMBEDDING_DATA_TRAINING_TOP_COUNT}
 ) TEMP
-WHERE similarity > {settings.EMBEDDING_DATA_TRAINING_SIMILARITY} and oid = :oid and datasource = :datasource and enabled = true
+WHERE similarity > {settings.EMBEDDING_DATA_TRAINING_SIMILARITY}
 ORDER BY similarity DESC
-LIMIT {settings.EMBEDDING_DATA_TRAINING_TOP_COUNT}
 """
 embedding_sql_in_advanced_application = f"""
 SELECT id, advanced_application, question, similarity
 FROM
-(SELECT id, advanced_application, question, oid, enabled,
-( 1 - (embedding <=> :embedding_array) ) AS similarity
+(SELECT id, advanced_application, question,
+( 1 - (embedding <=> CAST(:embedding_array AS vector)) ) AS similarity
 FROM data_training AS child
+WHERE oid = :oid and advanced_application = :advanced_application and enabled = true AND embedding IS NOT NULL
+ORDER BY embedding <=> CAST(:embedding_array AS vector)
+LIMIT {settings.EMBEDDING_DATA_TRAINING_TOP_COUNT}
 ) TEMP
-WHERE similarity > {settings.EMBEDDING_DATA_TRAINING_SIMILARITY} and oid = :oid and advanced_application = :advanced_application and enabled = true
+WHERE similarity > {settings.EMBEDDING_DATA_TRAINING_SIMILARITY}
 ORDER BY similarity DESC
-LIMIT {settings.EMBEDDING_DATA_TRAINING_TOP_COUNT}
 """
 
 
 def select_training_by_question(session: SessionDep, question: str, oid: int, datasource: Optional[int] = None,
-                                advanced_application_id: Optional[int] = None):
+                                advanced_application_id: Optional[int] = None,
+                                question_embedding: Optional[QueryEmbedding] = None):
     if question.strip() == "":
         return []
 
@@ -526,9 +516,8 @@ def select_training_by_question(session: SessionDep, question: str, oid: int, da
     if settings.EMBEDDING_ENABLED:
         with session.begin_nested():
             try:
-                model = EmbeddingModelCache.get_model()
-
-                embedding = model.embed_query(question)
+                embedding = embed_question(question, question_embedding)
+                set_hnsw_ef_search(session)
 
                 if advanced_application_id is not None:
                     results = session.execute(text(embedding_sql_in_advanced_application),
@@ -600,12 +589,14 @@ def to_xml_string(_dict: list[dict] | dict, root: str = 'sql-examples') -> str:
 
 
 def get_training_template(session: SessionDep, question: str, oid: Optional[int] = 1, datasource: Optional[int] = None,
-                          advanced_application_id: Optional[int] = None) -> tuple[str, list[dict]]:
+                          advanced_application_id: Optional[int] = None,
+                          question_embedding: Optional[QueryEmbedding] = None) -> tuple[str, list[dict]]:
     if not oid:
         oid = 1
     if not datasource and not advanced_application_id:
         return '', []
-    _results = select_training_by_question(session, question, oid, datasource, advanced_application_id)
+    _results = select_training_by_question(session, question, oid, datasource, advanced_application_id,
+                                           question_embedding)
     if _results and len(_results) > 0:
         data_training = to_xml_string(_results)
         template = get_base_data_training_template().format(data_training=data_training)
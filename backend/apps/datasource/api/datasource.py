@@ -26,6 +26,8 @@ from ..crud.datasource import get_datasource_list, check_status, create_ds, upda
     check_status_by_id, sync_single_fields
 from ..crud.field import get_fields_by_table_id
 from ..crud.table import get_tables_by_ds_id
+from ..utils.schema_cache import DsSchemaCache
+from ..utils.schema_render import SchemaFragmentCache
 from ..models.datasource import CoreDatasource, CreateDatasource, TableObj, CoreTable, CoreField, FieldObj, \
     TableSchemaResponse, ColumnSchemaResponse, PreviewResponse
 from common.audit.models.log_model import OperationType, OperationModules
@@ -532,6 +534,8 @@ async def upload_ds_schema(session: SessionDep, id: int = Path(..., description=
                                      CoreField.field_name == field[f_n_col])).update(
                                 {'custom_comment': field[f_c_col]})
         session.commit()
+        SchemaFragmentCache.invalidate_ds(id)
+        DsSchemaCache.invalidate(id)
 
         return True
     except Exception as e:
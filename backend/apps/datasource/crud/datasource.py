@@ -3,15 +3,23 @@ import json
 from typing import List, Optional
 
 from fastapi import HTTPException
-from sqlalchemy import and_, text
+from sqlalchemy import and_, text, update
+from sqlalchemy.orm import defer
 from sqlbot_xpack.permissions.models.ds_rules import DsRules
 from sqlmodel import select
 
-from apps.datasource.crud.permission import get_column_permission_fields, get_row_permission_filters, is_normal_user
+from apps.ai_model.embedding import QueryEmbedding
+from apps.datasource.crud.permission import get_column_permission_fields, get_column_hidden_field_ids, \
+    get_row_permission_filters, is_normal_user
 from apps.datasource.embedding.table_embedding import calc_table_embedding
+from apps.datasource.utils.schema_cache import DsSchemaCache
+from apps.datasource.utils.schema_render import render_table_schema, SchemaFragmentCache
 from apps.datasource.utils.utils import aes_decrypt
+from apps.db.conf_cache import DsConfCache
 from apps.db.constant import DB
-from apps.db.db import get_tables, get_fields, exec_sql, check_connection
+from apps.db.db import get_tables, get_fields, get_fields_by_tables, exec_sql, exec_sql_column, check_connection
+from apps.db.driver_pool import DsDriverPool
+from apps.db.engine_cache import DsEngineCache
 from apps.db.engine import get_engine_config, get_engine_conn
 from apps.system.schemas.auth import CacheName, CacheNamespace
 from common.core.config import settings
@@ -103,12 +111,19 @@ def update_ds(session: SessionDep, trans: Trans, user: CurrentUser, ds: CoreData
     # status = check_status(session, trans, ds)
     ds.status = "Success"
     record = session.exec(select(CoreDatasource).where(CoreDatasource.id == ds.id)).first()
+    origin_configuration = record.configuration
     update_data = ds.model_dump(exclude_unset=True)
     for field, value in update_data.items():
         setattr(record, field, value)
     session.add(record)
     session.commit()
 
+    if record.configuration != origin_configuration:
+        DsEngineCache.invalidate(ds.id)
+        DsDriverPool.invalidate(ds.id)
+        # the schema name of the tables comes from the configuration
+        DsSchemaCache.invalidate(ds.id)
+
     run_save_ds_embeddings([ds.id])
     return ds
 
@@ -133,6 +148,10 @@ async def delete_ds(session: SessionDep, id: int):
 
     session.delete(term)
     session.commit()
+    DsEngineCache.invalidate(id)
+    DsDriverPool.invalidate(id)
+    SchemaFragmentCache.invalidate_ds(id)
+    DsSchemaCache.invalidate(id)
     delete_table_by_ds_id(session, id)
     delete_field_by_ds_id(session, id)
     if term:
@@ -184,93 +203,121 @@ def sync_single_fields(session: SessionDep, trans: Trans, id: int):
 
     # sync field
     fields = getFieldsByDs(session, ds, table.table_name)
-    sync_fields(session, ds, table, fields)
-
-    # do table embedding
-    run_save_table_embeddings([table.id])
-    run_save_ds_embeddings([ds.id])
+    if sync_fields(session, ds, table, fields):
+        # do table embedding
+        run_save_table_embeddings([table.id])
+        run_save_ds_embeddings([ds.id])
 
 
 def sync_table(session: SessionDep, ds: CoreDatasource, tables: List[CoreTable]):
-    id_list = []
+    """
+    Diff the selected tables and their columns against the saved ones and write the changes in one transaction.
+    The columns of all tables come from one metadata query, only tables whose columns changed are re-embedded.
+    """
+    # read before anything is written, a failing datasource leaves the saved schema untouched
+    columns = get_fields_by_tables(ds, list(dict.fromkeys(item.table_name for item in tables)))
+
+    records = {t.table_name: t for t in
+               session.query(CoreTable).options(defer(CoreTable.embedding)).filter(CoreTable.ds_id == ds.id).all()}
+    selected: dict[str, CoreTable] = {}
+    new_tables = []
+    table_updates = []
     for item in tables:
-        statement = select(CoreTable).where(and_(CoreTable.ds_id == ds.id, CoreTable.table_name == item.table_name))
-        record = session.exec(statement).first()
-        # update exist table, only update table_comment
-        if record is not None:
-            item.id = record.id
-            id_list.append(record.id)
-
-            record.table_comment = item.table_comment
-            session.add(record)
-            session.commit()
-        else:
+        if item.table_name in selected:
+            continue
+        record = records.get(item.table_name)
+        if record is None:
             # save new table
-            table = CoreTable(ds_id=ds.id, checked=True, table_name=item.table_name, table_comment=item.table_comment,
-                              custom_comment=item.table_comment)
-            session.add(table)
-            session.flush()
-            session.refresh(table)
-            item.id = table.id
-            id_list.append(table.id)
-            session.commit()
-
-        # sync field
-        fields = getFieldsByDs(session, ds, item.table_name)
-        sync_fields(session, ds, item, fields)
-
-    if len(id_list) > 0:
-        session.query(CoreTable).filter(and_(CoreTable.ds_id == ds.id, CoreTable.id.not_in(id_list))).delete(
-            synchronize_session=False)
-        session.query(CoreField).filter(and_(CoreField.ds_id == ds.id, CoreField.table_id.not_in(id_list))).delete(
-            synchronize_session=False)
-        session.commit()
-    else:  # delete all tables and fields in this ds
-        session.query(CoreTable).filter(CoreTable.ds_id == ds.id).delete(synchronize_session=False)
-        session.query(CoreField).filter(CoreField.ds_id == ds.id).delete(synchronize_session=False)
-        session.commit()
+            record = CoreTable(ds_id=ds.id, checked=True, table_name=item.table_name,
+                               table_comment=item.table_comment, custom_comment=item.table_comment)
+            new_tables.append(record)
+        elif record.table_comment != item.table_comment:
+            # update exist table, only update table_comment
+            table_updates.append({'id': record.id, 'table_comment': item.table_comment})
+        selected[item.table_name] = record
+
+    session.add_all(new_tables)
+    session.flush()
+    if table_updates:
+        session.execute(update(CoreTable), table_updates)
+    for item in tables:
+        item.id = selected[item.table_name].id
+
+    # delete the tables and fields no longer selected
+    id_list = [record.id for record in selected.values()]
+    removed = session.query(CoreTable).filter(and_(CoreTable.ds_id == ds.id, CoreTable.id.not_in(id_list))).delete(
+        synchronize_session=False)
+    session.query(CoreField).filter(and_(CoreField.ds_id == ds.id, CoreField.table_id.not_in(id_list))).delete(
+        synchronize_session=False)
+
+    saved_fields: dict[int, List[CoreField]] = {}
+    for field in session.query(CoreField).filter(CoreField.table_id.in_(id_list)).all():
+        saved_fields.setdefault(field.table_id, []).append(field)
+    new_ids = {table.id for table in new_tables}
+    changed = [table_id for table_id in id_list if table_id in new_ids]
+    for table_name, record in selected.items():
+        if diff_fields(session, ds, record, columns.get(table_name, []), saved_fields.get(record.id, [])) \
+                and record.id not in new_ids:
+            changed.append(record.id)
+    session.commit()
+    SchemaFragmentCache.invalidate_ds(ds.id)
+    DsSchemaCache.invalidate(ds.id)
 
     # do table embedding
-    run_save_table_embeddings(id_list)
-    run_save_ds_embeddings([ds.id])
+    if changed:
+        run_save_table_embeddings(changed)
+    if changed or removed:
+        run_save_ds_embeddings([ds.id])
 
 
-def sync_fields(session: SessionDep, ds: CoreDatasource, table: CoreTable, fields: List[ColumnSchema]):
-    id_list = []
+def sync_fields(session: SessionDep, ds: CoreDatasource, table: CoreTable, fields: List[ColumnSchema]) -> bool:
+    """Sync the columns of one table, returns whether the embedded part (names and types) changed"""
+    saved_fields = session.query(CoreField).filter(CoreField.table_id == table.id).all()
+    changed = diff_fields(session, ds, table, fields, saved_fields)
+    session.commit()
+    SchemaFragmentCache.invalidate([table.id])
+    DsSchemaCache.invalidate(ds.id)
+    return changed
+
+
+def diff_fields(session: SessionDep, ds: CoreDatasource, table: CoreTable, fields: List[ColumnSchema],
+                saved_fields: List[CoreField]) -> bool:
+    """Batched inserts, updates and deletes of the fields of a table, not committed"""
+    by_name = {field.field_name: field for field in saved_fields}
+    new_fields = []
+    field_updates = []
+    changed = False
     for index, item in enumerate(fields):
-        statement = select(CoreField).where(
-            and_(CoreField.table_id == table.id, CoreField.field_name == item.fieldName))
-        record = session.exec(statement).first()
-        if record is not None:
-            item.id = record.id
-            id_list.append(record.id)
-
-            record.field_comment = item.fieldComment
-            record.field_index = index
-            record.field_type = item.fieldType
-            session.add(record)
-            session.commit()
-        else:
-            field = CoreField(ds_id=ds.id, table_id=table.id, checked=True, field_name=item.fieldName,
-                              field_type=item.fieldType, field_comment=item.fieldComment,
-                              custom_comment=item.fieldComment, field_index=index)
-            session.add(field)
-            session.flush()
-            session.refresh(field)
-            item.id = field.id
-            id_list.append(field.id)
-            session.commit()
-
-    if len(id_list) > 0:
-        session.query(CoreField).filter(and_(CoreField.table_id == table.id, CoreField.id.not_in(id_list))).delete(
+        record = by_name.pop(item.fieldName, None)
+        if record is None:
+            new_fields.append(CoreField(ds_id=ds.id, table_id=table.id, checked=True, field_name=item.fieldName,
+                                        field_type=item.fieldType, field_comment=item.fieldComment,
+                                        custom_comment=item.fieldComment, field_index=index))
+            changed = True
+            continue
+        if record.field_type != item.fieldType:
+            changed = True
+        if (record.field_comment, record.field_index, record.field_type) != (item.fieldComment, index, item.fieldType):
+            field_updates.append({'id': record.id, 'field_comment': item.fieldComment, 'field_index': index,
+                                  'field_type': item.fieldType})
+
+    if new_fields:
+        session.add_all(new_fields)
+    if field_updates:
+        session.execute(update(CoreField), field_updates)
+    if by_name:
+        session.query(CoreField).filter(CoreField.id.in_([field.id for field in by_name.values()])).delete(
             synchronize_session=False)
-        session.commit()
+        changed = True
+    return changed
 
 
 def update_table_and_fields(session: SessionDep, data: TableObj):
     update_table(session, data.table)
     for field in data.fields:
         update_field(session, field)
+    SchemaFragmentCache.invalidate([data.table.id])
+    DsSchemaCache.invalidate(data.table.ds_id)
 
     # do table embedding
     run_save_table_embeddings([data.table.id])
@@ -279,6 +326,8 @@ def update_table_and_fields(session: SessionDep, data: TableObj):
 
 def updateTable(session: SessionDep, table: CoreTable):
     update_table(session, table)
+    SchemaFragmentCache.invalidate([table.id])
+    DsSchemaCache.invalidate(table.ds_id)
 
     # do table embedding
     run_save_table_embeddings([table.id])
@@ -287,6 +336,8 @@ def updateTable(session: SessionDep, table: CoreTable):
 
 def updateField(session: SessionDep, field: CoreField):
     update_field(session, field)
+    SchemaFragmentCache.invalidate([field.table_id])
+    DsSchemaCache.invalidate(field.ds_id)
 
     # do table embedding
     run_save_table_embeddings([field.table_id])
@@ -381,8 +432,7 @@ def fieldEnum(session: SessionDep, id: int):
 
     db = DB.get_db(ds.type)
     sql = f"""SELECT DISTINCT {db.prefix}{field.field_name}{db.suffix} FROM {db.prefix}{table.table_name}{db.suffix}"""
-    res = exec_sql(ds, sql, True)
-    return [item.get(res.get('fields')[0]) for item in res.get('data')]
+    return exec_sql_column(ds, sql, True)
 
 
 def updateNum(session: SessionDep, ds: CoreDatasource):
@@ -400,15 +450,23 @@ def updateNum(session: SessionDep, ds: CoreDatasource):
 
 
 def get_table_obj_by_ds(session: SessionDep, current_user: CurrentUser, ds: CoreDatasource) -> List[TableAndFields]:
-    _list: List = []
-    tables = session.query(CoreTable).filter(CoreTable.ds_id == ds.id).all()
-    conf = DatasourceConf(**json.loads(aes_decrypt(ds.configuration))) if ds.type != "excel" else get_engine_config()
+    return DsSchemaCache.get_table_objs(
+        ds.id, current_user.id, lambda: load_ds_tables_and_fields(session, ds),
+        lambda tables: get_column_hidden_field_ids(session, current_user, [table.id for table in tables]))
+
+
+def load_ds_tables_and_fields(session: SessionDep, ds: CoreDatasource):
+    """Schema name, tables and checked fields with their dimensions, as copies detached from the session"""
+    # the vectors are ranked in the database, not needed here
+    tables = [CoreTable(**table.model_dump()) for table in
+              session.query(CoreTable).options(defer(CoreTable.embedding)).filter(CoreTable.ds_id == ds.id).all()]
+    conf = DsConfCache.get_conf(ds)
     schema = conf.dbSchema if conf.dbSchema is not None and conf.dbSchema != "" else conf.database
 
     # get all field
     table_ids = [table.id for table in tables]
-    all_fields = session.query(CoreField).filter(
-        and_(CoreField.table_id.in_(table_ids), CoreField.checked == True)).all()
+    all_fields = [CoreField(**field.model_dump()) for field in session.query(CoreField).filter(
+        and_(CoreField.table_id.in_(table_ids), CoreField.checked == True)).all()]
 
     # 获取所有维度值，按ID组织
     dimension_ids = [f.dimension_id for f in all_fields if f.dimension_id is not None]
@@ -416,7 +474,7 @@ def get_table_obj_by_ds(session: SessionDep, current_user: CurrentUser, ds: Core
     if dimension_ids:
         dimension_records = session.query(DimensionValue).filter(DimensionValue.id.in_(dimension_ids)).all()
         for dim in dimension_records:
-            dimensions[dim.id] = dim
+            dimensions[dim.id] = DimensionValue(**dim.model_dump())
 
     # 为每个字段附加维度值信息
     for field in all_fields:
@@ -429,21 +487,12 @@ def get_table_obj_by_ds(session: SessionDep, current_user: CurrentUser, ds: Core
             fields_dict.get(field.table_id).append(field)
         else:
             fields_dict[field.table_id] = [field]
-
-    contain_rules = session.query(DsRules).all()
-    for table in tables:
-        # fields = session.query(CoreField).filter(and_(CoreField.table_id == table.id, CoreField.checked == True)).all()
-        fields = fields_dict.get(table.id)
-
-        # do column permissions, filter fields
-        fields = get_column_permission_fields(session=session, current_user=current_user, table=table, fields=fields,
-                                              contain_rules=contain_rules)
-        _list.append(TableAndFields(schema=schema, table=table, fields=fields))
-    return _list
+    return schema, tables, fields_dict
 
 
 def get_table_schema(session: SessionDep, current_user: CurrentUser, ds: CoreDatasource, question: str,
-                     embedding: bool = True, table_list: list[str] = None) -> str:
+                     embedding: bool = True, table_list: list[str] = None,
+                     question_embedding: Optional[QueryEmbedding] = None) -> str:
     schema_str = ""
     table_objs = get_table_obj_by_ds(session=session, current_user=current_user, ds=ds)
     if len(table_objs) == 0:
@@ -457,39 +506,7 @@ def get_table_schema(session: SessionDep, current_user: CurrentUser, ds: CoreDat
         if table_list is not None and obj.table.table_name not in table_list:
             continue
 
-        schema_table = ''
-        schema_table += f"# Table: {db_name}.{obj.table.table_name}" if ds.type != "mysql" and ds.type != "es" else f"# Table: {obj.table.table_name}"
-        table_comment = ''
-        if obj.table.custom_comment:
-            table_comment = obj.table.custom_comment.strip()
-        if table_comment == '':
-            schema_table += '\n[\n'
-        else:
-            schema_table += f", {table_comment}\n[\n"
-
-        if obj.fields:
-            field_list = []
-            for field in obj.fields:
-                field_comment = ''
-                if field.custom_comment:
-                    field_comment = field.custom_comment.strip()
-
-                # 构建字段定义
-                field_def = f"({field.field_name}:{field.field_type}"
-                if field_comment != '':
-                    field_def += f", {field_comment}"
-
-                # 如果字段有关联的维度值，添加 examples 字段
-                if hasattr(field, 'dimension') and field.dimension and field.dimension.values:
-                    examples_str = json.dumps(field.dimension.values[:10], ensure_ascii=False)  # 最多显示10个值
-                    field_def += f", examples:{examples_str}"
-
-                field_def += ")"
-                field_list.append(field_def)
-            schema_table += ",\n".join(field_list)
-        schema_table += '\n]\n'
-
-        t_obj = {"id": obj.table.id, "schema_table": schema_table, "embedding": obj.table.embedding}
+        t_obj = {"id": obj.table.id, "table": obj.table, "fields": obj.fields, "cosine_similarity": 0.0}
         tables.append(t_obj)
         all_tables.append(t_obj)
 
@@ -499,13 +516,14 @@ def get_table_schema(session: SessionDep, current_user: CurrentUser, ds: CoreDat
 
     # do table embedding
     if embedding and tables and settings.TABLE_EMBEDDING_ENABLED:
-        tables = calc_table_embedding(tables, question)
-    # splice schema
-    if tables:
-        for s in tables:
-            schema_str += s.get('schema_table')
+        table_dict = {t.get('id'): t for t in tables}
+        ranked = calc_table_embedding(session, [{"id": t.get('id'), "schema_table": t.get('table').table_name}
+                                                for t in tables], question, question_embedding)
+        tables = [{**table_dict[t.get('id')], "cosine_similarity": t.get('cosine_similarity')} for t in ranked]
 
     # field relation
+    all_relations = []
+    lost_tables = []
     if tables and ds.table_relation:
         relations = list(filter(lambda x: x.get('shape') == 'edge', ds.table_relation))
         if relations:
@@ -522,35 +540,42 @@ def get_table_schema(session: SessionDep, current_user: CurrentUser, ds: CoreDat
                 relation_table_ids.append(r.get('source').get('cell'))
                 relation_table_ids.append(r.get('target').get('cell'))
             relation_table_ids = list(set(relation_table_ids))
-            # get table dict
-            table_records = session.query(CoreTable).filter(CoreTable.id.in_(list(map(int, relation_table_ids)))).all()
-            table_dict = {}
-            for ele in table_records:
-                table_dict[ele.id] = ele.table_name
 
             # get lost table ids
             lost_table_ids = list(set(relation_table_ids) - set(embedding_table_ids))
-            # get lost table schema and splice it
             lost_tables = list(filter(lambda x: x.get('id') in lost_table_ids, all_tables))
-            if lost_tables:
-                for s in lost_tables:
-                    schema_str += s.get('schema_table')
-
-            # get field dict
-            relation_field_ids = []
-            for relation in all_relations:
-                relation_field_ids.append(relation.get('source').get('port'))
-                relation_field_ids.append(relation.get('target').get('port'))
-            relation_field_ids = list(set(relation_field_ids))
-            field_records = session.query(CoreField).filter(CoreField.id.in_(list(map(int, relation_field_ids)))).all()
-            field_dict = {}
-            for ele in field_records:
-                field_dict[ele.id] = ele.field_name
-
-            if all_relations:
-                schema_str += '【Foreign keys】\n'
-                for ele in all_relations:
-                    schema_str += f"{table_dict.get(int(ele.get('source').get('cell')))}.{field_dict.get(int(ele.get('source').get('port')))}={table_dict.get(int(ele.get('target').get('cell')))}.{field_dict.get(int(ele.get('target').get('port')))}\n"
+
+    # splice schema, relation columns are kept first when the schema is over the token budget
+    relation_field_ids = list(set([int(r.get('source').get('port')) for r in all_relations] + [
+        int(r.get('target').get('port')) for r in all_relations]))
+    tables_schema, elided = render_table_schema(tables + lost_tables, db_name, ds.type,
+                                                key_field_ids=set(relation_field_ids), question=question,
+                                                budget=settings.TABLE_SCHEMA_TOKEN_BUDGET,
+                                                terse=settings.TABLE_SCHEMA_TERSE)
+    schema_str += tables_schema
+    if elided:
+        SQLBotLogUtil.info(f"schema of datasource {ds.id} is over the token budget, {elided} columns elided")
+
+    if all_relations:
+        relation_table_ids = list(set([int(r.get('source').get('cell')) for r in all_relations] + [
+            int(r.get('target').get('cell')) for r in all_relations]))
+        # get table dict
+        table_records = session.query(CoreTable.id, CoreTable.table_name).filter(
+            CoreTable.id.in_(relation_table_ids)).all()
+        table_dict = {}
+        for ele in table_records:
+            table_dict[ele.id] = ele.table_name
+
+        # get field dict
+        field_records = session.query(CoreField.id, CoreField.field_name).filter(
+            CoreField.id.in_(relation_field_ids)).all()
+        field_dict = {}
+        for ele in field_records:
+            field_dict[ele.id] = ele.field_name
+
+        schema_str += '【Foreign keys】\n'
+        for ele in all_relations:
+            schema_str += f"{table_dict.get(int(ele.get('source').get('cell')))}.{field_dict.get(int(ele.get('source').get('port')))}={table_dict.get(int(ele.get('target').get('cell')))}.{field_dict.get(int(ele.get('target').get('port')))}\n"
 
     return schema_str
 
@@ -48,39 +48,39 @@ def get_row_permission_filters(session: SessionDep, current_user: CurrentUser, d
 
 def get_column_permission_fields(session: SessionDep, current_user: CurrentUser, table: CoreTable,
                                  fields: list[CoreField], contain_rules: list[DsRules]):
-    if is_normal_user(current_user):
-        column_permissions = session.query(DsPermission).filter(
-            and_(DsPermission.table_id == table.id, DsPermission.type == 'column')).all()
-        if column_permissions is not None:
-            for permission in column_permissions:
-                # check permission and user in same rules
-                # obj = session.query(DsRules).filter(
-                #     and_(DsRules.permission_list.op('@>')(cast([permission.id], JSONB)),
-                #          or_(DsRules.user_list.op('@>')(cast([f'{current_user.id}'], JSONB)),
-                #              DsRules.user_list.op('@>')(cast([current_user.id], JSONB))))
-                # ).first()
-                flag = False
-                for r in contain_rules:
-                    p_list = json.loads(r.permission_list)
-                    u_list = json.loads(r.user_list)
-                    if p_list is not None and u_list is not None and permission.id in p_list and (
-                            current_user.id in u_list or f'{current_user.id}' in u_list):
-                        flag = True
-                        break
-                if flag:
-                    permission_list = json.loads(permission.permissions)
-                    fields = filter_list(fields, permission_list)
-    return fields
+    hidden = get_column_hidden_field_ids(session, current_user, [table.id], contain_rules)
+    return [f for f in fields if f.id not in hidden] if hidden else fields
 
 
-def is_normal_user(current_user: CurrentUser):
-    return current_user.id != 1
+def get_column_hidden_field_ids(session: SessionDep, current_user: CurrentUser, table_ids: list[int],
+                                contain_rules: Optional[list[DsRules]] = None) -> set[int]:
+    """Ids of the fields hidden from the user by column permissions, for all tables in one query"""
+    hidden = set()
+    if not is_normal_user(current_user) or not table_ids:
+        return hidden
+    column_permissions = session.query(DsPermission).filter(
+        and_(DsPermission.table_id.in_(table_ids), DsPermission.type == 'column')).all()
+    if not column_permissions:
+        return hidden
+    if contain_rules is None:
+        contain_rules = session.query(DsRules).all()
+    for permission in column_permissions:
+        # check permission and user in same rules
+        flag = False
+        for r in contain_rules:
+            p_list = json.loads(r.permission_list)
+            u_list = json.loads(r.user_list)
+            if p_list is not None and u_list is not None and permission.id in p_list and (
+                    current_user.id in u_list or f'{current_user.id}' in u_list):
+                flag = True
+                break
+        if flag:
+            for b in json.loads(permission.permissions):
+                if not b['enable']:
+                    hidden.add(b['field_id'])
+    return hidden
 
 
-def filter_list(list_a, list_b):
-    id_to_invalid = {}
-    for b in list_b:
-        if not b['enable']:
-            id_to_invalid[b['field_id']] = True
+def is_normal_user(current_user: CurrentUser):
+    return current_user.id != 1
 
-    return [a for a in list_a if not id_to_invalid.get(a.id, False)]
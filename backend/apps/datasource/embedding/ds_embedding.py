@@ -5,8 +5,11 @@ import time
 import traceback
 from typing import Optional
 
-from apps.ai_model.embedding import EmbeddingModelCache
-from apps.datasource.embedding.utils import cosine_similarity
+import numpy as np
+
+from apps.ai_model.embedding import EmbeddingService, QueryEmbedding, embed_question
+from apps.ai_model.vector_search import rank_ids_by_embedding
+from apps.datasource.embedding.utils import cosine_similarity_matrix, take_top_k, take_ranked
 from apps.datasource.models.datasource import CoreDatasource
 from apps.system.crud.assistant import AssistantOutDs
 from common.core.config import settings
@@ -17,7 +20,8 @@ from common.utils.utils import SQLBotLogUtil
 
 def get_ds_embedding(session: SessionDep, current_user: CurrentUser, _ds_list, out_ds: AssistantOutDs,
                      question: str,
-                     current_assistant: Optional[CurrentAssistant] = None):
+                     current_assistant: Optional[CurrentAssistant] = None,
+                     question_embedding: Optional[QueryEmbedding] = None):
     _list = []
     if current_assistant and current_assistant.type == 1:
         if out_ds.ds_list:
@@ -32,17 +36,11 @@ def get_ds_embedding(session: SessionDep, current_user: CurrentUser, _ds_list, o
             try:
                 text = [s.get('ds_schema') for s in _list]
 
-                model = EmbeddingModelCache.get_model()
-                results = model.embed_documents(text)
-
-                q_embedding = model.embed_query(question)
-                for index in range(len(results)):
-                    item = results[index]
-                    _list[index]['cosine_similarity'] = cosine_similarity(q_embedding, item)
+                results = EmbeddingService.embed_documents(text)
 
-                _list.sort(key=lambda x: x['cosine_similarity'], reverse=True)
-                # print(len(_list))
-                _list = _list[:settings.DS_EMBEDDING_COUNT]
+                q_embedding = embed_question(question, question_embedding)
+                scores = cosine_similarity_matrix(q_embedding, np.asarray(results, dtype=np.float32))
+                _list = take_top_k(_list, scores, settings.DS_EMBEDDING_COUNT)
                 SQLBotLogUtil.info(json.dumps(
                     [{"id": ele.get("id"), "name": ele.get("ds").name,
                       "cosine_similarity": ele.get("cosine_similarity")}
@@ -58,28 +56,19 @@ def get_ds_embedding(session: SessionDep, current_user: CurrentUser, _ds_list, o
                 # table_schema = get_table_schema(session, current_user, ds, question, embedding=False)
                 # ds_info = f"{ds.name}, {ds.description}\n"
                 # ds_schema = ds_info + table_schema
-                _list.append({"id": ds.id, "cosine_similarity": 0.0, "ds": ds, "embedding": ds.embedding})
+                _list.append({"id": ds.id, "cosine_similarity": 0.0, "ds": ds})
 
         if _list:
             try:
-                # text = [s.get('ds_schema') for s in _list]
-
-                model = EmbeddingModelCache.get_model()
                 start_time = time.time()
-                # results = model.embed_documents(text)
-                results = [item.get('embedding') for item in _list]
-
-                q_embedding = model.embed_query(question)
-                for index in range(len(results)):
-                    item = results[index]
-                    if item:
-                        _list[index]['cosine_similarity'] = cosine_similarity(q_embedding, json.loads(item))
 
-                _list.sort(key=lambda x: x['cosine_similarity'], reverse=True)
-                # print(len(_list))
+                q_embedding = embed_question(question, question_embedding)
+                with session.begin_nested():
+                    ranked = rank_ids_by_embedding(session, 'core_datasource', [item.get('id') for item in _list],
+                                                   q_embedding, settings.DS_EMBEDDING_COUNT)
+                _list = take_ranked(_list, ranked, settings.DS_EMBEDDING_COUNT)
                 end_time = time.time()
                 SQLBotLogUtil.info(str(end_time - start_time))
-                _list = _list[:settings.DS_EMBEDDING_COUNT]
                 SQLBotLogUtil.info(json.dumps(
                     [{"id": ele.get("id"), "name": ele.get("ds").name,
                       "cosine_similarity": ele.get("cosine_similarity")}
@@ -3,10 +3,15 @@
 import json
 import time
 import traceback
+from typing import Optional
 
-from apps.ai_model.embedding import EmbeddingModelCache
-from apps.datasource.embedding.utils import cosine_similarity
+import numpy as np
+
+from apps.ai_model.embedding import EmbeddingService, QueryEmbedding, embed_question
+from apps.ai_model.vector_search import rank_ids_by_embedding
+from apps.datasource.embedding.utils import cosine_similarity_matrix, take_top_k, take_ranked
 from common.core.config import settings
+from common.core.deps import SessionDep
 from common.utils.utils import SQLBotLogUtil
 
 
@@ -19,19 +24,14 @@ def get_table_embedding(tables: list[dict], question: str):
         try:
             text = [s.get('schema_table') for s in _list]
 
-            model = EmbeddingModelCache.get_model()
             start_time = time.time()
-            results = model.embed_documents(text)
+            results = EmbeddingService.embed_documents(text)
             end_time = time.time()
             SQLBotLogUtil.info(str(end_time - start_time))
 
-            q_embedding = model.embed_query(question)
-            for index in range(len(results)):
-                item = results[index]
-                _list[index]['cosine_similarity'] = cosine_similarity(q_embedding, item)
-
-            _list.sort(key=lambda x: x['cosine_similarity'], reverse=True)
-            _list = _list[:settings.TABLE_EMBEDDING_COUNT]
+            q_embedding = embed_question(question)
+            scores = cosine_similarity_matrix(q_embedding, np.asarray(results, dtype=np.float32))
+            _list = take_top_k(_list, scores, settings.TABLE_EMBEDDING_COUNT)
             # print(len(_list))
             SQLBotLogUtil.info(json.dumps(_list))
             return _list
@@ -40,32 +40,22 @@ def get_table_embedding(tables: list[dict], question: str):
     return _list
 
 
-def calc_table_embedding(tables: list[dict], question: str):
+def calc_table_embedding(session: SessionDep, tables: list[dict], question: str,
+                         question_embedding: Optional[QueryEmbedding] = None):
     _list = []
     for table in tables:
-        _list.append(
-            {"id": table.get('id'), "schema_table": table.get('schema_table'), "embedding": table.get('embedding'),
-             "cosine_similarity": 0.0})
+        _list.append({"id": table.get('id'), "schema_table": table.get('schema_table'), "cosine_similarity": 0.0})
 
     if _list:
         try:
-            # text = [s.get('schema_table') for s in _list]
-            #
-            model = EmbeddingModelCache.get_model()
             start_time = time.time()
-            # results = model.embed_documents(text)
-            # end_time = time.time()
-            # SQLBotLogUtil.info(str(end_time - start_time))
-            results = [item.get('embedding') for item in _list]
-
-            q_embedding = model.embed_query(question)
-            for index in range(len(results)):
-                item = results[index]
-                if item:
-                    _list[index]['cosine_similarity'] = cosine_similarity(q_embedding, json.loads(item))
 
-            _list.sort(key=lambda x: x['cosine_similarity'], reverse=True)
-            _list = _list[:settings.TABLE_EMBEDDING_COUNT]
+            q_embedding = embed_question(question, question_embedding)
+            # ranked by pgvector, only the ids and similarities of the top tables come back
+            with session.begin_nested():
+                ranked = rank_ids_by_embedding(session, 'core_table', [t.get('id') for t in _list], q_embedding,
+                                               settings.TABLE_EMBEDDING_COUNT)
+            _list = take_ranked(_list, ranked, settings.TABLE_EMBEDDING_COUNT)
             # print(len(_list))
             end_time = time.time()
             SQLBotLogUtil.info(str(end_time - start_time))
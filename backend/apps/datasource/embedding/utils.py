@@ -1,6 +1,9 @@
 # Author: Junjun
 # Date: 2025/9/23
 import math
+from typing import Sequence
+
+import numpy as np
 
 
 def cosine_similarity(vec_a, vec_b):
@@ -16,3 +19,69 @@ def cosine_similarity(vec_a, vec_b):
         return 0.0
 
     return dot_product / (norm_a * norm_b)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2 normalize every row, zero rows stay zero so their similarity is 0"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def cosine_similarity_matrix(query: Sequence[float], matrix: np.ndarray, normalized: bool = False) -> np.ndarray:
+    """
+    Cosine similarity of the query against every row of the matrix, in one matrix-vector product.
+
+    :param normalized: rows of the matrix are already L2 normalized
+    """
+    q = normalize_rows(np.asarray(query, dtype=np.float32))[0]
+    if matrix.shape[1] != q.shape[0]:
+        raise ValueError("The vector dimension must be the same")
+    rows = matrix if normalized else normalize_rows(matrix)
+    return rows @ q
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, highest first"""
+    n = scores.shape[0]
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        # O(n) selection, only the k candidates are sorted
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(n)
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def take_top_k(items: list[dict], scores: np.ndarray, k: int) -> list[dict]:
+    """The k items with the highest scores, highest first, the score is set as `cosine_similarity`"""
+    result = []
+    for index in top_k_indices(scores, k):
+        item = items[index]
+        item['cosine_similarity'] = float(scores[index])
+        result.append(item)
+    return result
+
+
+def take_ranked(items: list[dict], ranked: list[tuple[int, float]], k: int) -> list[dict]:
+    """
+    Items in the order of `ranked` ((id, similarity), as returned by the database), with the similarity set as
+    `cosine_similarity`. Items without embedding follow in their own order, up to k items.
+    """
+    by_id = {item.get('id'): item for item in items}
+    result = []
+    for _id, similarity in ranked[:k]:
+        item = by_id.pop(_id, None)
+        if item is not None:
+            item['cosine_similarity'] = similarity
+            result.append(item)
+    for item in items:
+        if len(result) >= k:
+            break
+        if item.get('id') in by_id:
+            result.append(item)
+    return result
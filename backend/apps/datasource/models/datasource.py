@@ -1,6 +1,7 @@
 from datetime import datetime
 from typing import List, Optional
 
+from pgvector.sqlalchemy import VECTOR
 from pydantic import BaseModel
 from sqlalchemy import Column, Text, BigInteger, DateTime, Identity
 from sqlalchemy.dialects.postgresql import JSONB
@@ -21,7 +22,7 @@ class CoreDatasource(SQLModel, table=True):
     num: str = Field(max_length=256, nullable=True)
     oid: int = Field(sa_column=Column(BigInteger()))
     table_relation: List = Field(sa_column=Column(JSONB, nullable=True))
-    embedding: str = Field(sa_column=Column(Text, nullable=True))
+    embedding: Optional[List[float]] = Field(default=None, sa_column=Column(VECTOR(), nullable=True), exclude=True)
     recommended_config: int = Field(sa_column=Column(BigInteger()))
 
 
@@ -33,7 +34,7 @@ class CoreTable(SQLModel, table=True):
     table_name: str = Field(sa_column=Column(Text))
     table_comment: str = Field(sa_column=Column(Text))
     custom_comment: str = Field(sa_column=Column(Text))
-    embedding: str = Field(sa_column=Column(Text, nullable=True))
+    embedding: Optional[List[float]] = Field(default=None, sa_column=Column(VECTOR(), nullable=True), exclude=True)
 
 
 class DsRecommendedProblem(SQLModel, table=True):
@@ -122,6 +123,11 @@ class DatasourceConf(BaseModel):
     mode: str = ''
     timeout: int = 30
     lowVersion: bool = False
+    poolSize: Optional[int] = None
+    maxOverflow: Optional[int] = None
+    poolRecycle: Optional[int] = None
+    maxRows: Optional[int] = None
+    maxResultSize: Optional[int] = None
 
     def to_dict(self):
         return {
@@ -137,7 +143,12 @@ class DatasourceConf(BaseModel):
             "sheets": self.sheets,
             "mode": self.mode,
             "timeout": self.timeout,
-            "lowVersion": self.lowVersion
+            "lowVersion": self.lowVersion,
+            "poolSize": self.poolSize,
+            "maxOverflow": self.maxOverflow,
+            "poolRecycle": self.poolRecycle,
+            "maxRows": self.maxRows,
+            "maxResultSize": self.maxResultSize
         }
 
 
@@ -0,0 +1,95 @@
+import threading
+import time
+from typing import Callable
+
+from apps.datasource.models.datasource import CoreTable, CoreField, TableAndFields
+from common.core.config import settings
+
+_lock = threading.Lock()
+
+# datasource id -> version, bumped by every write to its tables, fields or the dimensions they use
+_versions: dict[int, int] = {}
+# datasource id -> (expire time, version, schema name, tables, checked fields by table id)
+_models: dict[int, tuple[float, int, str, list[CoreTable], dict[int, list[CoreField]]]] = {}
+# (datasource id, user id) -> (expire time, version, ids of the fields hidden by column permissions)
+_fingerprints: dict[tuple, tuple[float, int, frozenset[int]]] = {}
+# (datasource id, version, hidden field ids) -> (expire time, table objects)
+_table_objs: dict[tuple, tuple[float, list[TableAndFields]]] = {}
+
+
+class DsSchemaCache:
+    """
+    Tables, checked fields and their dimensions per datasource, and the table objects left after the column
+    permissions of a user, shared by the users with the same hidden fields.
+    Writes to tables, fields and dimensions bump the version of the datasource. The permission rules are
+    edited outside of this application, the hidden fields of a user are read again after DS_SCHEMA_CACHE_TTL.
+    The cached objects are detached copies, callers must not change them.
+    """
+
+    @staticmethod
+    def get_table_objs(ds_id: int, user_id: int,
+                       model_loader: Callable[[], tuple[str, list[CoreTable], dict[int, list[CoreField]]]],
+                       hidden_loader: Callable[[list[CoreTable]], set[int]]) -> list[TableAndFields]:
+        if settings.DS_SCHEMA_CACHE_TTL <= 0:
+            schema, tables, fields_dict = model_loader()
+            return DsSchemaCache._build(schema, tables, fields_dict, frozenset(hidden_loader(tables)))
+
+        now = time.time()
+        version = _versions.get(ds_id, 0)
+        model = _models.get(ds_id)
+        if model is None or model[0] < now or model[1] != version:
+            schema, tables, fields_dict = model_loader()
+            model = (now + settings.DS_SCHEMA_CACHE_TTL, version, schema, tables, fields_dict)
+            with _lock:
+                # a write while loading bumped the version, the next call loads again
+                if _versions.get(ds_id, 0) == version:
+                    _models[ds_id] = model
+
+        fingerprint = _fingerprints.get((ds_id, user_id))
+        if fingerprint is None or fingerprint[0] < now or fingerprint[1] != version:
+            fingerprint = (now + settings.DS_SCHEMA_CACHE_TTL, version, frozenset(hidden_loader(model[3])))
+            with _lock:
+                DsSchemaCache._evict(_fingerprints, now)
+                _fingerprints[(ds_id, user_id)] = fingerprint
+
+        key = (ds_id, version, fingerprint[2])
+        cached = _table_objs.get(key)
+        if cached is not None and cached[0] >= now:
+            return cached[1]
+        table_objs = DsSchemaCache._build(model[2], model[3], model[4], fingerprint[2])
+        with _lock:
+            DsSchemaCache._evict(_table_objs, now)
+            _table_objs[key] = (now + settings.DS_SCHEMA_CACHE_TTL, table_objs)
+        return table_objs
+
+    @staticmethod
+    def invalidate(ds_id: int):
+        with _lock:
+            _versions[ds_id] = _versions.get(ds_id, 0) + 1
+            _models.pop(ds_id, None)
+            for key in [k for k in _table_objs if k[0] == ds_id]:
+                _table_objs.pop(key, None)
+
+    @staticmethod
+    def invalidate_all():
+        with _lock:
+            for ds_id in set(_versions) | set(_models):
+                _versions[ds_id] = _versions.get(ds_id, 0) + 1
+            _models.clear()
+            _table_objs.clear()
+
+    @staticmethod
+    def _build(schema: str, tables: list[CoreTable], fields_dict: dict[int, list[CoreField]],
+               hidden: frozenset[int]) -> list[TableAndFields]:
+        _list = []
+        for table in tables:
+            fields = fields_dict.get(table.id)
+            if fields is not None and hidden:
+                fields = [f for f in fields if f.id not in hidden]
+            _list.append(TableAndFields(schema=schema, table=table, fields=fields))
+        return _list
+
+    @staticmethod
+    def _evict(cache: dict, now: float):
+        for key in [k for k, v in cache.items() if v[0] < now]:
+            cache.pop(key, None)
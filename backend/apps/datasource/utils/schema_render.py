@@ -0,0 +1,205 @@
+import json
+import re
+import threading
+import time
+from typing import Optional
+
+from apps.datasource.models.datasource import CoreTable, CoreField
+from common.core.config import settings
+
+# comments longer than this are cut in the terse notation
+TERSE_COMMENT_LENGTH = 32
+
+_cjk = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uff00-\uffef]')
+_key_comment = re.compile(r'主键|primary key|\bpk\b', re.IGNORECASE)
+
+_lock = threading.Lock()
+# table id -> {'ds_id', 'expire', 'headers': {(db name, ds type): header},
+#              'fields': {(field id, dimension id): fragment}}
+_fragments: dict[int, dict] = {}
+
+
+def estimate_tokens(text: str) -> int:
+    """Token count without a tokenizer, a CJK character is about one token and other text about four characters"""
+    if not text:
+        return 0
+    cjk = len(_cjk.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class FieldFragment:
+    def __init__(self, full: str, terse: str):
+        self.full = full
+        self.terse = terse
+        # with the ",\n" joining the field to the previous one
+        self.full_tokens = estimate_tokens(full) + 1
+        self.terse_tokens = estimate_tokens(terse) + 1
+
+
+def _render_header(table: CoreTable, db_name: str, ds_type: str) -> str:
+    header = f"# Table: {db_name}.{table.table_name}" if ds_type != "mysql" and ds_type != "es" \
+        else f"# Table: {table.table_name}"
+    table_comment = table.custom_comment.strip() if table.custom_comment else ''
+    return header + ('\n[\n' if table_comment == '' else f", {table_comment}\n[\n")
+
+
+def _render_field(field: CoreField) -> FieldFragment:
+    field_comment = field.custom_comment.strip() if field.custom_comment else ''
+    terse = f"({field.field_name}:{field.field_type}"
+    full = terse
+    if field_comment != '':
+        full += f", {field_comment}"
+        short_comment = field_comment.splitlines()[0]
+        if len(short_comment) > TERSE_COMMENT_LENGTH:
+            short_comment = short_comment[:TERSE_COMMENT_LENGTH] + '…'
+        terse += f", {short_comment}"
+
+    # 如果字段有关联的维度值，添加 examples 字段
+    dimension = getattr(field, 'dimension', None)
+    if dimension and dimension.values:
+        examples_str = json.dumps(dimension.values[:10], ensure_ascii=False)  # 最多显示10个值
+        full += f", examples:{examples_str}"
+    return FieldFragment(full + ")", terse + ")")
+
+
+class SchemaFragmentCache:
+    """
+    Rendered schema text of tables and fields, dropped when the table, its fields or a dimension they use change
+    in this process, and after DS_SCHEMA_CACHE_TTL for the edits made by the other process (mcp).
+    The fields are filtered by column permission before rendering, the cache holds every field.
+    """
+
+    @staticmethod
+    def header(table: CoreTable, db_name: str, ds_type: str) -> str:
+        key = (db_name, ds_type)
+        entry = SchemaFragmentCache._get(table.id)
+        header = entry['headers'].get(key) if entry else None
+        if header is None:
+            header = _render_header(table, db_name, ds_type)
+            if settings.DS_SCHEMA_CACHE_TTL > 0:
+                with _lock:
+                    SchemaFragmentCache._entry(table)['headers'][key] = header
+        return header
+
+    @staticmethod
+    def field(table: CoreTable, field: CoreField) -> FieldFragment:
+        key = (field.id, field.dimension_id)
+        entry = SchemaFragmentCache._get(table.id)
+        fragment = entry['fields'].get(key) if entry else None
+        if fragment is None:
+            fragment = _render_field(field)
+            if settings.DS_SCHEMA_CACHE_TTL > 0:
+                with _lock:
+                    SchemaFragmentCache._entry(table)['fields'][key] = fragment
+        return fragment
+
+    @staticmethod
+    def invalidate(table_ids: list[int]):
+        with _lock:
+            for table_id in table_ids:
+                _fragments.pop(table_id, None)
+
+    @staticmethod
+    def invalidate_ds(ds_id: int):
+        with _lock:
+            for table_id in [k for k, v in _fragments.items() if v['ds_id'] == ds_id]:
+                _fragments.pop(table_id, None)
+
+    @staticmethod
+    def invalidate_dimension(dimension_id: int):
+        with _lock:
+            for entry in _fragments.values():
+                for key in [k for k in entry['fields'] if k[1] == dimension_id]:
+                    entry['fields'].pop(key, None)
+
+    @staticmethod
+    def _get(table_id: int) -> Optional[dict]:
+        entry = _fragments.get(table_id)
+        return entry if entry is not None and entry['expire'] >= time.time() else None
+
+    @staticmethod
+    def _entry(table: CoreTable) -> dict:
+        entry = _fragments.get(table.id)
+        if entry is None or entry['expire'] < time.time():
+            entry = {'ds_id': table.ds_id, 'expire': time.time() + settings.DS_SCHEMA_CACHE_TTL,
+                     'headers': {}, 'fields': {}}
+            _fragments[table.id] = entry
+        return entry
+
+
+def _field_rank(field: CoreField, key_field_ids: set[int], question: str) -> int:
+    """0 for key and relation columns, 1 for columns named in the question, 2 for the others"""
+    if field.id in key_field_ids or field.field_name.lower() == 'id' or (
+            field.custom_comment and _key_comment.search(field.custom_comment)):
+        return 0
+    if question:
+        if field.field_name.lower() in question:
+            return 1
+        comment = field.custom_comment.strip().lower() if field.custom_comment else ''
+        if 0 < len(comment) <= TERSE_COMMENT_LENGTH and comment in question:
+            return 1
+    return 2
+
+
+def render_table_schema(items: list[dict], db_name: str, ds_type: str, key_field_ids: Optional[set[int]] = None,
+                        question: str = '', budget: int = 0, terse: bool = False) -> tuple[str, int]:
+    """
+    Schema text of the tables, `items` holds `table`, `fields` and the `cosine_similarity` of the table.
+    With a token budget the headers are always kept, then the key and relation columns, then the columns
+    named in the question and the others, more similar tables getting a larger share of the budget.
+    Returns the text and the number of columns left out, which is also noted in the table.
+    """
+    key_field_ids = key_field_ids or set()
+    question = question.lower() if question else ''
+    headers = [SchemaFragmentCache.header(item['table'], db_name, ds_type) for item in items]
+    fragments = [[SchemaFragmentCache.field(item['table'], f) for f in (item.get('fields') or [])] for item in items]
+    kept: list[set[int]] = [set(range(len(f))) for f in fragments]
+
+    if budget > 0:
+        def cost(i: int, j: int) -> int:
+            return fragments[i][j].terse_tokens if terse else fragments[i][j].full_tokens
+
+        kept = [set() for _ in items]
+        used = sum(estimate_tokens(h) + 2 for h in headers)
+        order = []
+        for i, item in enumerate(items):
+            fields = item.get('fields') or []
+            ranks = [_field_rank(f, key_field_ids, question) for f in fields]
+            order.append(sorted(range(len(fields)), key=lambda j: (ranks[j], j)))
+            # key columns first, they are what the tables are joined on
+            for j in order[i]:
+                if ranks[j] > 0:
+                    break
+                if used + cost(i, j) <= budget:
+                    kept[i].add(j)
+                    used += cost(i, j)
+
+        # the rest of the budget is shared by similarity, what a table leaves goes to the most similar ones
+        weights = [max(float(item.get('cosine_similarity') or 0.0), 0.0) + 0.1 for item in items]
+        remaining = budget - used
+        for i in range(len(items)):
+            share = remaining * weights[i] / sum(weights)
+            for j in order[i]:
+                if j in kept[i]:
+                    continue
+                if cost(i, j) > share or used + cost(i, j) > budget:
+                    break
+                kept[i].add(j)
+                share -= cost(i, j)
+                used += cost(i, j)
+        for i in sorted(range(len(items)), key=lambda x: weights[x], reverse=True):
+            for j in order[i]:
+                if j not in kept[i] and used + cost(i, j) <= budget:
+                    kept[i].add(j)
+                    used += cost(i, j)
+
+    schema_str = ''
+    elided = 0
+    for i, item in enumerate(items):
+        lines = [(fragments[i][j].terse if terse else fragments[i][j].full) for j in sorted(kept[i])]
+        omitted = len(fragments[i]) - len(kept[i])
+        if omitted:
+            lines.append(f"(... {omitted} more columns omitted)")
+            elided += omitted
+        schema_str += headers[i] + ",\n".join(lines) + '\n]\n'
+    return schema_str, elided
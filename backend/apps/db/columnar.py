@@ -0,0 +1,246 @@
+import base64
+from datetime import datetime, date, time, timedelta
+from decimal import Decimal
+from typing import Any, Callable, Iterator, Optional, Sequence
+
+import pandas as pd
+
+from common.utils.data_format import DataFormat
+
+
+def convert_value(value, datetime_format='space'):
+    """
+        将Python值转换为JSON可序列化的类型
+
+        :param value: 要转换的值
+        :param datetime_format: 日期时间格式
+            'iso' - 2024-01-15T14:30:45 (ISO标准，带T)
+            'space' - 2024-01-15 14:30:45 (空格分隔，更常见)
+            'auto' - 自动选择
+        """
+    if value is None:
+        return None
+        # 处理 bytes 类型（包括 BIT 字段）
+    if isinstance(value, bytes):
+        # 1. 尝试判断是否是 BIT 类型
+        if len(value) <= 8:  # BIT 类型通常不会很长
+            try:
+                # 转换为整数
+                int_val = int.from_bytes(value, 'big')
+
+                # 如果是 0 或 1，返回布尔值更直观
+                if int_val in (0, 1):
+                    return bool(int_val)
+                else:
+                    return int_val
+            except:
+                # 如果转换失败，尝试解码为字符串
+                pass
+
+        # 2. 尝试解码为 UTF-8 字符串
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            # 3. 如果包含非打印字符，返回十六进制
+            if any(b < 32 and b not in (9, 10, 13) for b in value):  # 非打印字符
+                return f"0x{value.hex()}"
+            else:
+                # 4. 尝试 Latin-1 解码（不会失败）
+                return value.decode('latin-1')
+
+    elif isinstance(value, bytearray):
+        # 处理 bytearray
+        return convert_value(bytes(value))
+
+    if isinstance(value, timedelta):
+        # 将 timedelta 转换为秒数（整数）或字符串
+        return str(value)  # 或 value.total_seconds()
+    elif isinstance(value, Decimal):
+        return float(value)
+    # 4. 处理 datetime
+    elif isinstance(value, datetime):
+        if datetime_format == 'iso':
+            return value.isoformat()
+        elif datetime_format == 'space':
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        else:  # 'auto' 或其他
+            # 自动判断：没有时间部分只显示日期
+            if value.hour == 0 and value.minute == 0 and value.second == 0 and value.microsecond == 0:
+                return value.strftime('%Y-%m-%d')
+            else:
+                return value.strftime('%Y-%m-%d %H:%M:%S')
+
+    # 5. 处理 date
+    elif isinstance(value, date):
+        return value.isoformat()  # 总是 YYYY-MM-DD
+
+    # 6. 处理 time
+    elif isinstance(value, time):
+        return str(value)
+    else:
+        return value
+
+
+def _typed(value_type: type, fast: Callable[[Any], Any]) -> Callable[[Any], Any]:
+    # fast path for the expected type, anything else (mixed column, null) goes the generic way
+    def convert(value):
+        if type(value) is value_type:
+            return fast(value)
+        return convert_value(value)
+
+    return convert
+
+
+def _identity(value):
+    return value
+
+
+# 按列的Python类型选择一次转换函数，避免逐个单元格走 isinstance 判断链
+_converters: dict[type, Callable[[Any], Any]] = {
+    int: _identity,
+    float: _identity,
+    str: _identity,
+    bool: _identity,
+    Decimal: _typed(Decimal, float),
+    datetime: _typed(datetime, lambda v: v.strftime('%Y-%m-%d %H:%M:%S')),
+    date: _typed(date, lambda v: v.isoformat()),
+    time: _typed(time, str),
+    timedelta: _typed(timedelta, str),
+}
+
+
+def get_column_converter(value) -> Callable[[Any], Any]:
+    """Pick the converter of a column from its first non-null value, drivers report the same type for a column"""
+    converter = _converters.get(type(value))
+    if converter is None:
+        return convert_value
+    if converter is _identity:
+        # a later row may still hold another type (e.g. es, excel), keep those JSON safe as well
+        return _typed(type(value), _identity)
+    return converter
+
+
+def format_float_without_scientific(value: float) -> str:
+    """格式化浮点数，避免科学记数法"""
+    if value == 0:
+        return "0"
+    formatted = f"{value:.15f}"
+    if '.' in formatted:
+        formatted = formatted.rstrip('0').rstrip('.')
+    return formatted
+
+
+class ColumnarResult:
+    """
+    Query result kept as column names plus one list of converted values per column.
+    JSON rows, pandas frames (markdown, Excel) are all produced from this structure.
+    """
+
+    def __init__(self, fields: list[str], sql: str = ''):
+        self.fields = fields
+        self.columns: list[list] = [[] for _ in fields]
+        self.sql = sql
+        self.truncated = False
+        self.total = 0
+        self._converters: list[Optional[Callable[[Any], Any]]] = [None] * len(fields)
+        self._types: list[Optional[type]] = [None] * len(fields)
+
+    @classmethod
+    def from_rows(cls, fields: list[str], rows: list[dict]) -> 'ColumnarResult':
+        """Build from stored JSON rows, the values are already converted"""
+        result = cls(fields)
+        result.columns = [[row.get(field) for row in rows] for field in fields]
+        return result
+
+    def empty_copy(self) -> 'ColumnarResult':
+        """Empty result for the next batch of the same query, keeps the converters picked so far"""
+        result = ColumnarResult(self.fields, self.sql)
+        result._converters = list(self._converters)
+        result._types = list(self._types)
+        return result
+
+    @property
+    def num_rows(self) -> int:
+        return len(self.columns[0]) if self.columns else 0
+
+    def extend(self, batch: Sequence[Sequence]):
+        if not batch:
+            return
+        for idx, column in enumerate(self.columns):
+            values = [row[idx] for row in batch]
+            converter = self._converters[idx]
+            if converter is None:
+                first = next((value for value in values if value is not None), None)
+                if first is None:
+                    column.extend(values)
+                    continue
+                self._types[idx] = type(first)
+                converter = self._converters[idx] = get_column_converter(first)
+            column.extend([None if value is None else converter(value) for value in values])
+
+    def stringify_large_numbers(self, int_threshold=1e15, float_threshold=1e10):
+        """大数字转为字符串，避免前端精度丢失；已知类型的非数值列直接跳过"""
+        for idx, column in enumerate(self.columns):
+            column_type = self._types[idx]
+            if column_type is not None and column_type not in (int, float, Decimal):
+                continue
+            self.columns[idx] = [self._stringify_number(value, int_threshold, float_threshold) for value in column]
+
+    @staticmethod
+    def _stringify_number(value, int_threshold, float_threshold):
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, int):
+            return str(value) if abs(value) >= int_threshold else value
+        if isinstance(value, float):
+            if abs(value) >= float_threshold or abs(value) < 1e-6:
+                return format_float_without_scientific(value)
+        return value
+
+    def to_rows(self) -> list[dict]:
+        fields = [str(field) for field in self.fields]
+        return [dict(zip(fields, values)) for values in zip(*self.columns)]
+
+    def to_dict(self) -> dict:
+        return result_dict(self.fields, self.to_rows(), self.sql, self.truncated, self.total)
+
+    def to_dataframe(self, names: Optional[dict[str, str]] = None, fields: Optional[list[str]] = None,
+                     start: int = 0, stop: Optional[int] = None) -> pd.DataFrame:
+        """
+        :param names: 字段到显示名的映射
+        :param fields: 需要输出的字段及顺序，默认全部
+        :param start: 起始行
+        :param stop: 结束行（不含），默认到末尾
+        """
+        index = {field: idx for idx, field in enumerate(self.fields)}
+        fields = fields if fields is not None else self.fields
+        names = names or {}
+        stop = self.num_rows if stop is None else min(stop, self.num_rows)
+        start = min(start, stop)
+        columns = [self.columns[index[field]][start:stop] if field in index else [None] * (stop - start) for field
+                   in fields]
+        # build by position first, display names are allowed to repeat
+        df = pd.DataFrame({idx: column for idx, column in enumerate(columns)})
+        df.columns = [names.get(field) or field for field in fields]
+        return df
+
+    def to_markdown(self, names: Optional[dict[str, str]] = None, fields: Optional[list[str]] = None) -> str:
+        df = self.to_dataframe(names, fields)
+        return DataFormat.safe_convert_to_string(df).to_markdown(index=False)
+
+    def iter_markdown(self, names: Optional[dict[str, str]] = None, fields: Optional[list[str]] = None,
+                      chunk_rows: int = 1000) -> Iterator[str]:
+        """
+        按 chunk_rows 行分段输出 markdown 表格，只有第一段带表头，各段以换行拼接即为完整表格
+        """
+        for start in range(0, max(self.num_rows, 1), chunk_rows):
+            df = self.to_dataframe(names, fields, start, start + chunk_rows)
+            text = DataFormat.safe_convert_to_string(df).to_markdown(index=False)
+            # 去掉后续分段的表头行和分隔行
+            yield text if start == 0 else text.split('\n', 2)[2]
+
+
+def result_dict(fields: list[str], data: list[dict], sql: str, truncated: bool, total: int) -> dict:
+    """查询结果返回给前端及保存到记录的结构"""
+    return {"fields": fields, "data": data, "sql": bytes.decode(base64.b64encode(bytes(sql, 'utf-8'))),
+            "truncated": truncated, "total": total}
@@ -0,0 +1,65 @@
+import json
+import threading
+import time
+from typing import Callable
+
+from apps.datasource.models.datasource import DatasourceConf
+from apps.datasource.utils.utils import aes_decrypt
+from apps.db.engine import get_engine_config
+from apps.db.engine_cache import get_conf_hash
+from common.core.config import settings
+from common.utils.utils import equals_ignore_case
+
+_lock = threading.Lock()
+
+# encrypted configuration -> (expire time, decrypted conf)
+_conf_cache: dict[str, tuple[float, DatasourceConf]] = {}
+# (datasource id, configuration hash) -> (expire time, server version)
+_version_cache: dict[tuple, tuple[float, str]] = {}
+
+
+class DsConfCache:
+    """Decrypted datasource configuration and server version, cached with a TTL."""
+
+    @staticmethod
+    def get_conf(ds) -> DatasourceConf:
+        if equals_ignore_case(ds.type, "excel"):
+            return get_engine_config()
+        key = ds.configuration
+        now = time.time()
+        cached = _conf_cache.get(key)
+        if cached is None or cached[0] < now:
+            conf = DatasourceConf(**json.loads(aes_decrypt(key)))
+            with _lock:
+                DsConfCache._evict(_conf_cache, now)
+                _conf_cache[key] = (now + settings.DS_CONF_CACHE_TTL, conf)
+        else:
+            conf = cached[1]
+        # callers change timeout on the conf, never hand out the cached instance
+        return conf.model_copy()
+
+    @staticmethod
+    def get_version(ds, loader: Callable[[], str]) -> str:
+        key = (ds.id, ds.type, get_conf_hash(ds))
+        now = time.time()
+        cached = _version_cache.get(key)
+        if cached is not None and cached[0] >= now:
+            return cached[1]
+        version = loader()
+        # an empty version usually means the probe failed, try again next time
+        if version:
+            with _lock:
+                DsConfCache._evict(_version_cache, now)
+                _version_cache[key] = (now + settings.DS_CONF_CACHE_TTL, version)
+        return version
+
+    @staticmethod
+    def invalidate(ds_id: int):
+        with _lock:
+            for key in [k for k in _version_cache if k[0] == ds_id]:
+                _version_cache.pop(key, None)
+
+    @staticmethod
+    def _evict(cache: dict, now: float):
+        for key in [k for k, v in cache.items() if v[0] < now]:
+            cache.pop(key, None)
@@ -1,30 +1,33 @@
-import base64
 import json
 import os
 import platform
 import urllib.parse
-from datetime import datetime, date, time, timedelta
-from decimal import Decimal
-from typing import Optional
+import uuid
+from contextlib import contextmanager, nullcontext
+from typing import Optional, Callable, Sequence, Iterator
 
 import oracledb
 import psycopg2
 import pymssql
 
-from apps.db.db_sql import get_table_sql, get_field_sql, get_version_sql
+from apps.db.db_sql import get_table_sql, get_field_sql, get_version_sql, get_table_field_sql
 from common.error import ParseSQLResultError
 
 if platform.system() != "Darwin":
     import dmPython
 import pymysql
 import redshift_connector
-from sqlalchemy import create_engine, text, Engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, text, Engine, Connection
+from sqlalchemy.orm import Session
 
 from apps.datasource.models.datasource import DatasourceConf, CoreDatasource, TableSchema, ColumnSchema
 from apps.datasource.utils.utils import aes_decrypt
+from apps.db.columnar import ColumnarResult, result_dict
+from apps.db.conf_cache import DsConfCache
 from apps.db.constant import DB, ConnectType
-from apps.db.engine import get_engine_config
+from apps.db.driver_pool import DsDriverPool
+from apps.db.engine_cache import DsEngineCache
+from apps.db.sql_rewrite import get_sqlglot_dialect
 from apps.system.crud.assistant import get_out_ds_conf
 from apps.system.schemas.system_schema import AssistantOutDsSchema
 from common.core.deps import Trans
@@ -49,8 +52,7 @@ except Exception as e:
 
 
 def get_uri(ds: CoreDatasource) -> str:
-    conf = DatasourceConf(**json.loads(aes_decrypt(ds.configuration))) if not equals_ignore_case(ds.type,
-                                                                                                 "excel") else get_engine_config()
+    conf = DsConfCache.get_conf(ds)
     return get_uri_from_config(ds.type, conf)
 
 
@@ -132,32 +134,82 @@ def get_origin_connect(type: str, conf: DatasourceConf):
             )
 
 
-# use sqlalchemy
-def get_engine(ds: CoreDatasource, timeout: int = 0) -> Engine:
-    conf = DatasourceConf(**json.loads(aes_decrypt(ds.configuration))) if not equals_ignore_case(ds.type,
-                                                                                                 "excel") else get_engine_config()
-    if conf.timeout is None:
-        conf.timeout = timeout
-    if timeout > 0:
-        conf.timeout = timeout
-
+def get_driver_connect(type: str, conf: DatasourceConf):
+    extra_config_dict = get_extra_config(conf)
+    if equals_ignore_case(type, 'dm'):
+        return dmPython.connect(user=conf.username, password=conf.password, server=conf.host,
+                                port=conf.port, **extra_config_dict)
+    elif equals_ignore_case(type, 'doris', 'starrocks'):
+        return pymysql.connect(user=conf.username, passwd=conf.password, host=conf.host,
+                               port=conf.port, db=conf.database, connect_timeout=conf.timeout,
+                               read_timeout=conf.timeout, **extra_config_dict)
+    elif equals_ignore_case(type, 'redshift'):
+        return redshift_connector.connect(host=conf.host, port=conf.port, database=conf.database, user=conf.username,
+                                          password=conf.password,
+                                          timeout=conf.timeout, **extra_config_dict)
+    elif equals_ignore_case(type, 'kingbase'):
+        return psycopg2.connect(host=conf.host, port=conf.port, database=conf.database, user=conf.username,
+                                password=conf.password,
+                                connect_timeout=conf.timeout,
+                                options=f"-c statement_timeout={conf.timeout * 1000}",
+                                **extra_config_dict)
+    raise Exception(f'The datasource type {type} not support native driver.')
+
+
+# use DB-API driver, connections are pooled per datasource
+def get_driver_connection(ds: CoreDatasource | AssistantOutDsSchema, conf: DatasourceConf):
+    pool_config = get_pool_config(conf)
+    return DsDriverPool.connect(ds, lambda: get_driver_connect(ds.type, conf), pool_config["pool_size"],
+                                pool_config["max_overflow"], pool_config["pool_recycle"])
+
+
+def get_pool_config(conf: DatasourceConf) -> dict:
+    return {
+        "pool_size": conf.poolSize if conf.poolSize is not None else settings.DS_POOL_SIZE,
+        "max_overflow": conf.maxOverflow if conf.maxOverflow is not None else settings.DS_POOL_MAX_OVERFLOW,
+        "pool_recycle": conf.poolRecycle if conf.poolRecycle is not None else settings.DS_POOL_RECYCLE,
+        "pool_timeout": settings.DS_POOL_TIMEOUT,
+        "pool_pre_ping": settings.DS_POOL_PRE_PING,
+    }
+
+
+def create_ds_engine(ds: CoreDatasource, conf: DatasourceConf, pooled: bool = True) -> Engine:
+    pool_kwargs = get_pool_config(conf) if pooled else {"poolclass": NullPool}
     if equals_ignore_case(ds.type, "pg"):
         if conf.dbSchema is not None and conf.dbSchema != "":
-            engine = create_engine(get_uri(ds),
+            engine = create_engine(get_uri_from_config(ds.type, conf),
                                    connect_args={"options": f"-c search_path={urllib.parse.quote(conf.dbSchema)}",
-                                                 "connect_timeout": conf.timeout}, poolclass=NullPool)
+                                                 "connect_timeout": conf.timeout}, **pool_kwargs)
         else:
-            engine = create_engine(get_uri(ds), connect_args={"connect_timeout": conf.timeout}, poolclass=NullPool)
+            engine = create_engine(get_uri_from_config(ds.type, conf), connect_args={"connect_timeout": conf.timeout},
+                                   **pool_kwargs)
     elif equals_ignore_case(ds.type, 'sqlServer'):
-        engine = create_engine('mssql+pymssql://', creator=lambda: get_origin_connect(ds.type, conf),
-                               poolclass=NullPool)
+        engine = create_engine('mssql+pymssql://', creator=lambda: get_origin_connect(ds.type, conf), **pool_kwargs)
     elif equals_ignore_case(ds.type, 'oracle'):
-        engine = create_engine(get_uri(ds), poolclass=NullPool)
+        engine = create_engine(get_uri_from_config(ds.type, conf), **pool_kwargs)
     else:  # mysql, ck
-        engine = create_engine(get_uri(ds), connect_args={"connect_timeout": conf.timeout}, poolclass=NullPool)
+        engine = create_engine(get_uri_from_config(ds.type, conf), connect_args={"connect_timeout": conf.timeout},
+                               **pool_kwargs)
     return engine
 
 
+# use sqlalchemy
+def get_engine(ds: CoreDatasource, timeout: int = 0) -> Engine:
+    def build():
+        conf = DsConfCache.get_conf(ds)
+        if conf.timeout is None:
+            conf.timeout = timeout
+        if timeout > 0:
+            conf.timeout = timeout
+        return create_ds_engine(ds, conf, pooled=ds.id is not None and settings.DS_POOL_ENABLED)
+
+    # unsaved datasource (connection test from the form) or pooling disabled, use a throwaway engine
+    if ds.id is None or not settings.DS_POOL_ENABLED:
+        return build()
+    # the connect timeout is part of the engine, engines built with another timeout are kept apart
+    return DsEngineCache.get_engine(ds, build, timeout)
+
+
 def get_session(ds: CoreDatasource | AssistantOutDsSchema):
     # engine = get_engine(ds) if isinstance(ds, CoreDatasource) else get_ds_engine(ds)
     if isinstance(ds, AssistantOutDsSchema):
@@ -165,11 +217,55 @@ def get_session(ds: CoreDatasource | AssistantOutDsSchema):
         ds.configuration = out_conf
 
     engine = get_engine(ds)
-    session_maker = sessionmaker(bind=engine)
-    session = session_maker()
+    session = Session(bind=engine)
     return session
 
 
+@contextmanager
+def get_ds_connection(ds: CoreDatasource | AssistantOutDsSchema):
+    # checked out connection, SQLAlchemy Connection or DB-API connection of the native driver
+    if isinstance(ds, AssistantOutDsSchema) and not ds.configuration:
+        ds.configuration = get_out_ds_conf(ds, 30)
+    db = DB.get_db(ds.type)
+    if db.connect_type == ConnectType.sqlalchemy:
+        with get_engine(ds).connect() as connection:
+            yield connection
+    else:
+        with get_driver_connection(ds, DsConfCache.get_conf(ds)) as connection:
+            yield connection
+
+
+def cancel_query(ds: CoreDatasource | AssistantOutDsSchema, connection) -> bool:
+    """
+    Ask the server to stop the statement running on `connection`, called from another thread.
+    Returns False when the driver has no way to do it, the statement then runs to the end.
+    """
+    dbapi_conn = connection.connection.dbapi_connection if isinstance(connection, Connection) else connection
+    try:
+        # psycopg2 (pg, kingbase), oracledb
+        if callable(getattr(dbapi_conn, 'cancel', None)):
+            dbapi_conn.cancel()
+            return True
+        # pymysql (mysql, doris, starrocks): kill the query from a second connection
+        thread_id = getattr(dbapi_conn, 'thread_id', None)
+        if callable(thread_id):
+            kill_sql = f'KILL QUERY {int(thread_id())}'
+            if isinstance(connection, Connection):
+                with get_engine(ds).connect() as kill_conn:
+                    kill_conn.exec_driver_sql(kill_sql)
+            else:
+                kill_conn = get_driver_connect(ds.type, DsConfCache.get_conf(ds))
+                try:
+                    with kill_conn.cursor() as cursor:
+                        cursor.execute(kill_sql)
+                finally:
+                    kill_conn.close()
+            return True
+    except Exception as e:
+        SQLBotLogUtil.error(f"Datasource {ds.id} cancel query failed: {e}")
+    return False
+
+
 def check_connection(trans: Optional[Trans], ds: CoreDatasource | AssistantOutDsSchema, is_raise: bool = False):
     if isinstance(ds, AssistantOutDsSchema):
         out_conf = get_out_ds_conf(ds, 10)
@@ -188,11 +284,9 @@ def check_connection(trans: Optional[Trans], ds: CoreDatasource | AssistantOutDs
                 raise HTTPException(status_code=500, detail=trans('i18n_ds_invalid') + f': {e.args}')
             return False
     else:
-        conf = DatasourceConf(**json.loads(aes_decrypt(ds.configuration)))
-        extra_config_dict = get_extra_config(conf)
+        conf = DsConfCache.get_conf(ds)
         if equals_ignore_case(ds.type, 'dm'):
-            with dmPython.connect(user=conf.username, password=conf.password, server=conf.host,
-                                  port=conf.port, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 try:
                     cursor.execute('select 1', timeout=10).fetchall()
                     SQLBotLogUtil.info("success")
@@ -203,9 +297,7 @@ def check_connection(trans: Optional[Trans], ds: CoreDatasource | AssistantOutDs
                         raise HTTPException(status_code=500, detail=trans('i18n_ds_invalid') + f': {e.args}')
                     return False
         elif equals_ignore_case(ds.type, 'doris', 'starrocks'):
-            with pymysql.connect(user=conf.username, passwd=conf.password, host=conf.host,
-                                 port=conf.port, db=conf.database, connect_timeout=10,
-                                 read_timeout=10, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 try:
                     cursor.execute('select 1')
                     SQLBotLogUtil.info("success")
@@ -216,10 +308,7 @@ def check_connection(trans: Optional[Trans], ds: CoreDatasource | AssistantOutDs
                         raise HTTPException(status_code=500, detail=trans('i18n_ds_invalid') + f': {e.args}')
                     return False
         elif equals_ignore_case(ds.type, 'redshift'):
-            with redshift_connector.connect(host=conf.host, port=conf.port, database=conf.database,
-                                            user=conf.username,
-                                            password=conf.password,
-                                            timeout=10, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 try:
                     cursor.execute('select 1')
                     SQLBotLogUtil.info("success")
@@ -230,10 +319,7 @@ def check_connection(trans: Optional[Trans], ds: CoreDatasource | AssistantOutDs
                         raise HTTPException(status_code=500, detail=trans('i18n_ds_invalid') + f': {e.args}')
                     return False
         elif equals_ignore_case(ds.type, 'kingbase'):
-            with psycopg2.connect(host=conf.host, port=conf.port, database=conf.database,
-                                  user=conf.username,
-                                  password=conf.password,
-                                  connect_timeout=10, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 try:
                     cursor.execute('select 1')
                     SQLBotLogUtil.info("success")
@@ -267,11 +353,13 @@ def check_connection(trans: Optional[Trans], ds: CoreDatasource | AssistantOutDs
 
 
 def get_version(ds: CoreDatasource | AssistantOutDsSchema):
+    return DsConfCache.get_version(ds, lambda: probe_version(ds))
+
+
+def probe_version(ds: CoreDatasource | AssistantOutDsSchema):
     version = ''
     if isinstance(ds, CoreDatasource):
-        conf = DatasourceConf(
-            **json.loads(aes_decrypt(ds.configuration))) if not equals_ignore_case(ds.type,
-                                                                                   "excel") else get_engine_config()
+        conf = DsConfCache.get_conf(ds)
     else:
         conf = DatasourceConf(**json.loads(aes_decrypt(get_out_ds_conf(ds, 10))))
     # if isinstance(ds, AssistantOutDsSchema):
@@ -292,17 +380,13 @@ def get_version(ds: CoreDatasource | AssistantOutDsSchema):
                     res = result.fetchall()
                     version = res[0][0]
         else:
-            extra_config_dict = get_extra_config(conf)
             if equals_ignore_case(ds.type, 'dm'):
-                with dmPython.connect(user=conf.username, password=conf.password, server=conf.host,
-                                      port=conf.port) as conn, conn.cursor() as cursor:
-                    cursor.execute(sql, timeout=10, **extra_config_dict)
+                with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
+                    cursor.execute(sql, timeout=10)
                     res = cursor.fetchall()
                     version = res[0][0]
             elif equals_ignore_case(ds.type, 'doris', 'starrocks'):
-                with pymysql.connect(user=conf.username, passwd=conf.password, host=conf.host,
-                                     port=conf.port, db=conf.database, connect_timeout=10,
-                                     read_timeout=10, **extra_config_dict) as conn, conn.cursor() as cursor:
+                with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                     cursor.execute(sql)
                     res = cursor.fetchall()
                     version = res[0][0]
@@ -315,7 +399,7 @@ def get_version(ds: CoreDatasource | AssistantOutDsSchema):
 
 
 def get_schema(ds: CoreDatasource):
-    conf = DatasourceConf(**json.loads(aes_decrypt(ds.configuration))) if ds.type != "excel" else get_engine_config()
+    conf = DsConfCache.get_conf(ds)
     db = DB.get_db(ds.type)
     if db.connect_type == ConnectType.sqlalchemy:
         with get_session(ds) as session:
@@ -334,10 +418,8 @@ def get_schema(ds: CoreDatasource):
                 res_list = [item[0] for item in res]
                 return res_list
     else:
-        extra_config_dict = get_extra_config(conf)
         if equals_ignore_case(ds.type, 'dm'):
-            with dmPython.connect(user=conf.username, password=conf.password, server=conf.host,
-                                  port=conf.port, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 cursor.execute("""select OBJECT_NAME
                                   from dba_objects
                                   where object_type = 'SCH'""", timeout=conf.timeout)
@@ -345,19 +427,14 @@ def get_schema(ds: CoreDatasource):
                 res_list = [item[0] for item in res]
                 return res_list
         elif equals_ignore_case(ds.type, 'redshift'):
-            with redshift_connector.connect(host=conf.host, port=conf.port, database=conf.database, user=conf.username,
-                                            password=conf.password,
-                                            timeout=conf.timeout, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 cursor.execute("""SELECT nspname
                                   FROM pg_namespace""")
                 res = cursor.fetchall()
                 res_list = [item[0] for item in res]
                 return res_list
         elif equals_ignore_case(ds.type, 'kingbase'):
-            with psycopg2.connect(host=conf.host, port=conf.port, database=conf.database, user=conf.username,
-                                  password=conf.password,
-                                  options=f"-c statement_timeout={conf.timeout * 1000}",
-                                  **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 cursor.execute("""SELECT nspname
                                   FROM pg_namespace""")
                 res = cursor.fetchall()
@@ -366,8 +443,7 @@ def get_schema(ds: CoreDatasource):
 
 
 def get_tables(ds: CoreDatasource):
-    conf = DatasourceConf(**json.loads(aes_decrypt(ds.configuration))) if not equals_ignore_case(ds.type,
-                                                                                                 "excel") else get_engine_config()
+    conf = DsConfCache.get_conf(ds)
     db = DB.get_db(ds.type)
     sql, sql_param = get_table_sql(ds, conf, get_version(ds))
     if db.connect_type == ConnectType.sqlalchemy:
@@ -377,35 +453,26 @@ def get_tables(ds: CoreDatasource):
                 res_list = [TableSchema(*item) for item in res]
                 return res_list
     else:
-        extra_config_dict = get_extra_config(conf)
         if equals_ignore_case(ds.type, 'dm'):
-            with dmPython.connect(user=conf.username, password=conf.password, server=conf.host,
-                                  port=conf.port, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 cursor.execute(sql, {"param": sql_param}, timeout=conf.timeout)
                 res = cursor.fetchall()
                 res_list = [TableSchema(*item) for item in res]
                 return res_list
         elif equals_ignore_case(ds.type, 'doris', 'starrocks'):
-            with pymysql.connect(user=conf.username, passwd=conf.password, host=conf.host,
-                                 port=conf.port, db=conf.database, connect_timeout=conf.timeout,
-                                 read_timeout=conf.timeout, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 cursor.execute(sql, (sql_param,))
                 res = cursor.fetchall()
                 res_list = [TableSchema(*item) for item in res]
                 return res_list
         elif equals_ignore_case(ds.type, 'redshift'):
-            with redshift_connector.connect(host=conf.host, port=conf.port, database=conf.database, user=conf.username,
-                                            password=conf.password,
-                                            timeout=conf.timeout, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 cursor.execute(sql, (sql_param,))
                 res = cursor.fetchall()
                 res_list = [TableSchema(*item) for item in res]
                 return res_list
         elif equals_ignore_case(ds.type, 'kingbase'):
-            with psycopg2.connect(host=conf.host, port=conf.port, database=conf.database, user=conf.username,
-                                  password=conf.password,
-                                  options=f"-c statement_timeout={conf.timeout * 1000}",
-                                  **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 cursor.execute(sql.format(sql_param))
                 res = cursor.fetchall()
                 res_list = [TableSchema(*item) for item in res]
@@ -417,8 +484,7 @@ def get_tables(ds: CoreDatasource):
 
 
 def get_fields(ds: CoreDatasource, table_name: str = None):
-    conf = DatasourceConf(**json.loads(aes_decrypt(ds.configuration))) if not equals_ignore_case(ds.type,
-                                                                                                 "excel") else get_engine_config()
+    conf = DsConfCache.get_conf(ds)
     db = DB.get_db(ds.type)
     sql, p1, p2 = get_field_sql(ds, conf, table_name)
     if db.connect_type == ConnectType.sqlalchemy:
@@ -428,35 +494,26 @@ def get_fields(ds: CoreDatasource, table_name: str = None):
                 res_list = [ColumnSchema(*item) for item in res]
                 return res_list
     else:
-        extra_config_dict = get_extra_config(conf)
         if equals_ignore_case(ds.type, 'dm'):
-            with dmPython.connect(user=conf.username, password=conf.password, server=conf.host,
-                                  port=conf.port, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 cursor.execute(sql, {"param1": p1, "param2": p2}, timeout=conf.timeout)
                 res = cursor.fetchall()
                 res_list = [ColumnSchema(*item) for item in res]
                 return res_list
         elif equals_ignore_case(ds.type, 'doris', 'starrocks'):
-            with pymysql.connect(user=conf.username, passwd=conf.password, host=conf.host,
-                                 port=conf.port, db=conf.database, connect_timeout=conf.timeout,
-                                 read_timeout=conf.timeout, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 cursor.execute(sql, (p1, p2))
                 res = cursor.fetchall()
                 res_list = [ColumnSchema(*item) for item in res]
                 return res_list
         elif equals_ignore_case(ds.type, 'redshift'):
-            with redshift_connector.connect(host=conf.host, port=conf.port, database=conf.database, user=conf.username,
-                                            password=conf.password,
-                                            timeout=conf.timeout, **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 cursor.execute(sql, (p1, p2))
                 res = cursor.fetchall()
                 res_list = [ColumnSchema(*item) for item in res]
                 return res_list
         elif equals_ignore_case(ds.type, 'kingbase'):
-            with psycopg2.connect(host=conf.host, port=conf.port, database=conf.database, user=conf.username,
-                                  password=conf.password,
-                                  options=f"-c statement_timeout={conf.timeout * 1000}",
-                                  **extra_config_dict) as conn, conn.cursor() as cursor:
+            with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
                 cursor.execute(sql.format(p1, p2))
                 res = cursor.fetchall()
                 res_list = [ColumnSchema(*item) for item in res]
@@ -467,201 +524,277 @@ def get_fields(ds: CoreDatasource, table_name: str = None):
             return res_list
 
 
-def convert_value(value, datetime_format='space'):
+def get_fields_by_tables(ds: CoreDatasource, table_names: list[str]) -> dict[str, list[ColumnSchema]]:
     """
-        将Python值转换为JSON可序列化的类型
-
-        :param value: 要转换的值
-        :param datetime_format: 日期时间格式
-            'iso' - 2024-01-15T14:30:45 (ISO标准，带T)
-            'space' - 2024-01-15 14:30:45 (空格分隔，更常见)
-            'auto' - 自动选择
-        """
-    if value is None:
-        return None
-        # 处理 bytes 类型（包括 BIT 字段）
-    if isinstance(value, bytes):
-        # 1. 尝试判断是否是 BIT 类型
-        if len(value) <= 8:  # BIT 类型通常不会很长
-            try:
-                # 转换为整数
-                int_val = int.from_bytes(value, 'big')
-
-                # 如果是 0 或 1，返回布尔值更直观
-                if int_val in (0, 1):
-                    return bool(int_val)
-                else:
-                    return int_val
-            except:
-                # 如果转换失败，尝试解码为字符串
-                pass
-
-        # 2. 尝试解码为 UTF-8 字符串
-        try:
-            return value.decode('utf-8')
-        except UnicodeDecodeError:
-            # 3. 如果包含非打印字符，返回十六进制
-            if any(b < 32 and b not in (9, 10, 13) for b in value):  # 非打印字符
-                return f"0x{value.hex()}"
-            else:
-                # 4. 尝试 Latin-1 解码（不会失败）
-                return value.decode('latin-1')
-
-    elif isinstance(value, bytearray):
-        # 处理 bytearray
-        return convert_value(bytes(value))
-
-    if isinstance(value, timedelta):
-        # 将 timedelta 转换为秒数（整数）或字符串
-        return str(value)  # 或 value.total_seconds()
-    elif isinstance(value, Decimal):
-        return float(value)
-    # 4. 处理 datetime
-    elif isinstance(value, datetime):
-        if datetime_format == 'iso':
-            return value.isoformat()
-        elif datetime_format == 'space':
-            return value.strftime('%Y-%m-%d %H:%M:%S')
-        else:  # 'auto' 或其他
-            # 自动判断：没有时间部分只显示日期
-            if value.hour == 0 and value.minute == 0 and value.second == 0 and value.microsecond == 0:
-                return value.strftime('%Y-%m-%d')
-            else:
-                return value.strftime('%Y-%m-%d %H:%M:%S')
-
-    # 5. 处理 date
-    elif isinstance(value, date):
-        return value.isoformat()  # 总是 YYYY-MM-DD
+    Columns of the tables, read with one metadata query for the whole schema,
+    or table by table for the types without such a query.
+    """
+    conf = DsConfCache.get_conf(ds)
+    db = DB.get_db(ds.type)
+    sql, param = get_table_field_sql(ds, conf)
+    if not sql:
+        return {table_name: get_fields(ds, table_name) for table_name in table_names}
 
-    # 6. 处理 time
-    elif isinstance(value, time):
-        return str(value)
+    if db.connect_type == ConnectType.sqlalchemy:
+        with get_session(ds) as session:
+            with session.execute(text(sql), {"param1": param}) as result:
+                res = result.fetchall()
+    elif equals_ignore_case(ds.type, 'dm'):
+        with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
+            cursor.execute(sql, {"param1": param}, timeout=conf.timeout)
+            res = cursor.fetchall()
+    elif equals_ignore_case(ds.type, 'kingbase'):
+        with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
+            cursor.execute(sql.format(param))
+            res = cursor.fetchall()
     else:
-        return value
+        with get_driver_connection(ds, conf) as conn, conn.cursor() as cursor:
+            cursor.execute(sql, (param,))
+            res = cursor.fetchall()
+
+    fields = {table_name: [] for table_name in table_names}
+    for item in res:
+        table_fields = fields.get(item[0])
+        if table_fields is not None:
+            table_fields.append(ColumnSchema(*item[1:]))
+    return fields
+
+
+def get_fetch_limit(ds: CoreDatasource | AssistantOutDsSchema, max_rows: Optional[int] = None,
+                    max_bytes: Optional[int] = None) -> tuple[int, int]:
+    conf = DsConfCache.get_conf(ds)
+    ds_rows = conf.maxRows if conf.maxRows else settings.DS_QUERY_MAX_ROWS
+    ds_bytes = (conf.maxResultSize if conf.maxResultSize else settings.DS_QUERY_MAX_RESULT_SIZE) * 1024 * 1024
+    # the caller can only tighten the limits of the datasource
+    return min(max_rows, ds_rows) if max_rows else ds_rows, min(max_bytes, ds_bytes) if max_bytes else ds_bytes
+
+
+def estimate_size(row: tuple) -> int:
+    size = 0
+    for value in row:
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+        else:
+            size += 8
+    return size
+
 
+class SqlResultStream:
+    """
+    Rows of an executing query, fetched from the cursor batch by batch.
+    Iteration stops at the row/byte limit, `truncated` tells whether rows were left behind and
+    `total` is the number of rows read from the cursor. `finished` is set once the cursor is drained.
+    """
 
-def exec_sql(ds: CoreDatasource | AssistantOutDsSchema, sql: str, origin_column=False):
+    def __init__(self, fields: list[str], fetch: Callable[[], Sequence], max_rows: int, max_bytes: int,
+                 first_batch: Optional[Sequence] = None):
+        self.fields = fields
+        self.truncated = False
+        self.finished = False
+        self.total = 0
+        self._fetch = fetch
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+        self._first_batch = first_batch
+
+    def __iter__(self) -> Iterator[Sequence]:
+        rows = 0
+        size = 0
+        batch = self._first_batch if self._first_batch is not None else self._fetch()
+        self._first_batch = None
+        while batch:
+            self.total += len(batch)
+            end = 0
+            for row in batch:
+                if rows >= self._max_rows or size >= self._max_bytes:
+                    self.truncated = True
+                    break
+                size += estimate_size(row)
+                rows += 1
+                end += 1
+            if end:
+                yield batch[:end] if end < len(batch) else batch
+            if self.truncated:
+                return
+            batch = self._fetch()
+        self.finished = True
+
+    def chunks(self, sql: str = '') -> Iterator[ColumnarResult]:
+        """
+        Converted batches for callers that pass rows on instead of keeping them,
+        `truncated` and `total` of each chunk are those read so far.
+        """
+        chunk = ColumnarResult(self.fields, sql)
+        for batch in self:
+            chunk.extend(batch)
+            chunk.truncated = self.truncated
+            chunk.total = self.total
+            yield chunk
+            chunk = chunk.empty_copy()
+
+    def collect(self, sql: str = '') -> ColumnarResult:
+        result = ColumnarResult(self.fields, sql)
+        for batch in self:
+            result.extend(batch)
+        result.truncated = self.truncated
+        result.total = self.total
+        return result
+
+
+@contextmanager
+def stream_sql(ds: CoreDatasource | AssistantOutDsSchema, sql: str, origin_column=False, connection=None,
+               max_rows: Optional[int] = None, max_bytes: Optional[int] = None):
     while sql.endswith(';'):
         sql = sql[:-1]
     # check execute sql only contain read operations
     if not check_sql_read(sql, ds):
         raise ValueError(f"SQL can only contain read operations")
 
+    max_rows, max_bytes = get_fetch_limit(ds, max_rows, max_bytes)
+    batch_size = min(settings.DS_QUERY_FETCH_SIZE, max_rows + 1)
     db = DB.get_db(ds.type)
     if db.connect_type == ConnectType.sqlalchemy:
-        with get_session(ds) as session:
-            with session.execute(text(sql)) as result:
+        with (nullcontext(connection) if connection is not None else get_session(ds)) as session:
+            # server side cursor where the dialect supports it, otherwise the option is ignored
+            result = session.execute(text(sql), execution_options={"stream_results": True,
+                                                                   "max_row_buffer": batch_size})
+            stream = None
+            try:
                 try:
-                    columns = result.keys()._keys if origin_column else [item.lower() for item in result.keys()._keys]
-                    res = result.fetchall()
-                    result_list = [
-                        {str(columns[i]): convert_value(value) for i, value in enumerate(tuple_item)} for tuple_item in
-                        res
-                    ]
-                    return {"fields": columns, "data": result_list,
-                            "sql": bytes.decode(base64.b64encode(bytes(sql, 'utf-8')))}
+                    columns = list(result.keys()) if origin_column else [item.lower() for item in result.keys()]
                 except Exception as ex:
                     raise ParseSQLResultError(str(ex))
+                stream = SqlResultStream(columns, lambda: result.fetchmany(batch_size), max_rows, max_bytes)
+                yield stream
+            finally:
+                if stream is not None and not stream.finished:
+                    abandon_query(ds, session if isinstance(session, Connection) else session.connection())
+                    close_quietly(result)
+                else:
+                    result.close()
+    elif equals_ignore_case(ds.type, 'es'):
+        conf = DsConfCache.get_conf(ds)
+        try:
+            res, columns = get_es_data_by_http(conf, sql)
+            columns = [field.get('name') for field in columns] if origin_column else [field.get('name').lower() for
+                                                                                      field in
+                                                                                      columns]
+        except Exception as ex:
+            raise Exception(str(ex))
+        yield SqlResultStream(columns, lambda: [], max_rows, max_bytes, first_batch=res)
     else:
-        conf = DatasourceConf(**json.loads(aes_decrypt(ds.configuration)))
-        extra_config_dict = get_extra_config(conf)
-        if equals_ignore_case(ds.type, 'dm'):
-            with dmPython.connect(user=conf.username, password=conf.password, server=conf.host,
-                                  port=conf.port, **extra_config_dict) as conn, conn.cursor() as cursor:
-                try:
-                    cursor.execute(sql, timeout=conf.timeout)
-                    res = cursor.fetchall()
-                    columns = [field[0] for field in cursor.description] if origin_column else [field[0].lower() for
-                                                                                                field in
-                                                                                                cursor.description]
-                    result_list = [
-                        {str(columns[i]): convert_value(value) for i, value in enumerate(tuple_item)} for tuple_item in
-                        res
-                    ]
-                    return {"fields": columns, "data": result_list,
-                            "sql": bytes.decode(base64.b64encode(bytes(sql, 'utf-8')))}
-                except Exception as ex:
-                    raise ParseSQLResultError(str(ex))
-        elif equals_ignore_case(ds.type, 'doris', 'starrocks'):
-            with pymysql.connect(user=conf.username, passwd=conf.password, host=conf.host,
-                                 port=conf.port, db=conf.database, connect_timeout=conf.timeout,
-                                 read_timeout=conf.timeout, **extra_config_dict) as conn, conn.cursor() as cursor:
-                try:
-                    cursor.execute(sql)
-                    res = cursor.fetchall()
-                    columns = [field[0] for field in cursor.description] if origin_column else [field[0].lower() for
-                                                                                                field in
-                                                                                                cursor.description]
-                    result_list = [
-                        {str(columns[i]): convert_value(value) for i, value in enumerate(tuple_item)} for tuple_item in
-                        res
-                    ]
-                    return {"fields": columns, "data": result_list,
-                            "sql": bytes.decode(base64.b64encode(bytes(sql, 'utf-8')))}
-                except Exception as ex:
-                    raise ParseSQLResultError(str(ex))
-        elif equals_ignore_case(ds.type, 'redshift'):
-            with redshift_connector.connect(host=conf.host, port=conf.port, database=conf.database, user=conf.username,
-                                            password=conf.password,
-                                            timeout=conf.timeout, **extra_config_dict) as conn, conn.cursor() as cursor:
-                try:
-                    cursor.execute(sql)
-                    res = cursor.fetchall()
-                    columns = [field[0] for field in cursor.description] if origin_column else [field[0].lower() for
-                                                                                                field in
-                                                                                                cursor.description]
-                    result_list = [
-                        {str(columns[i]): convert_value(value) for i, value in enumerate(tuple_item)} for tuple_item in
-                        res
-                    ]
-                    return {"fields": columns, "data": result_list,
-                            "sql": bytes.decode(base64.b64encode(bytes(sql, 'utf-8')))}
-                except Exception as ex:
-                    raise ParseSQLResultError(str(ex))
-        elif equals_ignore_case(ds.type, 'kingbase'):
-            with psycopg2.connect(host=conf.host, port=conf.port, database=conf.database, user=conf.username,
-                                  password=conf.password,
-                                  options=f"-c statement_timeout={conf.timeout * 1000}",
-                                  **extra_config_dict) as conn, conn.cursor() as cursor:
+        conf = DsConfCache.get_conf(ds)
+        conn_ctx = nullcontext(connection) if connection is not None else get_driver_connection(ds, conf)
+        with conn_ctx as conn:
+            cursor = get_stream_cursor(ds, conn)
+            stream = None
+            try:
                 try:
-                    cursor.execute(sql)
-                    res = cursor.fetchall()
+                    if equals_ignore_case(ds.type, 'dm'):
+                        cursor.execute(sql, timeout=conf.timeout)
+                    else:
+                        cursor.execute(sql)
+                    # description of a server side cursor is only known after the first fetch
+                    first_batch = cursor.fetchmany(batch_size)
                     columns = [field[0] for field in cursor.description] if origin_column else [field[0].lower() for
                                                                                                 field in
                                                                                                 cursor.description]
-                    result_list = [
-                        {str(columns[i]): convert_value(value) for i, value in enumerate(tuple_item)} for tuple_item in
-                        res
-                    ]
-                    return {"fields": columns, "data": result_list,
-                            "sql": bytes.decode(base64.b64encode(bytes(sql, 'utf-8')))}
                 except Exception as ex:
                     raise ParseSQLResultError(str(ex))
-        elif equals_ignore_case(ds.type, 'es'):
-            try:
-                res, columns = get_es_data_by_http(conf, sql)
-                columns = [field.get('name') for field in columns] if origin_column else [field.get('name').lower() for
-                                                                                          field in
-                                                                                          columns]
-                result_list = [
-                    {str(columns[i]): convert_value(value) for i, value in enumerate(tuple_item)} for tuple_item in
-                    res
-                ]
-                return {"fields": columns, "data": result_list,
-                        "sql": bytes.decode(base64.b64encode(bytes(sql, 'utf-8')))}
-            except Exception as ex:
-                raise Exception(str(ex))
+                stream = SqlResultStream(columns, lambda: cursor.fetchmany(batch_size), max_rows, max_bytes,
+                                         first_batch=first_batch)
+                yield stream
+            finally:
+                if stream is not None and not stream.finished:
+                    abandon_query(ds, conn)
+                    close_quietly(cursor)
+                else:
+                    cursor.close()
 
 
-def check_sql_read(sql: str, ds: CoreDatasource | AssistantOutDsSchema):
+def abandon_query(ds: CoreDatasource | AssistantOutDsSchema, connection):
+    """
+    Give up a query whose remaining rows are not wanted (limit reached or the caller stopped reading).
+    Closing an unbuffered cursor (pymysql SSCursor, mysql stream_results) would read and drop every
+    remaining row, so the statement is stopped on the server and the connection is discarded instead.
+    """
+    cancel_query(ds, connection)
+    try:
+        if isinstance(connection, Connection):
+            # the pool drops an invalidated connection instead of reusing it
+            connection.invalidate()
+        else:
+            # the driver pool can not roll back a closed connection and discards it on checkin
+            connection.close()
+    except Exception as e:
+        SQLBotLogUtil.error(f"Datasource {ds.id} discard connection failed: {e}")
+
+
+def close_quietly(cursor):
     try:
-        dialect = None
-        if equals_ignore_case(ds.type, 'mysql', 'doris', 'starrocks'):
-            dialect = 'mysql'
-        elif equals_ignore_case(ds.type, 'sqlServer'):
-            dialect = 'tsql'
+        cursor.close()
+    except Exception:
+        # the connection is already discarded by abandon_query
+        pass
+
+
+def get_stream_cursor(ds: CoreDatasource | AssistantOutDsSchema, conn):
+    if equals_ignore_case(ds.type, 'doris', 'starrocks'):
+        return conn.cursor(pymysql.cursors.SSCursor)
+    elif equals_ignore_case(ds.type, 'kingbase'):
+        # named cursor is declared on the server and fetched in batches
+        return conn.cursor(name=f'sqlbot_{uuid.uuid4().hex}')
+    return conn.cursor()
 
-        statements = sqlglot.parse(sql, dialect=dialect)
+
+def query_sql(ds: CoreDatasource | AssistantOutDsSchema, sql: str, origin_column=False, connection=None,
+              max_rows: Optional[int] = None, max_bytes: Optional[int] = None) -> ColumnarResult:
+    while sql.endswith(';'):
+        sql = sql[:-1]
+    with stream_sql(ds, sql, origin_column, connection, max_rows, max_bytes) as stream:
+        try:
+            return stream.collect(sql)
+        except Exception as ex:
+            raise result_error(ds, ex)
+
+
+def exec_sql(ds: CoreDatasource | AssistantOutDsSchema, sql: str, origin_column=False, connection=None,
+             max_rows: Optional[int] = None, max_bytes: Optional[int] = None):
+    while sql.endswith(';'):
+        sql = sql[:-1]
+    data = []
+    with stream_sql(ds, sql, origin_column, connection, max_rows, max_bytes) as stream:
+        try:
+            # rows go to the response batch by batch, no columnar copy of the whole result
+            for chunk in stream.chunks(sql):
+                data.extend(chunk.to_rows())
+        except Exception as ex:
+            raise result_error(ds, ex)
+    return result_dict(stream.fields, data, sql, stream.truncated, stream.total)
+
+
+def exec_sql_column(ds: CoreDatasource | AssistantOutDsSchema, sql: str, origin_column=False, connection=None,
+                    max_rows: Optional[int] = None, max_bytes: Optional[int] = None) -> list:
+    """Values of the first column only"""
+    values = []
+    with stream_sql(ds, sql, origin_column, connection, max_rows, max_bytes) as stream:
+        try:
+            for chunk in stream.chunks(sql):
+                values.extend(chunk.columns[0] if chunk.columns else [])
+        except Exception as ex:
+            raise result_error(ds, ex)
+    return values
+
+
+def result_error(ds: CoreDatasource | AssistantOutDsSchema, ex: Exception) -> Exception:
+    if equals_ignore_case(ds.type, 'es'):
+        return Exception(str(ex))
+    return ParseSQLResultError(str(ex))
+
+
+def check_sql_read(sql: str, ds: CoreDatasource | AssistantOutDsSchema):
+    try:
+        statements = sqlglot.parse(sql, dialect=get_sqlglot_dialect(ds.type))
 
         if not statements:
             raise ValueError("Parse SQL Error")
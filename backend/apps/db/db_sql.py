@@ -313,3 +313,120 @@ def get_field_sql(ds: CoreDatasource, conf: DatasourceConf, table_name: str = No
         return sql1 + sql2, conf.dbSchema, table_name
     elif equals_ignore_case(ds.type, "es"):
         return "", None, None
+
+
+def get_table_field_sql(ds: CoreDatasource, conf: DatasourceConf):
+    """
+    Columns of every table in the schema in one query: table name, column name, type and comment,
+    in column order. Returns "" for types without such a query.
+    """
+    if equals_ignore_case(ds.type, "mysql", "doris", "starrocks"):
+        param = ":param1" if equals_ignore_case(ds.type, "mysql") else "%s"
+        return f"""
+                SELECT 
+                    TABLE_NAME,
+                    COLUMN_NAME,
+                    DATA_TYPE,
+                    COLUMN_COMMENT
+                FROM 
+                    INFORMATION_SCHEMA.COLUMNS
+                WHERE 
+                    TABLE_SCHEMA = {param}
+                ORDER BY TABLE_NAME, ORDINAL_POSITION
+                """, conf.database
+    elif equals_ignore_case(ds.type, "sqlServer"):
+        return """
+                SELECT 
+                    C.TABLE_NAME AS [TABLE_NAME],
+                    C.COLUMN_NAME AS [COLUMN_NAME],
+                    C.DATA_TYPE AS [DATA_TYPE],
+                    ISNULL(EP.value, '') AS [COLUMN_COMMENT]
+                FROM 
+                    INFORMATION_SCHEMA.COLUMNS C
+                LEFT JOIN 
+                    sys.extended_properties EP 
+                    ON EP.major_id = OBJECT_ID(C.TABLE_SCHEMA + '.' + C.TABLE_NAME)
+                    AND EP.minor_id = C.ORDINAL_POSITION
+                    AND EP.name = 'MS_Description'
+                WHERE 
+                    C.TABLE_SCHEMA = :param1
+                ORDER BY C.TABLE_NAME, C.ORDINAL_POSITION
+                """, conf.dbSchema
+    elif equals_ignore_case(ds.type, "pg", "excel", "redshift", "kingbase"):
+        if equals_ignore_case(ds.type, "redshift"):
+            param = "%s"
+        elif equals_ignore_case(ds.type, "kingbase"):
+            param = "'{0}'"
+        else:
+            param = ":param1"
+        return f"""
+               SELECT c.relname                                       AS TABLE_NAME,
+                      a.attname                                       AS COLUMN_NAME,
+                      pg_catalog.format_type(a.atttypid, a.atttypmod) AS DATA_TYPE,
+                      col_description(c.oid, a.attnum)                AS COLUMN_COMMENT
+               FROM pg_catalog.pg_attribute a
+                        JOIN
+                    pg_catalog.pg_class c ON a.attrelid = c.oid
+                        JOIN
+                    pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+               WHERE n.nspname = {param}
+                 AND c.relkind IN ('r', 'v', 'm', 'p', 'f')
+                 AND a.attnum > 0
+                 AND NOT a.attisdropped
+               ORDER BY c.relname, a.attnum
+               """, conf.dbSchema
+    elif equals_ignore_case(ds.type, "oracle"):
+        return """
+                SELECT 
+                    col.TABLE_NAME AS "TABLE_NAME",
+                    col.COLUMN_NAME AS "COLUMN_NAME",
+                    (CASE 
+                        WHEN col.DATA_TYPE IN ('VARCHAR2', 'CHAR', 'NVARCHAR2', 'NCHAR') 
+                            THEN col.DATA_TYPE || '(' || col.DATA_LENGTH || ')' 
+                        WHEN col.DATA_TYPE = 'NUMBER' AND col.DATA_PRECISION IS NOT NULL 
+                            THEN col.DATA_TYPE || '(' || col.DATA_PRECISION || 
+                                 CASE WHEN col.DATA_SCALE > 0 THEN ',' || col.DATA_SCALE END || ')' 
+                        ELSE col.DATA_TYPE 
+                    END) AS "DATA_TYPE",
+                    NVL(com.COMMENTS, '') AS "COLUMN_COMMENT"
+                FROM 
+                    ALL_TAB_COLUMNS col
+                LEFT JOIN 
+                    ALL_COL_COMMENTS com 
+                    ON col.OWNER = com.OWNER 
+                    AND col.TABLE_NAME = com.TABLE_NAME 
+                    AND col.COLUMN_NAME = com.COLUMN_NAME
+                WHERE 
+                    col.OWNER = :param1
+                ORDER BY col.TABLE_NAME, col.COLUMN_ID
+                """, conf.dbSchema
+    elif equals_ignore_case(ds.type, "ck"):
+        return """
+                SELECT 
+                    table AS TABLE_NAME,
+                    name AS COLUMN_NAME,
+                    type AS DATA_TYPE,
+                    comment AS COLUMN_COMMENT
+                FROM system.columns
+                WHERE database = :param1
+                ORDER BY table, position
+                """, conf.database
+    elif equals_ignore_case(ds.type, "dm"):
+        return """
+                SELECT 
+                    c.TABLE_NAME     AS "TABLE_NAME",
+                    c.COLUMN_NAME    AS "COLUMN_NAME",
+                    c.DATA_TYPE      AS "DATA_TYPE",
+                    COALESCE(com.COMMENTS, '') AS "COMMENTS"
+                FROM 
+                    ALL_TAB_COLS c
+                LEFT JOIN 
+                    ALL_COL_COMMENTS com 
+                    ON c.OWNER = com.OWNER 
+                   AND c.TABLE_NAME = com.TABLE_NAME 
+                   AND c.COLUMN_NAME = com.COLUMN_NAME
+                WHERE 
+                    c.OWNER = :param1
+                ORDER BY c.TABLE_NAME, c.COLUMN_ID
+                """, conf.dbSchema
+    return "", None
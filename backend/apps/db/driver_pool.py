@@ -0,0 +1,293 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Any, Optional
+
+from sqlalchemy.exc import DBAPIError
+
+from apps.db.engine_cache import get_conf_hash, get_ds_key
+from common.core.config import settings
+from common.utils.utils import SQLBotLogUtil
+
+_lock = threading.Lock()
+
+# (source kind, datasource id) -> pool
+_pools: dict[tuple[str, int], 'DriverConnectionPool'] = {}
+
+# mysql client errors: server has gone away, lost connection, out of sync, pipe broken, lost during handshake
+_MYSQL_DISCONNECT_CODES = (2006, 2013, 2014, 2045, 2055)
+# mysql server errors: query interrupted by KILL QUERY, max execution time exceeded
+_MYSQL_INTERRUPT_CODES = (1317, 3024, 1969)
+_TIMEOUT_MESSAGES = ('timed out', 'timeout', 'canceling statement', 'cancelled', 'canceled', 'interrupted')
+_DISCONNECT_MESSAGES = ('server closed the connection', 'connection already closed', 'connection not open',
+                        'terminating connection', 'could not receive data from server',
+                        'could not send data to server', 'broken pipe', 'connection reset', 'connection refused')
+
+
+class PooledConnection:
+    conn: Any
+    created_at: float
+    last_used: float
+
+    def __init__(self, conn: Any):
+        self.conn = conn
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+
+class DriverConnectionPool:
+    """Bounded pool of DB-API connections for one datasource, the driver is hidden behind `creator`."""
+
+    def __init__(self, ds_id: int, conf_hash: str, creator: Callable[[], Any], pool_size: int, max_overflow: int,
+                 recycle: int, ping_sql: str = 'select 1'):
+        self.ds_id = ds_id
+        self.conf_hash = conf_hash
+        self.creator = creator
+        self.pool_size = max(pool_size, 1)
+        self.max_size = self.pool_size + max(max_overflow, 0)
+        self.recycle = recycle
+        self.ping_sql = ping_sql
+        self.last_used = time.time()
+        self._idle: list[PooledConnection] = []
+        self._in_use = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {"created": 0, "reused": 0, "discarded": 0, "timeouts": 0}
+
+    def checkout(self) -> PooledConnection:
+        deadline = time.time() + settings.DS_POOL_TIMEOUT
+        while True:
+            item: Optional[PooledConnection] = None
+            with self._cond:
+                while not self._idle and self._in_use >= self.max_size:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise TimeoutError(
+                            f"Datasource {self.ds_id} connection pool exhausted (max size {self.max_size})")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    item = self._idle.pop()
+                self._in_use += 1
+                self.last_used = time.time()
+
+            if item is None:
+                try:
+                    item = PooledConnection(self.creator())
+                except Exception:
+                    self._release_slot()
+                    raise
+                self._stats["created"] += 1
+                return item
+
+            if self._is_usable(item):
+                self._stats["reused"] += 1
+                return item
+            # stale connection, drop it and try again
+            self._close(item)
+            self._release_slot()
+
+    def checkin(self, item: PooledConnection, broken: bool = False):
+        if not broken:
+            try:
+                # end the read transaction, so the next borrower gets a fresh snapshot
+                item.conn.rollback()
+            except Exception:
+                broken = True
+        item.last_used = time.time()
+        with self._cond:
+            self._in_use -= 1
+            keep = not broken and not self._closed and len(self._idle) < self.pool_size
+            if keep:
+                self._idle.append(item)
+            self._cond.notify()
+        if not keep:
+            self._close(item)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            self._cond.notify_all()
+        for item in idle:
+            self._close(item)
+
+    def evict_idle(self, now: float):
+        expired = []
+        with self._cond:
+            keep = []
+            for item in self._idle:
+                (expired if now - item.last_used > settings.DS_POOL_IDLE_TIMEOUT else keep).append(item)
+            self._idle = keep
+        for item in expired:
+            self._close(item)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"ds_id": self.ds_id, "max_size": self.max_size, "idle": len(self._idle),
+                    "in_use": self._in_use, **self._stats}
+
+    def _is_usable(self, item: PooledConnection) -> bool:
+        now = time.time()
+        if self.recycle and 0 < self.recycle < now - item.created_at:
+            return False
+        if now - item.last_used > settings.DS_POOL_IDLE_TIMEOUT:
+            return False
+        if not settings.DS_POOL_PRE_PING:
+            return True
+        try:
+            cursor = item.conn.cursor()
+            try:
+                cursor.execute(self.ping_sql)
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            return True
+        except Exception as e:
+            SQLBotLogUtil.info(f"Datasource {self.ds_id} pooled connection is invalid: {e}")
+            return False
+
+    def _release_slot(self):
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify()
+
+    def _close(self, item: PooledConnection):
+        self._stats["discarded"] += 1
+        try:
+            item.conn.close()
+        except Exception:
+            pass
+
+
+class DsDriverPool:
+    """
+    Registry of native driver connection pools, keyed by source kind and datasource id.
+    A pool is rebuilt when the configuration hash of its datasource changes.
+    """
+
+    _last_sweep: float = 0.0
+    _sweep_interval: int = 60
+
+    @staticmethod
+    @contextmanager
+    def connect(ds, creator: Callable[[], Any], pool_size: int, max_overflow: int, recycle: int,
+                ping_sql: str = 'select 1'):
+        # unsaved datasource (connection test from the form) or pooling disabled, use a throwaway connection
+        if ds.id is None or not settings.DS_POOL_ENABLED:
+            conn = creator()
+            try:
+                yield conn
+            finally:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            return
+
+        pool = DsDriverPool._get_pool(ds, creator, pool_size, max_overflow, recycle, ping_sql)
+        item = pool.checkout()
+        broken = False
+        try:
+            yield item.conn
+        except BaseException as e:
+            # driver level errors usually mean the connection can not be trusted any more
+            broken = not isinstance(e, Exception) or is_disconnect(e)
+            raise
+        finally:
+            pool.checkin(item, broken)
+
+    @staticmethod
+    def invalidate(ds_id: int):
+        with _lock:
+            pool = _pools.pop(('core', ds_id), None)
+        if pool is not None:
+            pool.close()
+            SQLBotLogUtil.info(f"Datasource {ds_id} connection pool closed")
+
+    @staticmethod
+    def clear():
+        with _lock:
+            pools = list(_pools.values())
+            _pools.clear()
+        for pool in pools:
+            pool.close()
+
+    @staticmethod
+    def stats() -> list[dict]:
+        return [{"kind": key[0], **pool.stats()} for key, pool in list(_pools.items())]
+
+    @staticmethod
+    def _get_pool(ds, creator, pool_size, max_overflow, recycle, ping_sql) -> DriverConnectionPool:
+        key = get_ds_key(ds)
+        conf_hash = get_conf_hash(ds)
+        DsDriverPool._sweep(time.time())
+        pool = _pools.get(key)
+        if pool is not None and pool.conf_hash == conf_hash:
+            return pool
+        old_pool: Optional[DriverConnectionPool] = None
+        with _lock:
+            pool = _pools.get(key)
+            if pool is None or pool.conf_hash != conf_hash:
+                # configuration changed, the old pool is no longer valid
+                old_pool = pool
+                pool = DriverConnectionPool(ds.id, conf_hash, creator, pool_size, max_overflow, recycle, ping_sql)
+                _pools[key] = pool
+        if old_pool is not None:
+            old_pool.close()
+        return pool
+
+    @staticmethod
+    def _sweep(now: float):
+        if now - DsDriverPool._last_sweep < DsDriverPool._sweep_interval:
+            return
+        DsDriverPool._last_sweep = now
+        expired = []
+        with _lock:
+            for key, pool in list(_pools.items()):
+                pool.evict_idle(now)
+                if now - pool.last_used > settings.DS_POOL_IDLE_TIMEOUT and pool.stats()["in_use"] == 0:
+                    expired.append(_pools.pop(key))
+        for pool in expired:
+            pool.close()
+
+
+def is_disconnect(e: BaseException) -> bool:
+    """
+    Whether the error means the connection was lost, so the statement can run again on a new one.
+    Timeouts and cancelled statements are not, running them again would only double the wait.
+    """
+    # exec_sql wraps driver errors, the original one is at the end of the chain
+    chain = []
+    while e is not None and len(chain) < 10:
+        chain.append(e)
+        e = e.__cause__ or e.__context__
+    for item in chain:
+        if isinstance(item, DBAPIError):
+            # the dialect has already checked the driver error codes
+            return bool(item.connection_invalidated) and not _is_timeout(item.orig)
+    return bool(chain) and not _is_timeout(chain[-1]) and _is_driver_disconnect(chain[-1])
+
+
+def _is_timeout(e: BaseException) -> bool:
+    if getattr(e, 'pgcode', None) == '57014':
+        return True
+    code = e.args[0] if e.args else None
+    if isinstance(code, int) and code in _MYSQL_INTERRUPT_CODES:
+        return True
+    message = str(e).lower()
+    return any(m in message for m in _TIMEOUT_MESSAGES)
+
+
+def _is_driver_disconnect(e: BaseException) -> bool:
+    # psycopg2 (kingbase): connection exception class 08, or the server shutting the backend down
+    pgcode = getattr(e, 'pgcode', None)
+    if pgcode:
+        return pgcode.startswith('08') or pgcode in ('57P01', '57P02', '57P03')
+    # pymysql (doris, starrocks): client errors of a lost connection, (0, '') once the socket is closed
+    code = e.args[0] if e.args else None
+    if isinstance(code, int) and type(e).__module__.startswith('pymysql'):
+        return code in _MYSQL_DISCONNECT_CODES or (code == 0 and type(e).__name__ == 'InterfaceError')
+    message = str(e).lower()
+    return any(m in message for m in _DISCONNECT_MESSAGES)
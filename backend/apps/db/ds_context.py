@@ -0,0 +1,94 @@
+from typing import Optional, Any
+
+from sqlalchemy import Connection, text
+
+from apps.datasource.models.datasource import CoreDatasource
+from apps.db.columnar import ColumnarResult
+from apps.db.db import get_ds_connection, query_sql, check_connection, cancel_query
+from apps.db.driver_pool import is_disconnect
+from apps.system.crud.assistant import get_out_ds_conf
+from apps.system.schemas.system_schema import AssistantOutDsSchema
+from common.core.config import settings
+from common.error import TaskCancelledError
+from common.utils.utils import SQLBotLogUtil, equals_ignore_case
+
+
+class DatasourceContext:
+    """
+    Datasource of one chat turn: the configuration is resolved once, the connection check gives its
+    connection back to the pool right away and query_sql only holds one while the sql runs, so the pool
+    is not taken up while the sql is generated.
+    """
+
+    def __init__(self, ds: CoreDatasource | AssistantOutDsSchema):
+        self.ds = ds
+        if isinstance(ds, AssistantOutDsSchema):
+            ds.configuration = get_out_ds_conf(ds, 30)
+        self._connection: Any = None
+        self._cancelled = False
+
+    def check_connection(self) -> bool:
+        if equals_ignore_case(self.ds.type, 'es'):
+            return check_connection(trans=None, ds=self.ds)
+        try:
+            with get_ds_connection(self.ds) as connection:
+                # a new connection has just connected and a pooled one is pinged on checkout with pre ping,
+                # the checkout already is the check
+                if settings.DS_POOL_ENABLED and not settings.DS_POOL_PRE_PING:
+                    self._ping(connection)
+            return True
+        except Exception as e:
+            SQLBotLogUtil.error(f"Datasource {self.ds.id} connection failed: {e}")
+            return False
+
+    def query_sql(self, sql: str, origin_column=False, max_rows: Optional[int] = None) -> ColumnarResult:
+        try:
+            return self._query(sql, origin_column, max_rows)
+        except Exception as e:
+            if self._cancelled:
+                raise TaskCancelledError(f"Datasource {self.ds.id} query cancelled") from e
+            if not is_disconnect(e):
+                raise e
+            # the pooled connection may have been dropped by the server since it was last used
+            SQLBotLogUtil.info(f"Datasource {self.ds.id} connection lost, retry with a new one: {e}")
+            return self._query(sql, origin_column, max_rows)
+
+    def cancel(self):
+        """Stop the query running on the checked out connection, called from another thread"""
+        self._cancelled = True
+        connection = self._connection
+        if connection is not None and cancel_query(self.ds, connection):
+            SQLBotLogUtil.info(f"Datasource {self.ds.id} running query cancelled")
+
+    def _query(self, sql: str, origin_column: bool, max_rows: Optional[int]) -> ColumnarResult:
+        self._check_cancelled()
+        if equals_ignore_case(self.ds.type, 'es'):
+            return query_sql(ds=self.ds, sql=sql, origin_column=origin_column, max_rows=max_rows)
+        with get_ds_connection(self.ds) as connection:
+            self._connection = connection
+            try:
+                # cancel may have run between the checks and the checkout, before the connection was known
+                self._check_cancelled()
+                return query_sql(ds=self.ds, sql=sql, origin_column=origin_column, connection=connection,
+                                 max_rows=max_rows)
+            finally:
+                self._connection = None
+
+    def _check_cancelled(self):
+        if self._cancelled:
+            raise TaskCancelledError(f"Datasource {self.ds.id} query cancelled")
+
+    def _ping(self, connection):
+        if isinstance(connection, Connection):
+            connection.execute(text('select 1' if not equals_ignore_case(self.ds.type, 'oracle')
+                                    else 'select 1 from dual')).fetchall()
+            return
+        cursor = connection.cursor()
+        try:
+            if equals_ignore_case(self.ds.type, 'dm'):
+                cursor.execute('select 1', timeout=10)
+            else:
+                cursor.execute('select 1')
+            cursor.fetchall()
+        finally:
+            cursor.close()
@@ -0,0 +1,125 @@
+import hashlib
+import threading
+import time
+from typing import Callable, Optional
+
+from sqlalchemy import Engine
+
+from apps.system.schemas.system_schema import AssistantOutDsSchema
+from common.core.config import settings
+from common.utils.utils import SQLBotLogUtil
+
+_lock = threading.Lock()
+
+# (source kind, datasource id, timeout) -> engine
+_engines: dict[tuple, 'DsEngineEntry'] = {}
+
+_last_sweep: float = 0.0
+_sweep_interval: int = 60
+
+
+class DsEngineEntry:
+    engine: Engine
+    conf_hash: str
+    last_used: float
+
+    def __init__(self, engine: Engine, conf_hash: str):
+        self.engine = engine
+        self.conf_hash = conf_hash
+        self.last_used = time.time()
+
+
+def get_ds_key(ds) -> tuple[str, int]:
+    """Out datasources of the assistants have ids of their own, which may be the same as a datasource id"""
+    return 'out' if isinstance(ds, AssistantOutDsSchema) else 'core', ds.id
+
+
+def get_conf_hash(ds) -> str:
+    if isinstance(ds, AssistantOutDsSchema):
+        # configuration of out datasource is rebuilt per call with different timeouts, hash the connect info only
+        raw = ':'.join(str(v) for v in [ds.type, ds.host, ds.port, ds.user, ds.password, ds.dataBase, ds.db_schema,
+                                         ds.extraParams, ds.mode])
+    else:
+        # configuration is stored encrypted (deterministic), so hashing it avoids a decrypt on every lookup
+        raw = f"{ds.type}:{ds.configuration or ''}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class DsEngineCache:
+    """
+    Pooled SQLAlchemy engines per datasource and connect timeout, the timeout is fixed when the engine is built.
+    An engine is rebuilt when the configuration hash of its datasource changes.
+    """
+
+    @staticmethod
+    def get_engine(ds, builder: Callable[[], Engine], timeout: int = 0) -> Engine:
+        key = (*get_ds_key(ds), timeout)
+        conf_hash = get_conf_hash(ds)
+        now = time.time()
+        DsEngineCache._sweep(now)
+
+        entry = _engines.get(key)
+        if entry is not None and entry.conf_hash == conf_hash:
+            entry.last_used = now
+            return entry.engine
+
+        old_engine: Optional[Engine] = None
+        with _lock:
+            entry = _engines.get(key)
+            if entry is not None and entry.conf_hash == conf_hash:
+                entry.last_used = now
+                return entry.engine
+            if entry is not None:
+                # configuration changed, the old pool is no longer valid
+                old_engine = entry.engine
+            entry = DsEngineEntry(builder(), conf_hash)
+            _engines[key] = entry
+
+        if old_engine is not None:
+            DsEngineCache._dispose(ds.id, old_engine)
+        return entry.engine
+
+    @staticmethod
+    def invalidate(ds_id: int):
+        with _lock:
+            entries = [_engines.pop(key) for key in list(_engines) if key[:2] == ('core', ds_id)]
+        for entry in entries:
+            DsEngineCache._dispose(ds_id, entry.engine)
+
+    @staticmethod
+    def clear():
+        with _lock:
+            entries = list(_engines.items())
+            _engines.clear()
+        for key, entry in entries:
+            DsEngineCache._dispose(key[1], entry.engine)
+
+    @staticmethod
+    def stats() -> list[dict]:
+        return [{"kind": key[0], "ds_id": key[1], "timeout": key[2],
+                 "idle_seconds": round(time.time() - entry.last_used, 1),
+                 "pool": entry.engine.pool.status()} for key, entry in list(_engines.items())]
+
+    @staticmethod
+    def _sweep(now: float):
+        global _last_sweep
+        if now - _last_sweep < _sweep_interval:
+            return
+        expired = []
+        with _lock:
+            if now - _last_sweep < _sweep_interval:
+                return
+            _last_sweep = now
+            for key, entry in list(_engines.items()):
+                if now - entry.last_used > settings.DS_POOL_IDLE_TIMEOUT:
+                    expired.append((key[1], _engines.pop(key)))
+        for ds_id, entry in expired:
+            DsEngineCache._dispose(ds_id, entry.engine)
+
+    @staticmethod
+    def _dispose(ds_id: int, engine: Engine):
+        try:
+            engine.dispose()
+            SQLBotLogUtil.info(f"Datasource {ds_id} engine disposed")
+        except Exception as e:
+            SQLBotLogUtil.error(f"Datasource {ds_id} engine dispose failed: {e}")
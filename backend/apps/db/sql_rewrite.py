@@ -0,0 +1,163 @@
+from typing import Callable, Optional
+
+import sqlglot
+from sqlglot import expressions as exp
+
+from common.utils.utils import equals_ignore_case
+
+
+def get_sqlglot_dialect(ds_type: str) -> Optional[str]:
+    if equals_ignore_case(ds_type, 'mysql', 'doris', 'starrocks'):
+        return 'mysql'
+    if equals_ignore_case(ds_type, 'sqlServer'):
+        return 'tsql'
+    if equals_ignore_case(ds_type, 'pg', 'excel', 'kingbase'):
+        return 'postgres'
+    if equals_ignore_case(ds_type, 'redshift'):
+        return 'redshift'
+    if equals_ignore_case(ds_type, 'ck'):
+        return 'clickhouse'
+    if equals_ignore_case(ds_type, 'oracle', 'dm'):
+        return 'oracle'
+    return None
+
+
+def inject_row_filters(sql: str, filters: list[dict], ds_type: str) -> str:
+    """
+    Apply row permissions to the sql without asking the LLM.
+    Every reference to a filtered table, in joins, subqueries and CTE bodies, is replaced by
+    `(SELECT * FROM table WHERE filter) AS alias`, the alias is kept (or set to the table name), so the rest of
+    the query is untouched. References to a CTE with the same name as a table are left alone.
+
+    :param filters: [{"table": table name, "filter": where condition}], as built by get_row_permission_filters
+    :raises ValueError: the sql or a filter cannot be parsed
+    """
+    dialect = get_sqlglot_dialect(ds_type)
+    conditions: dict[str, exp.Expression] = {}
+    for f in filters:
+        try:
+            condition = exp.condition(f.get('filter'), dialect=dialect)
+        except Exception as e:
+            raise ValueError(f"Parse row permission of table {f.get('table')} error: {e}")
+        name = f.get('table').lower()
+        conditions[name] = exp.and_(conditions[name], condition) if name in conditions else condition
+
+    def filtered(table: exp.Table) -> Optional[exp.Query]:
+        condition = conditions.get(table.name.lower())
+        if condition is None:
+            return None
+        inner = table.copy()
+        inner.set('alias', None)
+        inner.set('pivots', None)
+        return exp.select('*').from_(inner).where(condition.copy())
+
+    return _rewrite_tables(sql, dialect, filtered)
+
+
+def replace_tables(sql: str, replacements: dict[str, str], ds_type: str) -> str:
+    """
+    Replace every reference to a table by its query, `(query) AS alias`, the alias is kept (or set to the
+    table name). Used for the tables of assistant datasources that are defined by a sql.
+
+    :param replacements: table name -> query
+    :raises ValueError: the sql or a query cannot be parsed
+    """
+    dialect = get_sqlglot_dialect(ds_type)
+    queries: dict[str, exp.Query] = {}
+    for name, query in replacements.items():
+        try:
+            parsed = sqlglot.parse_one(query, dialect=dialect)
+        except Exception as e:
+            raise ValueError(f"Parse SQL of table {name} error: {e}")
+        if not isinstance(parsed, exp.Query):
+            raise ValueError(f"SQL of table {name} is not a query")
+        queries[name.lower()] = parsed
+
+    def replaced(table: exp.Table) -> Optional[exp.Query]:
+        query = queries.get(table.name.lower())
+        return query.copy() if query is not None else None
+
+    return _rewrite_tables(sql, dialect, replaced)
+
+
+def _rewrite_tables(sql: str, dialect: Optional[str], build: Callable[[exp.Table], Optional[exp.Query]]) -> str:
+    """Replace the table references for which `build` returns a query with that query as derived table"""
+    try:
+        statements = sqlglot.parse(sql, dialect=dialect)
+    except Exception as e:
+        raise ValueError(f"Parse SQL Error: {e}")
+    statements = [stmt for stmt in statements if stmt is not None]
+    if not statements:
+        raise ValueError("Parse SQL Error")
+
+    result = []
+    for stmt in statements:
+        if not isinstance(stmt, exp.Query):
+            # only queries are rewritten, the tables anything else reads are not known for sure
+            raise ValueError(f"Unsupported SQL statement: {stmt.sql(dialect=dialect)}")
+        # collected first, the inserted queries are not visited again
+        columns = list(stmt.find_all(exp.Column))
+        for table in list(stmt.find_all(exp.Table)):
+            if not isinstance(table.this, exp.Identifier):
+                # table function
+                continue
+            if table.name.lower() in _visible_cte_names(table):
+                continue
+            query = build(table)
+            if query is not None:
+                if not table.args.get('alias'):
+                    _unqualify_columns(columns, table)
+                table.replace(_derived_table(table, query))
+        rewritten = stmt.sql(dialect=dialect)
+        # round trip, a rewrite the dialect can not read back is not sent to the database
+        try:
+            sqlglot.parse_one(rewritten, dialect=dialect)
+        except Exception as e:
+            raise ValueError(f"Rewritten SQL cannot be parsed: {e}")
+        result.append(rewritten)
+    return ';\n'.join(result)
+
+
+def _derived_table(table: exp.Table, query: exp.Query) -> exp.Subquery:
+    alias = table.args.get('alias') or exp.TableAlias(this=table.this.copy())
+    pivots = table.args.get('pivots')
+    subquery = query.subquery()
+    subquery.set('alias', alias.copy())
+    if pivots:
+        subquery.set('pivots', [p.copy() for p in pivots])
+    return subquery
+
+
+def _unqualify_columns(columns: list[exp.Column], table: exp.Table):
+    """
+    Drop the schema and catalog of the columns written as `schema.table.col`, the derived table that replaces
+    the table is only known by its alias, the table name
+    """
+    name, db = table.name.lower(), table.db.lower()
+    for column in columns:
+        if not column.args.get('db') or column.table.lower() != name:
+            continue
+        if db and column.db.lower() != db:
+            continue
+        column.set('db', None)
+        column.set('catalog', None)
+
+
+def _visible_cte_names(table: exp.Table) -> set[str]:
+    """Names of the CTEs the table reference can see, a CTE body only sees the CTEs defined before it"""
+    names = set()
+    child, node = table, table.parent
+    while node is not None:
+        if isinstance(node, exp.With):
+            ctes = node.expressions
+            index = next((i for i, cte in enumerate(ctes) if cte is child), len(ctes))
+            visible = ctes[:index + 1] if node.args.get('recursive') else ctes[:index]
+            names.update(cte.alias_or_name.lower() for cte in visible)
+            # the query owning this WITH is already handled
+            child, node = node.parent, node.parent.parent if node.parent is not None else None
+            continue
+        with_ = node.args.get('with_')
+        if isinstance(with_, exp.With) and child is not with_:
+            names.update(cte.alias_or_name.lower() for cte in with_.expressions)
+        child, node = node, node.parent
+    return names
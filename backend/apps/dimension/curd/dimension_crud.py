@@ -7,6 +7,8 @@ from typing import List, Optional
 from fastapi import HTTPException
 from sqlalchemy import and_, select, func, delete, update
 
+from apps.datasource.utils.schema_cache import DsSchemaCache
+from apps.datasource.utils.schema_render import SchemaFragmentCache
 from common.core.config import settings
 from common.core.deps import SessionDep, Trans
 from ..models.dimension_model import DimensionValue, DimensionValueInfo, DimensionValueResponse, DimensionValueQuery
@@ -227,6 +229,9 @@ def update_dimension(
 
     session.add(dimension)
     session.commit()
+    # 表结构中字段的示例值来自维度值
+    SchemaFragmentCache.invalidate_dimension(dimension.id)
+    DsSchemaCache.invalidate_all()
 
     return dimension.id
 
@@ -263,6 +268,8 @@ def delete_dimension(session: SessionDep, trans: Trans, oid: int, dimension_id:
 
     session.delete(dimension)
     session.commit()
+    SchemaFragmentCache.invalidate_dimension(dimension_id)
+    DsSchemaCache.invalidate_all()
 
     return True
 
@@ -2,11 +2,18 @@ import os
 from http.client import HTTPException
 
 from fastapi import APIRouter
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 
+from apps.ai_model.embedding import EmbeddingModelCache, EmbeddingService, QueryEmbeddingCache
+from apps.chat.curd.chat import get_token_usage_stats
 from apps.swagger.i18n import PLACEHOLDER_PREFIX
+from apps.system.schemas.permission import SqlbotPermission, require_permissions
 from common.core.config import settings
+from common.core.deps import SessionDep
 from common.core.file import FileRequest
+from common.utils.embedding_backfill import EmbeddingBackfill
+from common.utils.embedding_threads import start_embedding_backfill, warm_up_embedding_model
+from common.utils.task_scheduler import TaskScheduler
 
 router = APIRouter(tags=["System"], prefix="/system")
 
@@ -38,3 +45,80 @@ async def download_excel(req: FileRequest):
         filename=filename,
         media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     )
+
+
+@router.get("/scheduler/stats", include_in_schema=False)
+@require_permissions(permission=SqlbotPermission(role=['admin']))
+async def scheduler_stats():
+    """
+    后台任务队列的排队数、等待时间等指标
+    """
+    return TaskScheduler.stats()
+
+
+@router.get("/llm/token/stats", include_in_schema=False)
+@require_permissions(permission=SqlbotPermission(role=['admin']))
+async def llm_token_stats(session: SessionDep, days: int = 7):
+    """
+    最近 days 天大模型调用的输入 token 中命中模型服务前缀缓存与未命中的数量
+    """
+    return get_token_usage_stats(session, days)
+
+
+@router.get("/embedding/cache/stats", include_in_schema=False)
+@require_permissions(permission=SqlbotPermission(role=['admin']))
+async def embedding_cache_stats():
+    """
+    问题向量缓存的命中率等指标
+    """
+    return QueryEmbeddingCache.stats()
+
+
+@router.get("/embedding/service/stats", include_in_schema=False)
+@require_permissions(permission=SqlbotPermission(role=['admin']))
+async def embedding_service_stats():
+    """
+    向量化服务的吞吐量、批大小与 p95 延迟
+    """
+    return EmbeddingService.stats()
+
+
+@router.get("/embedding/ready", include_in_schema=False)
+async def embedding_ready():
+    """
+    就绪探针：向量模型加载完成前返回 503，首次调用时在后台加载模型
+    """
+    ready = EmbeddingModelCache.is_ready() or (not settings.EMBEDDING_ENABLED and not settings.TABLE_EMBEDDING_ENABLED)
+    if not ready:
+        warm_up_embedding_model()
+    return JSONResponse(status_code=200 if ready else 503,
+                        content={'ready': ready, 'backfill': EmbeddingBackfill.progress().get('status')})
+
+
+@router.get("/embedding/backfill", include_in_schema=False)
+@require_permissions(permission=SqlbotPermission(role=['admin']))
+async def embedding_backfill_progress():
+    """
+    缺失向量补全任务的进度
+    """
+    return EmbeddingBackfill.progress()
+
+
+@router.post("/embedding/backfill", include_in_schema=False)
+@require_permissions(permission=SqlbotPermission(role=['admin']))
+async def embedding_backfill_start():
+    """
+    立即开始补全缺失向量，从仍未生成向量的数据继续
+    """
+    start_embedding_backfill()
+    return EmbeddingBackfill.progress()
+
+
+@router.post("/embedding/backfill/stop", include_in_schema=False)
+@require_permissions(permission=SqlbotPermission(role=['admin']))
+async def embedding_backfill_stop():
+    """
+    停止补全缺失向量，当前批次完成后退出
+    """
+    EmbeddingBackfill.stop()
+    return EmbeddingBackfill.progress()
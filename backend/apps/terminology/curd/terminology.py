@@ -5,10 +5,11 @@ from typing import List, Optional, Any
 from xml.dom.minidom import parseString
 
 import dicttoxml
-from sqlalchemy import and_, or_, select, func, delete, update, union, text, BigInteger
+from sqlalchemy import and_, or_, select, func, delete, update, text, BigInteger
 from sqlalchemy.orm import aliased
 
-from apps.ai_model.embedding import EmbeddingModelCache
+from apps.ai_model.embedding import EmbeddingService, QueryEmbedding, embed_question
+from apps.ai_model.vector_search import set_hnsw_ef_search
 from apps.datasource.models.datasource import CoreDatasource
 from apps.template.generate_chart.generator import get_base_terminology_template
 from apps.terminology.models.terminology_model import Terminology, TerminologyInfo
@@ -636,23 +637,6 @@ def enable_terminology(session: SessionDep, id: int, enabled: bool, trans: Trans
 # engine = create_engine(str(settings.SQLALCHEMY_DATABASE_URI))
 # session_maker = scoped_session(sessionmaker(bind=engine))
 
-def run_fill_empty_embeddings(session_maker):
-    try:
-        if not settings.EMBEDDING_ENABLED:
-            return
-        session = session_maker()
-        stmt1 = select(Terminology.id).where(and_(Terminology.embedding.is_(None), Terminology.pid.is_(None)))
-        stmt2 = select(Terminology.pid).where(
-            and_(Terminology.embedding.is_(None), Terminology.pid.isnot(None))).distinct()
-        combined_stmt = union(stmt1, stmt2)
-        results = session.execute(combined_stmt).scalars().all()
-        save_embeddings(session_maker, results)
-    except Exception:
-        traceback.print_exc()
-    finally:
-        session_maker.remove()
-
-
 def save_embeddings(session_maker, ids: List[int]):
     if not settings.EMBEDDING_ENABLED:
         return
@@ -665,9 +649,7 @@ def save_embeddings(session_maker, ids: List[int]):
 
         _words_list = [item.word for item in _list]
 
-        model = EmbeddingModelCache.get_model()
-
-        results = model.embed_documents(_words_list)
+        results = EmbeddingService.embed_documents(_words_list)
 
         for index in range(len(results)):
             item = results[index]
@@ -681,38 +663,45 @@ def save_embeddings(session_maker, ids: List[int]):
         session_maker.remove()
 
 
+# filters first, then ORDER BY distance LIMIT so the HNSW index on embedding can be used,
+# the similarity threshold only drops rows from the top k
 embedding_sql = f"""
 SELECT id, pid, word, similarity
 FROM
-(SELECT id, pid, word, oid, specific_ds, datasource_ids, enabled,
-( 1 - (embedding <=> :embedding_array) ) AS similarity
+(SELECT id, pid, word,
+( 1 - (embedding <=> CAST(:embedding_array AS vector)) ) AS similarity
 FROM terminology AS child
-) TEMP
-WHERE similarity > {settings.EMBEDDING_TERMINOLOGY_SIMILARITY} AND oid = :oid AND enabled = true
+WHERE oid = :oid AND enabled = true AND embedding IS NOT NULL
 AND (specific_ds = false OR specific_ds IS NULL)
-ORDER BY similarity DESC
+ORDER BY embedding <=> CAST(:embedding_array AS vector)
 LIMIT {settings.EMBEDDING_TERMINOLOGY_TOP_COUNT}
+) TEMP
+WHERE similarity > {settings.EMBEDDING_TERMINOLOGY_SIMILARITY}
+ORDER BY similarity DESC
 """
 
 embedding_sql_with_datasource = f"""
 SELECT id, pid, word, similarity
 FROM
-(SELECT id, pid, word, oid, specific_ds, datasource_ids, enabled,
-( 1 - (embedding <=> :embedding_array) ) AS similarity
+(SELECT id, pid, word,
+( 1 - (embedding <=> CAST(:embedding_array AS vector)) ) AS similarity
 FROM terminology AS child
-) TEMP
-WHERE similarity > {settings.EMBEDDING_TERMINOLOGY_SIMILARITY} AND oid = :oid AND enabled = true
+WHERE oid = :oid AND enabled = true AND embedding IS NOT NULL
 AND (
     (specific_ds = false OR specific_ds IS NULL)
      OR
     (specific_ds = true AND datasource_ids IS NOT NULL AND datasource_ids @> jsonb_build_array(:datasource))
 )
-ORDER BY similarity DESC
+ORDER BY embedding <=> CAST(:embedding_array AS vector)
 LIMIT {settings.EMBEDDING_TERMINOLOGY_TOP_COUNT}
+) TEMP
+WHERE similarity > {settings.EMBEDDING_TERMINOLOGY_SIMILARITY}
+ORDER BY similarity DESC
 """
 
 
-def select_terminology_by_word(session: SessionDep, word: str, oid: int, datasource: int = None):
+def select_terminology_by_word(session: SessionDep, word: str, oid: int, datasource: int = None,
+                               question_embedding: Optional[QueryEmbedding] = None):
     if word.strip() == "":
         return []
 
@@ -756,9 +745,8 @@ def select_terminology_by_word(session: SessionDep, word: str, oid: int, datasou
     if settings.EMBEDDING_ENABLED:
         with session.begin_nested():
             try:
-                model = EmbeddingModelCache.get_model()
-
-                embedding = model.embed_query(word)
+                embedding = embed_question(word, question_embedding)
+                set_hnsw_ef_search(session)
 
                 if datasource is not None:
                     results = session.execute(text(embedding_sql_with_datasource),
@@ -846,10 +834,11 @@ def to_xml_string(_dict: list[dict] | dict, root: str = 'terminologies') -> str:
 
 
 def get_terminology_template(session: SessionDep, question: str, oid: Optional[int] = 1,
-                             datasource: Optional[int] = None) -> tuple[str, list[dict]]:
+                             datasource: Optional[int] = None,
+                             question_embedding: Optional[QueryEmbedding] = None) -> tuple[str, list[dict]]:
     if not oid:
         oid = 1
-    _results = select_terminology_by_word(session, question, oid, datasource)
+    _results = select_terminology_by_word(session, question, oid, datasource, question_embedding)
     if _results and len(_results) > 0:
         terminology = to_xml_string(_results)
         template = get_base_terminology_template().format(terminologies=terminology)
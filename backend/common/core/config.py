@@ -99,6 +99,10 @@ class Settings(BaseSettings):
 
     LOCAL_MODEL_PATH: str = '/opt/sqlbot/models'
     DEFAULT_EMBEDDING_MODEL: str = 'shibing624/text2vec-base-chinese'
+    # 向量模型推理后端：torch / onnx（需安装 onnx 扩展依赖）
+    EMBEDDING_BACKEND: str = 'torch'
+    # onnx 后端的 int8 动态量化配置：avx2 / avx512 / avx512_vnni / arm64，为空表示不量化
+    EMBEDDING_ONNX_QUANTIZATION: str = ''
     EMBEDDING_ENABLED: bool = True
     EMBEDDING_DEFAULT_SIMILARITY: float = 0.4
     EMBEDDING_TERMINOLOGY_SIMILARITY: float = EMBEDDING_DEFAULT_SIMILARITY
@@ -106,10 +110,31 @@ class Settings(BaseSettings):
     EMBEDDING_DEFAULT_TOP_COUNT: int = 5
     EMBEDDING_TERMINOLOGY_TOP_COUNT: int = EMBEDDING_DEFAULT_TOP_COUNT
     EMBEDDING_DATA_TRAINING_TOP_COUNT: int = EMBEDDING_DEFAULT_TOP_COUNT
+    # 问题向量缓存条数，0 表示不缓存；CACHE_TYPE 为 redis 时同时写入 Redis，过期时间(秒)
+    EMBEDDING_QUERY_CACHE_SIZE: int = 2000
+    EMBEDDING_QUERY_CACHE_EXPIRE: int = 60 * 60 * 24
+    # 向量化微批：每批最多文本条数，问题向量等待凑批的最长时间(毫秒)
+    EMBEDDING_BATCH_SIZE: int = 32
+    EMBEDDING_BATCH_MAX_WAIT_MS: int = 10
+    # 启动时在后台预加载向量模型
+    EMBEDDING_WARM_UP_ON_STARTUP: bool = True
+    # 启动后补全缺失向量：延迟(秒)，每秒最多向量化的条数(0 表示不限速)
+    EMBEDDING_BACKFILL_DELAY: int = 30
+    EMBEDDING_BACKFILL_RATE: int = 50
+    # 向量维度，需与向量模型一致，迁移时据此建立 HNSW 索引
+    EMBEDDING_DIMENSION: int = 768
+    # HNSW 检索的候选集大小，越大召回越高、越慢
+    EMBEDDING_HNSW_EF_SEARCH: int = 100
 
     # 是否启用SQL查询行数限制，默认值，可被参数配置覆盖
     GENERATE_SQL_QUERY_LIMIT_ENABLED: bool = True
     GENERATE_SQL_QUERY_HISTORY_ROUND_COUNT: int = 3
+    # 行权限默认通过解析SQL直接注入，解析失败时是否交给大模型改写
+    ROW_PERMISSION_LLM_FALLBACK: bool = False
+    # 小助手动态数据源的表默认通过解析SQL直接替换为子查询，解析失败时是否交给大模型改写
+    ASSISTANT_DYNAMIC_SQL_LLM_FALLBACK: bool = False
+    # 生成SQL的系统提示词稳定前缀上标记 cache_control，用于需要显式声明缓存的模型服务；openai、vLLM 按前缀自动缓存，无需开启
+    LLM_PROMPT_CACHE_HINT: bool = False
 
     PARSE_REASONING_BLOCK_ENABLED: bool = True
     DEFAULT_REASONING_CONTENT_START: str = '<think>'
@@ -120,18 +145,71 @@ class Settings(BaseSettings):
     PG_POOL_RECYCLE: int = 3600
     PG_POOL_PRE_PING: bool = True
 
+    # 数据源连接池默认值，可在数据源配置中单独覆盖
+    DS_POOL_ENABLED: bool = True
+    DS_POOL_SIZE: int = 5
+    DS_POOL_MAX_OVERFLOW: int = 10
+    DS_POOL_RECYCLE: int = 1800
+    DS_POOL_TIMEOUT: int = 30
+    DS_POOL_PRE_PING: bool = True
+    DS_POOL_IDLE_TIMEOUT: int = 600  # 数据源连接池闲置超过该秒数后释放
+    DS_CONF_CACHE_TTL: int = 300  # 数据源解密配置及版本号缓存时间(秒)
+    # 数据源表、字段、按列权限过滤后的表结构及渲染后的表结构片段缓存时间(秒)，列权限规则及另一进程(mcp)中的修改最迟在此时间后生效，0 为不缓存
+    DS_SCHEMA_CACHE_TTL: int = 60
+    # 查询结果分批拉取，超过行数或大小(MB)上限后截断，可在数据源配置中单独设置
+    DS_QUERY_FETCH_SIZE: int = 1000
+    DS_QUERY_MAX_ROWS: int = 100000
+    DS_QUERY_MAX_RESULT_SIZE: int = 100
+    # 问答结果数据按列分块压缩存储，启动时分批转换历史记录
+    CHAT_RECORD_DATA_CHUNK_ROWS: int = 500
+    CHAT_RECORD_DATA_COMPRESS_LEVEL: int = 6
+    CHAT_RECORD_DATA_CONVERT_ENABLED: bool = True
+    CHAT_RECORD_DATA_CONVERT_BATCH: int = 200
+    # 对话历史随记录返回的数据行数，其余行分页读取，0 为全部
+    CHAT_RECORD_DATA_DISPLAY_ROWS: int = 1000
+    CHAT_STREAM_BUFFER_SIZE: int = 256  # 问答流式输出缓冲的最大块数，超出后生成线程等待
+    # 后台任务队列：工作线程数及最大排队数，排满后拒绝并提示重试
+    TASK_QUEUE_CHAT_WORKERS: int = 100
+    TASK_QUEUE_CHAT_MAX_PENDING: int = 200
+    # 图表与SQL执行并行生成，队列满时退回到查询结束后生成
+    TASK_QUEUE_CHART_WORKERS: int = 100
+    TASK_QUEUE_CHART_MAX_PENDING: int = 0
+    # 提问前的术语、SQL示例、自定义提示词检索并行执行，队列满时在对话线程中依次执行
+    TASK_QUEUE_RETRIEVAL_WORKERS: int = 60
+    TASK_QUEUE_RETRIEVAL_MAX_PENDING: int = 0
+    TASK_QUEUE_ANALYSIS_WORKERS: int = 30
+    TASK_QUEUE_ANALYSIS_MAX_PENDING: int = 60
+    TASK_QUEUE_RECOMMEND_WORKERS: int = 20
+    TASK_QUEUE_RECOMMEND_MAX_PENDING: int = 40
+    TASK_QUEUE_EMBEDDING_WORKERS: int = 4
+    TASK_QUEUE_EMBEDDING_MAX_PENDING: int = 1000
+    TASK_QUEUE_WORKSPACE_SHARE: float = 0.5  # 有其他工作空间排队时，单个工作空间最多占用的线程比例
+    TASK_QUEUE_MAX_RETRY_AFTER: int = 60
+
     TABLE_EMBEDDING_ENABLED: bool = True
     TABLE_EMBEDDING_COUNT: int = 10
+    # 表结构提示词的 token 预算，0 为不限制；超出时优先保留关联字段、问题中提到的字段和相似度高的表的字段
+    TABLE_SCHEMA_TOKEN_BUDGET: int = 0
+    # 表结构使用简写：不带维度示例值，备注截断
+    TABLE_SCHEMA_TERSE: bool = False
     DS_EMBEDDING_COUNT: int = 10
 
     ORACLE_CLIENT_PATH: str = '/opt/sqlbot/db_client/oracle_instant_client'
 
     @field_validator('SQL_DEBUG',
                      'EMBEDDING_ENABLED',
+                     'EMBEDDING_WARM_UP_ON_STARTUP',
                      'GENERATE_SQL_QUERY_LIMIT_ENABLED',
+                     'ROW_PERMISSION_LLM_FALLBACK',
+                     'ASSISTANT_DYNAMIC_SQL_LLM_FALLBACK',
+                     'LLM_PROMPT_CACHE_HINT',
                      'PARSE_REASONING_BLOCK_ENABLED',
                      'PG_POOL_PRE_PING',
+                     'DS_POOL_ENABLED',
+                     'DS_POOL_PRE_PING',
+                     'CHAT_RECORD_DATA_CONVERT_ENABLED',
                      'TABLE_EMBEDDING_ENABLED',
+                     'TABLE_SCHEMA_TERSE',
                      mode='before')
     @classmethod
     def lowercase_bool(cls, v: Any) -> Any:
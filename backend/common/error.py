@@ -17,3 +17,14 @@ class SQLBotDBError(Exception):
 
 class ParseSQLResultError(Exception):
     pass
+
+
+class TaskCancelledError(Exception):
+    pass
+
+
+class TaskRejectedError(Exception):
+    def __init__(self, queue: str, retry_after: int):
+        super().__init__(f"Server is busy ({queue}), please retry after {retry_after} seconds")
+        self.queue = queue
+        self.retry_after = retry_after
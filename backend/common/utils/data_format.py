@@ -79,7 +79,7 @@ class DataFormat:
         return md_data, _fields_list
 
     @staticmethod
-    def convert_data_fields_for_pandas(chart: dict, fields: list, data: list):
+    def get_chart_field_names(chart: dict) -> dict:
         _fields = {}
         if chart.get('columns'):
             for _column in chart.get('columns'):
@@ -103,6 +103,11 @@ class DataFormat:
             if chart.get('axis').get('series'):
                 _fields[chart.get('axis').get('series').get('value')] = chart.get('axis').get('series').get(
                     'name')
+        return _fields
+
+    @staticmethod
+    def convert_data_fields_for_pandas(chart: dict, fields: list, data: list):
+        _fields = DataFormat.get_chart_field_names(chart)
         _column_list = []
         for field in fields:
             _column_list.append(
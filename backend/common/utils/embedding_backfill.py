@@ -0,0 +1,138 @@
+import threading
+import time
+import traceback
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy import and_, func, select, union
+
+from common.core.config import settings
+from common.utils.utils import SQLBotLogUtil
+
+_lock = threading.Lock()
+_stop = threading.Event()
+
+_progress: dict = {'status': 'idle', 'started_at': None, 'finished_at': None, 'stages': {}}
+
+
+class _Stage:
+    def __init__(self, name: str, enabled: Callable[[], bool], pending, model, save: Callable):
+        self.name = name
+        self.enabled = enabled
+        # subquery with an `id` column, the ids still waiting for their embedding
+        self.pending = pending
+        self.model = model
+        self.save = save
+
+
+def _stages() -> list[_Stage]:
+    from apps.data_training.curd.data_training import save_embeddings as save_data_training_embeddings
+    from apps.data_training.models.data_training_model import DataTraining
+    from apps.datasource.crud.table import save_table_embedding, save_ds_embedding
+    from apps.datasource.models.datasource import CoreTable, CoreDatasource
+    from apps.terminology.curd.terminology import save_embeddings as save_terminology_embeddings
+    from apps.terminology.models.terminology_model import Terminology
+
+    # terminology is embedded by its parent id together with the synonyms
+    terminology = union(
+        select(Terminology.id).where(and_(Terminology.embedding.is_(None), Terminology.pid.is_(None))),
+        select(Terminology.pid.label('id')).where(and_(Terminology.embedding.is_(None), Terminology.pid.isnot(None)))
+    ).subquery()
+    return [
+        _Stage('terminology', lambda: settings.EMBEDDING_ENABLED, terminology, Terminology,
+               save_terminology_embeddings),
+        _Stage('data_training', lambda: settings.EMBEDDING_ENABLED,
+               select(DataTraining.id).where(DataTraining.embedding.is_(None)).subquery(), DataTraining,
+               save_data_training_embeddings),
+        _Stage('table', lambda: settings.TABLE_EMBEDDING_ENABLED,
+               select(CoreTable.id).where(CoreTable.embedding.is_(None)).subquery(), CoreTable,
+               save_table_embedding),
+        _Stage('datasource', lambda: settings.TABLE_EMBEDDING_ENABLED,
+               select(CoreDatasource.id).where(CoreDatasource.embedding.is_(None)).subquery(), CoreDatasource,
+               save_ds_embedding),
+    ]
+
+
+class EmbeddingBackfill:
+    """
+    Fill the embeddings missing for terminology, data training, tables and datasources in the background.
+    Ids are read in id order, one EMBEDDING_BATCH_SIZE batch at a time, and every batch is committed before the
+    next one, so a stopped or interrupted run resumes from the rows that are still empty.
+    At most EMBEDDING_BACKFILL_RATE rows are embedded per second, leaving the model to the questions of users.
+    """
+
+    @staticmethod
+    def run(session_maker):
+        with _lock:
+            if _progress['status'] == 'running':
+                return
+            _stop.clear()
+            _progress.update(status='running', started_at=datetime.now().isoformat(), finished_at=None, stages={})
+
+        SQLBotLogUtil.info('start embedding backfill')
+        status = 'finished'
+        try:
+            for stage in _stages():
+                if _stop.is_set():
+                    break
+                if stage.enabled():
+                    EmbeddingBackfill._run_stage(session_maker, stage)
+            if _stop.is_set():
+                status = 'stopped'
+        except Exception:
+            traceback.print_exc()
+            status = 'error'
+        finally:
+            session_maker.remove()
+            with _lock:
+                _progress.update(status=status, finished_at=datetime.now().isoformat())
+            SQLBotLogUtil.info(f'embedding backfill {status}: {_progress["stages"]}')
+
+    @staticmethod
+    def stop():
+        _stop.set()
+
+    @staticmethod
+    def progress() -> dict:
+        with _lock:
+            return {**_progress, 'stages': {name: dict(stage) for name, stage in _progress['stages'].items()}}
+
+    @staticmethod
+    def _run_stage(session_maker, stage: _Stage):
+        session = session_maker()
+        total = session.execute(select(func.count()).select_from(stage.pending)).scalar()
+        progress = {'total': total, 'done': 0, 'failed': 0, 'last_id': None}
+        with _lock:
+            _progress['stages'][stage.name] = progress
+        if not total:
+            return
+
+        batch_size = max(settings.EMBEDDING_BATCH_SIZE, 1)
+        last_id = None
+        while not _stop.is_set():
+            start = time.monotonic()
+            session = session_maker()
+            stmt = select(stage.pending.c.id).order_by(stage.pending.c.id).limit(batch_size)
+            if last_id is not None:
+                # rows that failed stay empty, the cursor keeps them from being retried in this run
+                stmt = stmt.where(stage.pending.c.id > last_id)
+            ids = session.execute(stmt).scalars().all()
+            if not ids:
+                break
+
+            # the save functions commit, log their own errors and release the session
+            stage.save(session_maker, ids)
+
+            session = session_maker()
+            failed = session.execute(select(func.count()).select_from(stage.model).where(
+                and_(stage.model.id.in_(ids), stage.model.embedding.is_(None)))).scalar()
+            last_id = ids[-1]
+            with _lock:
+                progress['done'] += len(ids) - failed
+                progress['failed'] += failed
+                progress['last_id'] = last_id
+
+            if settings.EMBEDDING_BACKFILL_RATE > 0:
+                wait = len(ids) / settings.EMBEDDING_BACKFILL_RATE - (time.monotonic() - start)
+                if wait > 0:
+                    _stop.wait(wait)
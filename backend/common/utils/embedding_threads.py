@@ -1,11 +1,13 @@
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import traceback
 from typing import List
 
 from sqlalchemy.orm import sessionmaker, scoped_session
 
-executor = ThreadPoolExecutor(max_workers=200)
-
 from common.core.db import engine
+from common.error import TaskRejectedError
+from common.utils.task_scheduler import TaskScheduler, QUEUE_EMBEDDING
+from common.utils.utils import SQLBotLogUtil
 
 session_maker = scoped_session(sessionmaker(bind=engine))
 
@@ -13,36 +15,68 @@ session_maker = scoped_session(sessionmaker(bind=engine))
 # session = session_maker()
 
 
-def run_save_terminology_embeddings(ids: List[int]):
-    from apps.terminology.curd.terminology import save_embeddings
-    executor.submit(save_embeddings, session_maker, ids)
+def submit(fn, *args) -> bool:
+    try:
+        TaskScheduler.submit(QUEUE_EMBEDDING, fn, *args)
+        return True
+    except TaskRejectedError as e:
+        # 未生成的向量会在下次启动时补全
+        SQLBotLogUtil.warning(f"Embedding task {fn.__name__} skipped: {e}")
+        return False
 
 
-def fill_empty_terminology_embeddings():
-    from apps.terminology.curd.terminology import run_fill_empty_embeddings
-    executor.submit(run_fill_empty_embeddings, session_maker)
+def run_save_terminology_embeddings(ids: List[int]):
+    from apps.terminology.curd.terminology import save_embeddings
+    submit(save_embeddings, session_maker, ids)
 
 
 def run_save_data_training_embeddings(ids: List[int]):
     from apps.data_training.curd.data_training import save_embeddings
-    executor.submit(save_embeddings, session_maker, ids)
-
-
-def fill_empty_data_training_embeddings():
-    from apps.data_training.curd.data_training import run_fill_empty_embeddings
-    executor.submit(run_fill_empty_embeddings, session_maker)
+    submit(save_embeddings, session_maker, ids)
 
 
 def run_save_table_embeddings(ids: List[int]):
     from apps.datasource.crud.table import save_table_embedding
-    executor.submit(save_table_embedding, session_maker, ids)
+    submit(save_table_embedding, session_maker, ids)
 
 
 def run_save_ds_embeddings(ids: List[int]):
     from apps.datasource.crud.table import save_ds_embedding
-    executor.submit(save_ds_embedding, session_maker, ids)
+    submit(save_ds_embedding, session_maker, ids)
+
+
+def start_embedding_backfill(delay: int = 0):
+    from common.utils.embedding_backfill import EmbeddingBackfill
+    if delay <= 0:
+        submit(EmbeddingBackfill.run, session_maker)
+        return
+    # 启动后延迟执行，不与首批请求争抢向量模型
+    timer = threading.Timer(delay, submit, (EmbeddingBackfill.run, session_maker))
+    timer.daemon = True
+    timer.start()
+
+
+_warm_up_submitted = threading.Event()
+
+
+def warm_up_embedding_model():
+    if _warm_up_submitted.is_set():
+        return
+    _warm_up_submitted.set()
+    if not submit(run_warm_up):
+        _warm_up_submitted.clear()
+
+
+def run_warm_up():
+    from apps.ai_model.embedding import EmbeddingModelCache
+    try:
+        EmbeddingModelCache.warm_up()
+    except Exception:
+        traceback.print_exc()
+        # 加载失败时允许再次预加载
+        _warm_up_submitted.clear()
 
 
-def fill_empty_table_and_ds_embeddings():
-    from apps.datasource.crud.table import run_fill_empty_table_and_ds_embedding
-    executor.submit(run_fill_empty_table_and_ds_embedding, session_maker)
+def fill_chat_record_data_blocks():
+    from apps.chat.curd.record_data import run_convert_record_data
+    submit(run_convert_record_data, session_maker)
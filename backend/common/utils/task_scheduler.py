@@ -0,0 +1,218 @@
+import math
+import threading
+import time
+from collections import deque, defaultdict
+from concurrent.futures import Future
+from typing import Callable, Any, Optional
+
+from common.core.config import settings
+from common.error import TaskRejectedError
+from common.utils.utils import SQLBotLogUtil
+
+# 队列名称
+QUEUE_CHAT = 'chat'
+QUEUE_CHART = 'chart'
+QUEUE_RETRIEVAL = 'retrieval'
+QUEUE_ANALYSIS = 'analysis'
+QUEUE_RECOMMEND = 'recommend'
+QUEUE_EMBEDDING = 'embedding'
+
+DEFAULT_WORKSPACE = 'system'
+
+# 还没有完成的任务时，按该耗时(秒)估算重试等待时间
+_DEFAULT_RUN_TIME = 5
+
+
+class _Task:
+    __slots__ = ('fn', 'args', 'kwargs', 'future', 'workspace', 'submitted_at')
+
+    def __init__(self, fn: Callable, args: tuple, kwargs: dict, workspace: str):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.workspace = workspace
+        self.submitted_at = time.time()
+
+
+class TaskQueue:
+    """
+    One named queue with a fixed number of worker threads and a bounded backlog.
+    Waiting tasks are kept per workspace and picked round robin, a workspace only runs more than its share
+    of the workers while no other workspace is waiting.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_pending: int, workspace_share: float):
+        self.name = name
+        self.max_workers = max(max_workers, 1)
+        self.max_pending = max(max_pending, 0)
+        self.workspace_running_limit = max(1, math.ceil(self.max_workers * workspace_share))
+        self.workspace_pending_limit = max(1, math.ceil(self.max_pending * workspace_share))
+        self._cond = threading.Condition()
+        self._pending: dict[str, deque[_Task]] = defaultdict(deque)
+        self._order: deque[str] = deque()
+        self._pending_count = 0
+        self._running: dict[str, int] = defaultdict(int)
+        self._running_count = 0
+        self._threads = 0
+        self._idle = 0
+        self._stats = {'submitted': 0, 'rejected': 0, 'completed': 0, 'failed': 0,
+                       'wait_time': 0.0, 'max_wait_time': 0.0, 'run_time': 0.0}
+
+    def submit(self, workspace: str, fn: Callable, *args, **kwargs) -> Future:
+        task = _Task(fn, args, kwargs, workspace)
+        with self._cond:
+            waiting = len(self._pending.get(workspace, ()))
+            # 只有没有空闲线程时任务才需要排队
+            busy = self._running_count + self._pending_count >= self.max_workers
+            if self._running_count + self._pending_count >= self.max_workers + self.max_pending \
+                    or busy and waiting >= self.workspace_pending_limit:
+                self._stats['rejected'] += 1
+                retry_after = self._retry_after()
+                SQLBotLogUtil.warning(f"Task queue {self.name} is saturated, workspace {workspace} rejected, "
+                                      f"pending {self._pending_count}, running {self._running_count}")
+                raise TaskRejectedError(self.name, retry_after)
+            if not waiting:
+                self._order.append(workspace)
+            self._pending[workspace].append(task)
+            self._pending_count += 1
+            self._stats['submitted'] += 1
+            if self._idle < self._pending_count and self._threads < self.max_workers:
+                self._threads += 1
+                threading.Thread(target=self._work, name=f'sqlbot-{self.name}-{self._threads}', daemon=True).start()
+            else:
+                self._cond.notify()
+        return task.future
+
+    def stats(self) -> dict:
+        with self._cond:
+            finished = self._stats['completed'] + self._stats['failed']
+            started = finished + self._running_count
+            oldest = min((tasks[0].submitted_at for tasks in self._pending.values() if tasks), default=None)
+            return {
+                'queue': self.name,
+                'max_workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'threads': self._threads,
+                'running': self._running_count,
+                'pending': self._pending_count,
+                'pending_by_workspace': {ws: len(tasks) for ws, tasks in self._pending.items() if tasks},
+                'running_by_workspace': {ws: count for ws, count in self._running.items() if count},
+                'oldest_wait_time': round(time.time() - oldest, 3) if oldest else 0,
+                'avg_wait_time': round(self._stats['wait_time'] / started, 3) if started else 0,
+                'max_wait_time': round(self._stats['max_wait_time'], 3),
+                'avg_run_time': round(self._stats['run_time'] / finished, 3) if finished else 0,
+                'submitted': self._stats['submitted'],
+                'rejected': self._stats['rejected'],
+                'completed': self._stats['completed'],
+                'failed': self._stats['failed'],
+            }
+
+    def _retry_after(self) -> int:
+        finished = self._stats['completed'] + self._stats['failed']
+        avg_run = self._stats['run_time'] / finished if finished else _DEFAULT_RUN_TIME
+        # 估算排在前面的任务全部开始所需的时间
+        seconds = avg_run * (self._pending_count + 1) / self.max_workers
+        return int(min(max(math.ceil(seconds), 1), settings.TASK_QUEUE_MAX_RETRY_AFTER))
+
+    def _next_task(self) -> Optional[_Task]:
+        # 轮询各工作空间，优先选择未超出份额的
+        fallback = None
+        for _ in range(len(self._order)):
+            workspace = self._order[0]
+            self._order.rotate(-1)
+            if self._running.get(workspace, 0) < self.workspace_running_limit:
+                return self._pop(workspace)
+            if fallback is None:
+                fallback = workspace
+        return self._pop(fallback) if fallback is not None else None
+
+    def _pop(self, workspace: str) -> _Task:
+        tasks = self._pending[workspace]
+        task = tasks.popleft()
+        if not tasks:
+            del self._pending[workspace]
+            self._order.remove(workspace)
+        self._pending_count -= 1
+        return task
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+                    task = self._next_task()
+                self._running[task.workspace] += 1
+                self._running_count += 1
+                wait_time = time.time() - task.submitted_at
+                self._stats['wait_time'] += wait_time
+                self._stats['max_wait_time'] = max(self._stats['max_wait_time'], wait_time)
+
+            started = time.time()
+            failed = False
+            if task.future.set_running_or_notify_cancel():
+                try:
+                    task.future.set_result(task.fn(*task.args, **task.kwargs))
+                except BaseException as e:
+                    failed = True
+                    task.future.set_exception(e)
+                    SQLBotLogUtil.error(f"Task in queue {self.name} failed: {e}")
+
+            with self._cond:
+                self._running[task.workspace] -= 1
+                if not self._running[task.workspace]:
+                    del self._running[task.workspace]
+                self._running_count -= 1
+                self._stats['run_time'] += time.time() - started
+                self._stats['failed' if failed else 'completed'] += 1
+
+
+class TaskScheduler:
+    """Shared scheduler of the background work, every kind of work has its own bounded queue."""
+
+    _queues: dict[str, TaskQueue] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def submit(queue: str, fn: Callable, *args, workspace: Any = None, **kwargs) -> Future:
+        """
+        :raises TaskRejectedError: the queue is saturated, `retry_after` tells when to try again
+        """
+        workspace = str(workspace) if workspace is not None else DEFAULT_WORKSPACE
+        return TaskScheduler.get_queue(queue).submit(workspace, fn, *args, **kwargs)
+
+    @staticmethod
+    def get_queue(name: str) -> TaskQueue:
+        queue = TaskScheduler._queues.get(name)
+        if queue is not None:
+            return queue
+        with TaskScheduler._lock:
+            queue = TaskScheduler._queues.get(name)
+            if queue is None:
+                max_workers, max_pending = _queue_config(name)
+                queue = TaskQueue(name, max_workers, max_pending, settings.TASK_QUEUE_WORKSPACE_SHARE)
+                TaskScheduler._queues[name] = queue
+        return queue
+
+    @staticmethod
+    def stats() -> list[dict]:
+        return [queue.stats() for queue in list(TaskScheduler._queues.values())]
+
+
+def _queue_config(name: str) -> tuple[int, int]:
+    if name == QUEUE_CHAT:
+        return settings.TASK_QUEUE_CHAT_WORKERS, settings.TASK_QUEUE_CHAT_MAX_PENDING
+    if name == QUEUE_CHART:
+        return settings.TASK_QUEUE_CHART_WORKERS, settings.TASK_QUEUE_CHART_MAX_PENDING
+    if name == QUEUE_RETRIEVAL:
+        return settings.TASK_QUEUE_RETRIEVAL_WORKERS, settings.TASK_QUEUE_RETRIEVAL_MAX_PENDING
+    if name == QUEUE_ANALYSIS:
+        return settings.TASK_QUEUE_ANALYSIS_WORKERS, settings.TASK_QUEUE_ANALYSIS_MAX_PENDING
+    if name == QUEUE_RECOMMEND:
+        return settings.TASK_QUEUE_RECOMMEND_WORKERS, settings.TASK_QUEUE_RECOMMEND_MAX_PENDING
+    if name == QUEUE_EMBEDDING:
+        return settings.TASK_QUEUE_EMBEDDING_WORKERS, settings.TASK_QUEUE_EMBEDDING_MAX_PENDING
+    raise ValueError(f'Unknown task queue: {name}')
@@ -17,6 +17,8 @@ from alembic import command
 from apps.api import api_router
 from apps.swagger.i18n import PLACEHOLDER_PREFIX, tags_metadata, i18n_list
 from apps.swagger.i18n import get_translation, DEFAULT_LANG
+from apps.db.driver_pool import DsDriverPool
+from apps.db.engine_cache import DsEngineCache
 from apps.system.crud.aimodel_manage import async_model_info
 from apps.system.crud.assistant import init_dynamic_cors
 from apps.system.middleware.auth import TokenMiddleware
@@ -25,8 +27,8 @@ from common.audit.schemas.request_context import RequestContextMiddlewareCommon
 from common.core.config import settings
 from common.core.response_middleware import ResponseMiddleware, exception_handler
 from common.core.sqlbot_cache import init_sqlbot_cache
-from common.utils.embedding_threads import fill_empty_terminology_embeddings, fill_empty_data_training_embeddings, \
-    fill_empty_table_and_ds_embeddings
+from common.utils.embedding_threads import start_embedding_backfill, warm_up_embedding_model, \
+    fill_chat_record_data_blocks
 from common.utils.utils import SQLBotLogUtil
 
 
@@ -35,16 +37,12 @@ def run_migrations():
     command.upgrade(alembic_cfg, "head")
 
 
-def init_terminology_embedding_data():
-    fill_empty_terminology_embeddings()
-
-
-def init_data_training_embedding_data():
-    fill_empty_data_training_embeddings()
-
-
-def init_table_and_ds_embedding():
-    fill_empty_table_and_ds_embeddings()
+def init_embedding():
+    if not settings.EMBEDDING_ENABLED and not settings.TABLE_EMBEDDING_ENABLED:
+        return
+    if settings.EMBEDDING_WARM_UP_ON_STARTUP:
+        warm_up_embedding_model()
+    start_embedding_backfill(settings.EMBEDDING_BACKFILL_DELAY)
 
 
 @asynccontextmanager
@@ -52,14 +50,15 @@ async def lifespan(app: FastAPI):
     run_migrations()
     init_sqlbot_cache()
     init_dynamic_cors(app)
-    init_terminology_embedding_data()
-    init_data_training_embedding_data()
-    init_table_and_ds_embedding()
+    init_embedding()
+    fill_chat_record_data_blocks()
     SQLBotLogUtil.info("✅ SQLBot 初始化完成")
     await sqlbot_xpack.core.clean_xpack_cache()
     await async_model_info()  # 异步加密已有模型的密钥和地址
     await sqlbot_xpack.core.monitor_app(app)
     yield
+    DsEngineCache.clear()
+    DsDriverPool.clear()
     SQLBotLogUtil.info("SQLBot 应用关闭")
 
 
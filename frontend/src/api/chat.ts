@@ -447,8 +447,8 @@ export const chatApi = {
   get_with_Data: (id: number): Promise<ChatInfo> => {
     return request.get(`/chat/${id}/with_data`)
   },
-  get_chart_data: (record_id?: number): Promise<any> => {
-    return request.get(`/chat/record/${record_id}/data`)
+  get_chart_data: (record_id?: number, offset?: number, limit?: number): Promise<any> => {
+    return request.get(`/chat/record/${record_id}/data`, { params: { offset, limit } })
   },
   get_chart_predict_data: (record_id?: number): Promise<any> => {
     return request.get(`/chat/record/${record_id}/predict_data`)
@@ -0,0 +1,99 @@
+"""
+向量模型推理后端对比：torch vs onnx vs onnx int8 量化
+以库中的术语与数据训练问题为语料（--sample 时使用内置样例），检查与 torch 结果的一致性并统计吞吐量:
+    cd backend
+    python ../tools/bench-scripts/bench_embedding_backend.py --quantization avx2
+一致性指标：
+    cosine   同一文本在两个后端下向量的余弦相似度（平均 / 最小）
+    recall@k 以语料中每条文本为问题，按相似度取 top-k，与 torch 结果的重合率
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'backend'))
+
+from apps.ai_model.embedding import EmbeddingModelCache, EmbeddingModelInfo  # noqa: E402
+from apps.datasource.embedding.utils import normalize_rows, top_k_indices  # noqa: E402
+from common.core.config import settings  # noqa: E402
+
+SAMPLE = ['销售额', '毛利率', '客单价', '复购率', '月活跃用户', '上个月华东地区的销售额是多少',
+          '统计每个产品类别的退货数量', '今年每个月的新增客户数', '库存周转天数最高的十个商品',
+          '各渠道订单金额同比增长', 'GMV', 'DAU', '按地区统计订单数量', '最近一周的日均访问量']
+
+
+def load_corpus(limit: int) -> list[str]:
+    from sqlmodel import Session
+
+    from apps.data_training.models.data_training_model import DataTraining
+    from apps.terminology.models.terminology_model import Terminology
+    from common.core.db import engine
+
+    with Session(engine) as session:
+        words = [w for (w,) in session.query(Terminology.word).limit(limit).all() if w]
+        questions = [q for (q,) in session.query(DataTraining.question).limit(limit).all() if q]
+    return words + questions
+
+
+def encode(model, texts: list[str], batch_size: int) -> tuple[np.ndarray, float]:
+    model.embed_documents(texts[:batch_size])
+    start = time.perf_counter()
+    vectors = []
+    for i in range(0, len(texts), batch_size):
+        vectors.extend(model.embed_documents(texts[i:i + batch_size]))
+    return normalize_rows(np.asarray(vectors, dtype=np.float32)), len(texts) / (time.perf_counter() - start)
+
+
+def recall_at_k(reference: np.ndarray, other: np.ndarray, k: int) -> float:
+    k = min(k, reference.shape[0])
+    hits = 0
+    for i in range(reference.shape[0]):
+        expected = set(top_k_indices(reference @ reference[i], k).tolist())
+        hits += len(expected & set(top_k_indices(other @ other[i], k).tolist()))
+    return hits / (reference.shape[0] * k)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=settings.DEFAULT_EMBEDDING_MODEL)
+    parser.add_argument('--quantization', default='avx2', help='avx2 / avx512 / avx512_vnni / arm64, 为空不测量化')
+    parser.add_argument('--limit', type=int, default=2000, help='术语、数据训练各取的条数')
+    parser.add_argument('--batch-size', type=int, default=settings.EMBEDDING_BATCH_SIZE)
+    parser.add_argument('--k', type=int, default=settings.EMBEDDING_DEFAULT_TOP_COUNT)
+    parser.add_argument('--sample', action='store_true', help='不连接数据库，使用内置样例语料')
+    args = parser.parse_args()
+
+    texts = SAMPLE if args.sample else load_corpus(args.limit)
+    if not texts:
+        print('corpus is empty, use --sample')
+        return
+    print(f'corpus: {len(texts)} texts')
+
+    backends = [('torch', ''), ('onnx', '')]
+    if args.quantization:
+        backends.append(('onnx', args.quantization))
+
+    reference = None
+    print(f"{'backend':>20} {'texts/s':>10} {'cosine avg':>11} {'cosine min':>11} {'recall@' + str(args.k):>10}")
+    for backend, quantization in backends:
+        config = EmbeddingModelInfo(folder=settings.LOCAL_MODEL_PATH, name=args.model, backend=backend,
+                                    quantization=quantization)
+        # onnx 直接加载，不回退到 torch
+        model = EmbeddingModelCache._new_onnx_instance(config) if backend == 'onnx' \
+            else EmbeddingModelCache._new_instance(config)
+        vectors, throughput = encode(model, texts, args.batch_size)
+        name = backend + (f' int8 {quantization}' if quantization else '')
+        if reference is None:
+            reference = vectors
+            print(f"{name:>20} {throughput:10.1f} {'-':>11} {'-':>11} {'-':>10}")
+            continue
+        cosine = np.sum(reference * vectors, axis=1)
+        print(f"{name:>20} {throughput:10.1f} {cosine.mean():11.4f} {cosine.min():11.4f} "
+              f"{recall_at_k(reference, vectors, args.k):10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+向量化服务基准测试：逐条调用模型 vs EmbeddingService 微批
+需要本地向量模型（LOCAL_MODEL_PATH），在 backend 环境中运行:
+    cd backend
+    python ../tools/bench-scripts/bench_embedding_batch.py --queries 200 --concurrency 16 --documents 500
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'backend'))
+
+from apps.ai_model.embedding import EmbeddingModelCache, EmbeddingService  # noqa: E402
+
+WORDS = ['订单', '销售额', '客户', '地区', '月份', '同比', '增长', '产品', '库存', '退货', 'order', 'amount',
+         'customer', 'region', 'status', 'created_at']
+
+
+def random_text(rng: random.Random, min_words: int, max_words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def p95(latencies: list[float]) -> float:
+    latencies = sorted(latencies)
+    return latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000
+
+
+def run_queries(embed, questions: list[str], concurrency: int) -> tuple[float, float]:
+    def timed(question):
+        start = time.perf_counter()
+        embed(question)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(timed, questions))
+    return len(questions) / (time.perf_counter() - start), p95(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--documents', type=int, default=500)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    questions = [random_text(rng, 3, 12) for _ in range(args.queries)]
+    documents = [random_text(rng, 10, 300) for _ in range(args.documents)]
+
+    model = EmbeddingModelCache.get_model()
+    model.embed_query('warm up')
+
+    lock = threading.Lock()
+
+    def direct(question):
+        # 原先的方式：每个问题单独调用一次模型
+        with lock:
+            return model.embed_query(question)
+
+    print(f"{'':>22} {'texts/s':>10} {'p95 (ms)':>10}")
+    qps, latency = run_queries(direct, questions, args.concurrency)
+    print(f"{'query direct':>22} {qps:10.1f} {latency:10.1f}")
+    qps, latency = run_queries(EmbeddingService.embed_query, questions, args.concurrency)
+    print(f"{'query micro batch':>22} {qps:10.1f} {latency:10.1f}")
+
+    start = time.perf_counter()
+    model.embed_documents(documents)
+    print(f"{'bulk unsorted':>22} {len(documents) / (time.perf_counter() - start):10.1f} {'-':>10}")
+    start = time.perf_counter()
+    EmbeddingService.embed_documents(documents)
+    print(f"{'bulk sorted chunks':>22} {len(documents) / (time.perf_counter() - start):10.1f} {'-':>10}")
+
+    print()
+    print(EmbeddingService.stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+向量检索基准测试：全表计算相似度后过滤 vs 先过滤再 ORDER BY 距离 LIMIT（HNSW 索引）
+在独立的 schema 中生成聚类分布的随机向量（默认每个工作空间 10 万条），需要安装了 pgvector 的 PostgreSQL:
+    cd backend
+    python ../tools/bench-scripts/bench_vector_search.py --rows 100000 --workspaces 2
+不指定 --url 时使用 SQLBot 的数据库配置，结束后删除生成的 schema（--keep 保留）
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from sqlalchemy import create_engine, text
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'backend'))
+
+from common.core.config import settings  # noqa: E402
+
+SCHEMA = 'sqlbot_bench'
+
+# 与术语检索原先的写法一致：子查询先计算每一行的相似度，无法使用索引
+LEGACY_SQL = f"""
+SELECT id, similarity FROM
+(SELECT id, oid, enabled, ( 1 - (embedding <=> CAST(:embedding AS vector)) ) AS similarity
+FROM {SCHEMA}.terminology) TEMP
+WHERE similarity > :threshold AND oid = :oid AND enabled = true
+ORDER BY similarity DESC
+LIMIT :k
+"""
+
+INDEXED_SQL = f"""
+SELECT id, similarity FROM
+(SELECT id, ( 1 - (embedding <=> CAST(:embedding AS vector)) ) AS similarity
+FROM {SCHEMA}.terminology
+WHERE oid = :oid AND enabled = true AND embedding IS NOT NULL
+ORDER BY embedding <=> CAST(:embedding AS vector)
+LIMIT :k) TEMP
+WHERE similarity > :threshold
+ORDER BY similarity DESC
+"""
+
+
+def prepare(conn, rows: int, workspaces: int, dim: int):
+    conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+    conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+    conn.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+    conn.execute(text(f"""
+        CREATE TABLE {SCHEMA}.terminology (id BIGSERIAL PRIMARY KEY, oid BIGINT, enabled BOOLEAN,
+                                           embedding vector({dim}))"""))
+    # 100 个聚类中心加噪声，比均匀随机向量更接近真实语料
+    conn.execute(text(f"""
+        CREATE TABLE {SCHEMA}.centers AS
+        SELECT c AS id, array_agg(random() - 0.5 ORDER BY d) AS v
+        FROM generate_series(0, 99) c, generate_series(1, {dim}) d GROUP BY c"""))
+    start = time.perf_counter()
+    conn.execute(text(f"""
+        INSERT INTO {SCHEMA}.terminology (oid, enabled, embedding)
+        SELECT 1 + g % {workspaces}, g % 10 <> 0,
+               (SELECT array_agg(c.v[d] + (random() - 0.5) * 0.3 ORDER BY d)
+                FROM generate_series(1, {dim}) d)::vector
+        FROM generate_series(1, {rows * workspaces}) g JOIN {SCHEMA}.centers c ON c.id = g % 100"""))
+    print(f'insert {rows * workspaces} rows: {time.perf_counter() - start:.1f}s')
+
+    start = time.perf_counter()
+    conn.execute(text(f"CREATE INDEX ON {SCHEMA}.terminology USING hnsw (embedding vector_cosine_ops)"))
+    conn.execute(text(f"CREATE INDEX ON {SCHEMA}.terminology (oid)"))
+    conn.execute(text(f"ANALYZE {SCHEMA}.terminology"))
+    print(f'build indexes: {time.perf_counter() - start:.1f}s')
+
+
+def run(conn, sql: str, queries: list[tuple[int, str]], k: int, threshold: float, ef_search: int = 0):
+    latencies, results = [], []
+    for oid, embedding in queries:
+        if ef_search:
+            conn.execute(text(f"SET hnsw.ef_search = {ef_search}"))
+        start = time.perf_counter()
+        rows = conn.execute(text(sql), {'embedding': embedding, 'oid': oid, 'k': k, 'threshold': threshold})
+        results.append([row.id for row in rows])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.array(latencies), results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default=str(settings.SQLALCHEMY_DATABASE_URI))
+    parser.add_argument('--rows', type=int, default=100000, help='每个工作空间的行数')
+    parser.add_argument('--workspaces', type=int, default=2)
+    parser.add_argument('--dim', type=int, default=settings.EMBEDDING_DIMENSION)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--k', type=int, default=settings.EMBEDDING_DEFAULT_TOP_COUNT)
+    parser.add_argument('--threshold', type=float, default=settings.EMBEDDING_DEFAULT_SIMILARITY)
+    parser.add_argument('--ef-search', type=int, nargs='+', default=[40, settings.EMBEDDING_HNSW_EF_SEARCH, 200])
+    parser.add_argument('--keep', action='store_true')
+    args = parser.parse_args()
+
+    engine = create_engine(args.url, isolation_level='AUTOCOMMIT')
+    with engine.connect() as conn:
+        prepare(conn, args.rows, args.workspaces, args.dim)
+        try:
+            # 以库中向量加噪声作为问题
+            samples = conn.execute(text(f"""
+                SELECT oid, embedding::text AS embedding FROM {SCHEMA}.terminology
+                ORDER BY random() LIMIT {args.queries}""")).fetchall()
+            rng = np.random.default_rng(0)
+            queries = []
+            for row in samples:
+                vector = np.array(row.embedding.strip('[]').split(','), dtype=np.float32)
+                vector += rng.uniform(-0.05, 0.05, vector.shape[0]).astype(np.float32)
+                queries.append((row.oid, str(vector.tolist())))
+
+            legacy, expected = run(conn, LEGACY_SQL, queries, args.k, args.threshold)
+            print(f"{'query':>22} {'avg (ms)':>10} {'p95 (ms)':>10} {'recall@' + str(args.k):>10}")
+            print(f"{'legacy full scan':>22} {legacy.mean():10.2f} {np.percentile(legacy, 95):10.2f} {'1.000':>10}")
+            for ef_search in args.ef_search:
+                latencies, found = run(conn, INDEXED_SQL, queries, args.k, args.threshold, ef_search)
+                hits = sum(len(set(e) & set(f)) for e, f in zip(expected, found))
+                total = sum(len(e) for e in expected) or 1
+                print(f"{'hnsw ef_search=' + str(ef_search):>22} {latencies.mean():10.2f} "
+                      f"{np.percentile(latencies, 95):10.2f} {hits / total:10.3f}")
+        finally:
+            if not args.keep:
+                conn.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+
+
+if __name__ == '__main__':
+    main()